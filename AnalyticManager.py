@@ -4,43 +4,123 @@ Created on Jan 9, 2012
 @author: dmasad
 '''
 
+from heapq import merge
+
+from aggregates import timeBucket, bucketEnd
+from exporters import TRAIN_COUNT_FIELDS, TRAIN_COUNT_TYPES
+from headwayAnalytics import HeadwayAnalytics, REPORT_FIELDS, REPORT_TYPES
 from MetroManager_SQL import WMATAManager
+from ParallelReplay import parallelReplay
 
 class AnalyticManager(WMATAManager):
     '''
     Specific implementation of WMATAManager intended to analyze existing data.
     '''
     
-    def countAllTrains(self, filepath):
+    def countAllTrains(self, filepath, format=None):
         '''
         Count trains across each timestamp and generate the appropriate table.
-        '''
+        The rows are written as they are counted, so memory use stays constant.
         
-        cursor = self.db.db.cursor()
-        cursor.execute("SELECT DISTINCT EntryTime FROM ArrivalTimes")
-        timeStamps = [entry[0] for entry in cursor.fetchall()]
-        
-        allData = []
-        for timecode in timeStamps:
-            print timecode
-            self.currentSchedule = self.db.loadSchedule(timecode)
-            print len(self.currentSchedule)
+        format: 'csv', 'parquet' or 'arrow'; by default, set by the file extension.
+        '''
+        self.api.export_data(self.iterTrainCounts(), filepath, TRAIN_COUNT_FIELDS, format,
+                             TRAIN_COUNT_TYPES)
+    
+    def iterTrainCounts(self):
+        '''
+        Replay the stored schedules, yielding a record of the number of 
+        trains on each line at each timestamp.
+        Any trains already found are forgotten first.
+        '''
+        self.db.createIndexes()
+        for line in self.rail_lines:
+            line.resetTrains()
+        for timecode, schedule in self.db.iterSnapshots():
+            self.currentSchedule = schedule
+            self.current_time = timecode
+            self.instrumentation.count('snapshots')
+            self.instrumentation.count('entries', len(self.currentSchedule))
             self.findTrains()
             for line in self.rail_lines:
                 newEntry = {"TimeStamp": timecode}
                 newEntry['Line'] = line.lineCode
                 newEntry['Direction'] = line.reverse
                 newEntry['TrainCount'] = len(line.Trains)
-                allData.append(newEntry)
-        self.api.export_data(allData, filepath)
-                
-                
-                
-            
-            
+                yield newEntry
+    
+    def materializeAggregates(self, startTime=None, endTime=None):
+        '''
+        Recompute the aggregate tables from the stored schedules between
+        startTime and endTime, replacing what they held for those buckets.
+        Every bucket the bounds touch is replaced, and replayed in full: from
+        the start of startTime's bucket to the end of endTime's. Any trains
+        already found are forgotten first, and the interval estimates are
+        restored to those saved in the database, so the result doesn't 
+        depend on what ran before.
         
+        Returns the number of snapshots replayed.
+        '''
+        if startTime is not None:
+            startTime = timeBucket(startTime)
+        if endTime is not None:
+            endTime = bucketEnd(endTime)
+        self.db.deleteAggregates(startTime, None if endTime is None else timeBucket(endTime))
+        self.db.createIndexes()
+        for line in self.rail_lines:
+            line.resetTrains()
+            line.resetIntervals()
+        self._loadIntervalStats()
+        snapshots = 0
+        for timecode, schedule in self.db.iterSnapshots(startTime, endTime):
+            self.currentSchedule = schedule
+            self.current_time = timecode
+            self.findTrains()
+            observations = []
+            for line in self.rail_lines:
+                observations += line.updateStationIntervals(timecode)
+            self.updateAggregates(observations)
+            snapshots += 1
+        return snapshots
+    
+    def headwayReport(self, startTime, endTime, filepath=None, cacheDirectory=None, format=None):
+        '''
+        Summarize the headways, waits, bunching and gaps at each station, 
+        on each line and direction, from startTime to endTime (see 
+        headwayAnalytics.py), optionally writing the table to filepath.
         
-
-
-
-
+        cacheDirectory: directory to cache each day's arrival events in, so
+            later reports only process the days not seen before.
+        Returns the list of report rows.
+        '''
+        report = HeadwayAnalytics(self, cacheDirectory).stationReport(startTime, endTime)
+        if filepath is not None:
+            self.api.export_data(report, filepath, REPORT_FIELDS, format, REPORT_TYPES)
+        return report
+    
+    def countAllTrainsParallel(self, filepath, processes=None, windowCount=None, format=None):
+        '''
+        Count trains across each timestamp using a pool of worker processes,
+        and generate the same table as countAllTrains.
+        
+        Ghost trains are reset at the start of each time window, so counts
+        can differ slightly from the serial replay near window boundaries.
+        '''
+        replay = parallelReplay(self, processes, windowCount)
+        lineCounts = []
+        for index, line in enumerate(self.rail_lines):
+            counts, tracks = replay.get((line.lineCode, line.reverse), ([], []))
+            lineCounts.append([(timecode, index, trainCount) for timecode, trainCount in counts])
+        
+        def records():
+            # Merge the lines' counts into timestamp order:
+            for timecode, index, trainCount in merge(*lineCounts):
+                line = self.rail_lines[index]
+                newEntry = {"TimeStamp": timecode}
+                newEntry['Line'] = line.lineCode
+                newEntry['Direction'] = line.reverse
+                newEntry['TrainCount'] = trainCount
+                yield newEntry
+        with self.instrumentation.timer('export'):
+            self.api.export_data(records(), filepath, TRAIN_COUNT_FIELDS, format,
+                                 TRAIN_COUNT_TYPES)
@@ -8,81 +8,228 @@ database for storing all the relevant information.
 
 '''
 #import json
+import logging
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
 
 
+from aggregates import timeBucket, trainCountRows, headwayRows, intervalRows
+from instrumentation import NULL_INSTRUMENTATION
+from NetworkTopology import NetworkTopology, LINES
 from TrainLines import RailLine
-from wmata import WMATA
+from ScheduleSnapshot import ScheduleSnapshot
+from simulation import Simulator
+from trainPositions import TrainPositions
+from wmata import WMATA, WMATAError, DEFAULT_BASE_URL
 from WMATADatabase import WMATADatabase
 
-LINES = ["RD", "OR", "BL", "YL", "GR"]
+METADATA_VERSION = 1              # Bump to invalidate previously cached API data.
+METADATA_TTL = timedelta(days=7)  # How long cached API data is used before refreshing it.
+
+log = logging.getLogger(__name__)
 
 class WMATAManager(object):
     '''
     A class intended to manage acquiring and analyzing data for the 
     entire Metro system. Uses a SQLite database to store the information.
     '''
+    instrumentation = NULL_INSTRUMENTATION # Stage timers and counters; off by default.
 
-    def __init__(self, api_key, database=':memory:'):
+    def __init__(self, api_key, database=':memory:', metadataTTL=METADATA_TTL, 
+                 refreshMetadata=False, topology=None, instrumentation=None, archive=None,
+                 base_url=DEFAULT_BASE_URL, intervalModel=None):
         '''
         Initialize the system with a valid WMATA API key
+        
+        metadataTTL: timedelta for which the line and path data
+            cached in the database are used without asking the API again
+            (None to never expire them).
+        refreshMetadata: if True, fetch all of it from the API regardless
+            when building the topology.
+        topology: an existing NetworkTopology to share; if given, no line
+            data is loaded from the database or the API.
+        instrumentation: an instrumentation.Instrumentation to record the
+            time spent in each stage of processing.
+        archive: an archive.SnapshotArchive holding older schedules.
+        base_url: root URL of the API, e.g. that of a replayServer.ReplayServer.
+        intervalModel: an intervalModel.IntervalModel, giving the interval 
+            times by time of week used to estimate the trains' arrival times
+            and locations.
         '''
-        self.api = WMATA(api_key)
-        self.db = WMATADatabase(self, database)
-        self.current_time = ""
+        if instrumentation is not None:
+            self.instrumentation = instrumentation
+        self.api = WMATA(api_key, base_url)
+        self.db = WMATADatabase(self, database, archive=archive)
+        self.current_time = None # Time of the current schedule.
         self.currentSchedule = [] # List that holds the current schedule.
         self.stationData = self.db.loadStations() # Dictionary that holds the station data.
         self.lineData = {}        # Dictionary that holds the API line data.
-        self._getRailLines() # Load the rail line data.
-        
-        
+        self.metadataTTL = metadataTTL
+        self._refresh = refreshMetadata
+        self.metadata = {}        # Cached API data.
+        if topology is None:
+            self.metadata = self.db.loadMetadata()
+            self._getRailLines() # Load the rail line data.
+            topology = NetworkTopology.fromManager(self)
+        self._refresh = False # Only the initial load ignores the cache.
+        self.topology = topology  # Static network data, shared with any other managers.
         
         # Initialize the rail lines:
         # (NOTE: All necessary data should be loaded by this point)
         # ----------------------------------------------------------
         self.rail_lines = [] # List which will hold all the rail line objects.
-        for line in LINES:
-            for direction in [False, True]:
-                self.rail_lines.append(RailLine(self, line, reverse=direction))
+        for lineTopology in self.topology.lines:
+            self.rail_lines.append(RailLine(self, lineTopology.lineCode, 
+                                            lineTopology.reverse, lineTopology))
+        self.trainPositions = TrainPositions(self.rail_lines)
+        self._loadIntervalStats()
+        self.intervalModel = intervalModel
+        if intervalModel is not None:
+            for line in self.rail_lines:
+                stationCodes = [station.stationCode for station in line.stationList]
+                if intervalModel.stationCodes(line.lineCode, line.reverse) == stationCodes:
+                    line.intervalModel = intervalModel
+                else:
+                    log.warning("The interval model doesn't match line %s%s; not using it.",
+                                line.lineCode, " (reverse)" if line.reverse else "")
     
   
     
     def findTrains(self):
         '''
         Find all the trains in the current schedule.
+        The schedule may be a list of PID entries, or a ScheduleSnapshot.
         '''
-        pidDict = self._listToDict(self.currentSchedule, ['LocationCode','DestinationCode'])
+        if isinstance(self.currentSchedule, ScheduleSnapshot):
+            pidDict = self.currentSchedule
+        else:
+            with self.instrumentation.timer('parse'):
+                pidDict = self._listToDict(self.currentSchedule, ['LocationCode','DestinationCode'])
         for line in self.rail_lines:
-            line.findTrains(pidDict)
+            line.findTrains(pidDict, self.current_time)
      
             
     
+    def updateIntervals(self):
+        '''
+        Run only after finding trains.
+        Update the station interval estimates from the current trains, and 
+        save the new observations and updated statistics to the database.
+        Returns the new observations, as IntervalTimes rows.
+        '''
+        observations = []
+        stats = []
+        for line in self.rail_lines:
+            observations += line.updateStationIntervals(self.current_time)
+            for station in line.stationList:
+                for row in station.intervals.changedStats():
+                    stats.append((line.lineCode, int(line.reverse), station.stationCode) + row)
+        self.db.saveIntervals(observations)
+        self.db.saveIntervalStats(stats)
+        return observations
+    
+    def simulate(self, minutes=60, scenarios=None):
+        '''
+        Run only after finding trains.
+        Project the current trains forward minutes minutes, using the current
+        interval estimates (see RailLine.intervalTime), under each of a list
+        of simulation.Scenarios (by default, just the baseline).
+        Returns a simulation.Projection of the predicted arrivals.
+        '''
+        simulator = Simulator(self.rail_lines)
+        return simulator.run(minutes, scenarios)
+    
+    def updateAggregates(self, observations=()):
+        '''
+        Run only after finding trains.
+        Add the current train counts and headways, and the given interval 
+        observations (as returned by updateIntervals), to the materialized
+        aggregate tables.
+        Nothing on the collection path calls this; the tables are filled in
+        batches by AnalyticManager.materializeAggregates.
+        '''
+        bucket = timeBucket(self.current_time)
+        self.db.saveAggregates(trainCountRows(self.rail_lines, bucket),
+                               headwayRows(self.rail_lines, bucket),
+                               intervalRows(observations))
+    
+    def _loadIntervalStats(self):
+        '''
+        Restore the station interval estimates saved in the database.
+        '''
+        lines = dict(((line.lineCode, int(line.reverse)), line) for line in self.rail_lines)
+        for lineCode, direction, stationCode, slot, count, mean, m2, ewma in self.db.loadIntervalStats():
+            line = lines.get((lineCode, direction))
+            if line is not None and stationCode in line.stationDict:
+                line.stationDict[stationCode].intervals.restore(slot, count, mean, m2, ewma)
+    
     """
     DATA COLLECTION FROM THE API
     """
     
     def _getRailLines(self):
-        #TODO: Integrate with Database
-        lines_list = self.api.getRailLines()
+        lines_list = self._cachedMetadata('lines', self.api.getRailLines)
         for line in lines_list:
-            print line['LineCode']
+            log.debug("Loaded line %s", line['LineCode'])
             self.lineData[line['LineCode']] = line
     
     def getRailPath(self, startStation, endStation):
-        #TODO: Integrate with Database.
-        return self.api.getRailPath(startStation, endStation)
+        return self._cachedMetadata('path/%s/%s' % (startStation, endStation),
+                                    lambda: self.api.getRailPath(startStation, endStation))
+    
+    def refreshMetadata(self):
+        '''
+        Fetch the line and path data again from the API, and update the cache.
+        This manager's topology (and so its RailLines) is built once and is
+        left as it is; the refreshed data is used by the managers created
+        afterwards on the same database.
+        '''
+        self._refresh = True
+        try:
+            self._getRailLines()
+            for line in self.rail_lines:
+                self.getRailPath(line.startStation[0], line.endStation[0])
+        finally:
+            self._refresh = False
+    
+    def _cachedMetadata(self, key, fetch):
+        '''
+        Return the cached API data for key if it is current; otherwise, 
+        get it by calling fetch() and cache it.
+        If the API can't be reached, fall back on stale cached data.
+        '''
+        cached = self.metadata.get(key)
+        if cached is not None and cached[0] == METADATA_VERSION and not self._refresh:
+            version, fetched, value = cached
+            if self.metadataTTL is None or datetime.now() - fetched < self.metadataTTL:
+                return value
+        try:
+            value = fetch()
+        except (WMATAError, ValueError, KeyError):
+            if cached is None or cached[0] != METADATA_VERSION: raise
+            log.warning("Using stale cached data for %s", key)
+            return cached[2]
+        fetched = datetime.now()
+        self.db.saveMetadata(key, value, METADATA_VERSION, fetched)
+        self.metadata[key] = (METADATA_VERSION, fetched, value)
+        return value
     
     def updateSchedule(self):
         '''
         Pull the updated schedule from the API.
+        Returns False (and keeps the previous schedule) if the update failed.
         '''
         try:
-            self.currentSchedule = self.api.updateSchedule()
+            with self.instrumentation.timer('fetch'):
+                self.currentSchedule = self.api.updateSchedule()
             self.current_time = datetime.now()
-        except:
-            # TODO: Catch the error here.
-            pass
+        except (WMATAError, ValueError, KeyError) as error:
+            log.warning("Schedule update failed: %s", error)
+            self.instrumentation.count('failures')
+            return False
+        self.instrumentation.count('polls')
+        self.instrumentation.count('entries', len(self.currentSchedule))
+        return True
   
          
     """
@@ -93,31 +240,31 @@ class WMATAManager(object):
         '''
         Generates a JSON file with the coordinates for each line.
         '''
-        lineCoords = {}
-        for line in self.rail_lines:
-            if line.lineCode not in lineCoords:
-                lineCoords[line.lineCode] = []
-                for station in line.stationList:
-                    newcoords = [station.stationName, station.lat, station.lon]
-                    lineCoords[line.lineCode].append(newcoords)
-        self.api._exportJSON(lineCoords, filepath)
+        with self.instrumentation.timer('export'):
+            lineCoords = {}
+            for line in self.rail_lines:
+                if line.lineCode not in lineCoords:
+                    lineCoords[line.lineCode] = []
+                    for station in line.stationList:
+                        newcoords = [station.stationName, station.lat, station.lon]
+                        lineCoords[line.lineCode].append(newcoords)
+            self.api._exportJSON(lineCoords, filepath)
     
     def exportAllTrains(self, filepath):
         '''
         Export the positions of all trains as JSON file.
         '''
-        trainCoords = {}        
-        for line in self.rail_lines:
-            newTrains = []
-            for train in line.Trains:
-                train.findLocation()
-                newTrains.append([train.lat, train.lon])
-            if line.lineCode in trainCoords:
-                trainCoords[line.lineCode] = trainCoords[line.lineCode] + newTrains
-            else:
-                trainCoords[line.lineCode] = newTrains
-        
-        self.api._exportJSON(trainCoords, filepath)
+        with self.instrumentation.timer('export'):
+            trainCoords = {}        
+            positions = self.trainPositions.locate()
+            for line, (lats, lons) in zip(self.rail_lines, positions):
+                newTrains = [[lat, lon] for lat, lon in zip(lats.tolist(), lons.tolist())]
+                if line.lineCode in trainCoords:
+                    trainCoords[line.lineCode] = trainCoords[line.lineCode] + newTrains
+                else:
+                    trainCoords[line.lineCode] = newTrains
+            
+            self.api._exportJSON(trainCoords, filepath)
         
     """
     MISC HELPER FUNCTIONS
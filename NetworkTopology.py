@@ -0,0 +1,158 @@
+'''
+Created on Jan 30, 2012
+
+@author: dmasad
+
+Immutable description of the rail network: the lines, their directions
+and terminals, and the ordered stations along each one.
+
+A NetworkTopology is built once (from the API data, or loaded from a file)
+and shared read-only between managers and worker processes. All the
+per-run state (arrivals, trains, interval estimates) stays in the
+RailLine and Station objects built on top of it.
+'''
+
+import cPickle as pickle
+
+import numpy as np
+
+LINES = ["RD", "OR", "BL", "YL", "GR"]
+
+class _Frozen(object):
+    '''
+    Base for objects whose attributes can't be changed after __init__.
+    '''
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s is immutable" % type(self).__name__)
+
+    def _set(self, name, value):
+        object.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+            self._set(name, value)
+
+
+class StationInfo(_Frozen):
+    '''
+    Static data on one station of a line.
+    seqNum is the index of the station along the line, starting at 0.
+    '''
+    __slots__ = ('stationCode', 'stationName', 'seqNum', 'lat', 'lon')
+
+    def __init__(self, stationCode, stationName, seqNum, lat, lon):
+        self._set('stationCode', stationCode)
+        self._set('stationName', stationName)
+        self._set('seqNum', seqNum)
+        self._set('lat', lat)
+        self._set('lon', lon)
+
+
+class LineTopology(_Frozen):
+    '''
+    Static data on one rail line, in one direction.
+
+    startStation, endStation: tuples of the terminal station codes, followed
+        by the internal destination codes ('' if none) of trains in this direction.
+    stations: tuple of StationInfo, in order along the line.
+    stationIndex: dictionary of seqNums by station code (treat as read-only).
+    lats, lons: read-only arrays of the station coordinates.
+    '''
+    __slots__ = ('lineCode', 'reverse', 'startStation', 'endStation', 'stations',
+                 'stationIndex', 'lats', 'lons')
+
+    def __init__(self, lineCode, reverse, startStation, endStation, stations):
+        self._set('lineCode', lineCode)
+        self._set('reverse', reverse)
+        self._set('startStation', tuple(startStation))
+        self._set('endStation', tuple(endStation))
+        self._set('stations', tuple(stations))
+        self._set('stationIndex', dict((station.stationCode, station.seqNum)
+                                       for station in stations))
+        self._set('lats', _readOnly([station.lat for station in stations]))
+        self._set('lons', _readOnly([station.lon for station in stations]))
+
+    @classmethod
+    def fromAPI(cls, lineData, getRailPath, stationData, lineCode, reverse=False):
+        '''
+        Build a line from the API data.
+
+        lineData: the JLines entry for the line.
+        getRailPath: function returning the JPath stations between two station codes.
+        stationData: dictionary of station data (with Lat and Lon), by station code.
+        '''
+        startStation = [lineData['StartStationCode'], lineData['InternalDestination1']]
+        endStation = [lineData['EndStationCode'], lineData['InternalDestination2']]
+
+        if lineCode == 'YL': # Temporary hard-coding to deal with error in WMATA Yellow Line coding:
+            startStation = [u'C15', '']
+            endStation[0] = u'E06'
+            endStation[1] = u'B06'
+            endStation.append(u'E01')
+
+        if reverse == True: # Reverse the direction if needed:
+            startStation, endStation = endStation, startStation
+
+        stations = []
+        for station in getRailPath(startStation[0], endStation[0]):
+            code = station['StationCode']
+            stations.append(StationInfo(code, station['StationName'],
+                                        int(station['SeqNum']) - 1, # Adjust to correspond to the list.
+                                        stationData[code]['Lat'], stationData[code]['Lon']))
+        return cls(lineCode, reverse, startStation, endStation, stations)
+
+
+class NetworkTopology(_Frozen):
+    '''
+    The full network: a LineTopology for each line and direction.
+    '''
+    __slots__ = ('lines',)
+
+    def __init__(self, lines):
+        self._set('lines', tuple(lines))
+
+    def line(self, lineCode, reverse=False):
+        for line in self.lines:
+            if line.lineCode == lineCode and line.reverse == reverse:
+                return line
+        raise KeyError((lineCode, reverse))
+
+    @classmethod
+    def fromManager(cls, manager, lineCodes=LINES):
+        '''
+        Build the network from a WMATAManager's line, path and station data.
+        '''
+        lines = []
+        for lineCode in lineCodes:
+            for reverse in [False, True]:
+                lines.append(LineTopology.fromAPI(manager.lineData[lineCode], manager.getRailPath,
+                                                  manager.stationData, lineCode, reverse))
+        return cls(lines)
+
+    def save(self, filepath):
+        f = open(filepath, "wb")
+        pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+
+    @classmethod
+    def load(cls, filepath):
+        f = open(filepath, "rb")
+        topology = pickle.load(f)
+        f.close()
+        return topology
+
+
+def _readOnly(values):
+    array = np.array(values, dtype=float)
+    array.flags.writeable = False
+    return array
@@ -0,0 +1,202 @@
+'''
+Created on Jan 20, 2012
+
+@author: dmasad
+
+Replay stored schedules across a pool of worker processes.
+
+The work is split into one job per rail line, direction and contiguous
+time window. Each window (after the first) starts one snapshot early, on
+the last snapshot of the window before it; since the trains found in a
+single snapshot don't depend on the history, the trains found in that
+shared snapshot can be used to stitch the train tracks of neighbouring
+windows together. Ghost trains are not carried across window boundaries.
+
+Each worker process receives the manager's NetworkTopology once, when it
+starts, and builds its RailLines from it.
+'''
+
+from multiprocessing import Pool
+
+from MetroManager_SQL import WMATAManager
+from archive import SnapshotArchive
+from TrainLines import RailLine
+from WMATADatabase import WMATADatabase
+
+
+class _ReplayManager(WMATAManager):
+    '''
+    Minimal WMATAManager for use inside a worker process, with no API access.
+    '''
+
+    def __init__(self, topology):
+        self.topology = topology
+
+
+_topology = None # The NetworkTopology attached to this worker process.
+
+def _attachTopology(topology):
+    '''
+    Pool initializer: keep the shared topology for all of this worker's jobs.
+    '''
+    global _topology
+    _topology = topology
+
+
+def splitWindows(timeStamps, windowCount):
+    '''
+    Split a sorted list of timestamps into windowCount contiguous windows.
+    Every window after the first also begins with the last timestamp of the
+    window before it.
+    '''
+    windowCount = max(1, min(windowCount, len(timeStamps)))
+    size = len(timeStamps) // windowCount
+    extra = len(timeStamps) % windowCount
+    windows = []
+    start = 0
+    for i in range(windowCount):
+        end = start + size + (1 if i < extra else 0)
+        if i == 0:
+            windows.append(timeStamps[start:end])
+        else:
+            windows.append(timeStamps[start-1:end])
+        start = end
+    return windows
+
+
+def replayWindow(job):
+    '''
+    Replay a single time window for a single line and direction.
+
+    job: tuple of (database path, archive directory or None, lineCode, reverse,
+        windowIndex, timeStamps)
+
+    Returns a dictionary with:
+        counts: list of (timecode, train count) tuples
+        tracks: list of (timecode, trackId, next station seqNum, ETA) tuples
+        firstIds, lastIds: the trackIds of the trains found in the first and
+            last snapshots of the window, in the order they were found.
+    '''
+    database, archiveDirectory, lineCode, reverse, windowIndex, timeStamps = job
+    manager = _ReplayManager(_topology)
+    line = RailLine(manager, lineCode, reverse, _topology.line(lineCode, reverse))
+    archive = None
+    if archiveDirectory is not None:
+        archive = SnapshotArchive(archiveDirectory)
+    db = WMATADatabase(manager, database, archive=archive)
+
+    stationCodes = [station.stationCode for station in line.stationList]
+    schedules = db.iterSnapshots(timeStamps[0], timeStamps[-1], stationCodes)
+    nextSchedule = next(schedules, (None, None))
+
+    result = {'counts': [], 'tracks': [], 'firstIds': [], 'lastIds': []}
+    trackCount = 0
+    for timecode in timeStamps:
+        # Timestamps with no entries on this line replay as an empty schedule:
+        if nextSchedule[0] == timecode:
+            schedule = nextSchedule[1]
+            nextSchedule = next(schedules, (None, None))
+        else:
+            schedule = manager._listToDict([], ['LocationCode','DestinationCode'])
+        line.findTrains(schedule)
+
+        # Carry the track IDs forward from the matched trains:
+        trackIds = []
+        for train in line.newTrains:
+            if train.matched:
+                train.trackId = train.matched.trackId
+            else:
+                train.trackId = (windowIndex, trackCount)
+                trackCount += 1
+            trackIds.append(train.trackId)
+            eta = train.findETA(train.nextStation.stationCode)
+            result['tracks'].append((timecode, train.trackId, train.nextStation.seqNum, eta))
+        result['counts'].append((timecode, len(line.Trains)))
+
+        if timecode == timeStamps[0]:
+            result['firstIds'] = trackIds
+        result['lastIds'] = trackIds
+    db.db.close()
+    return result
+
+
+def stitchWindows(results):
+    '''
+    Combine the per-window results for a single line and direction, in time order.
+    Drops the snapshot shared between each pair of neighbouring windows and
+    renumbers the tracks so that continuing tracks keep a single ID.
+
+    Returns a tuple of (counts, tracks) lists, as in replayWindow.
+    '''
+    aliases = {}
+    globalIds = {}
+
+    def resolve(trackId):
+        trackId = aliases.get(trackId, trackId)
+        if trackId not in globalIds:
+            globalIds[trackId] = len(globalIds)
+        return globalIds[trackId]
+
+    counts = []
+    tracks = []
+    for index, result in enumerate(results):
+        skip = 0
+        if index > 0:
+            skip = 1
+            previousIds = results[index-1]['lastIds']
+            # The shared snapshot yields the same trains in the same order.
+            if len(previousIds) == len(result['firstIds']):
+                for oldId, newId in zip(previousIds, result['firstIds']):
+                    aliases[newId] = aliases.get(oldId, oldId)
+        firstTime = result['counts'][0][0] if result['counts'] else None
+        counts += result['counts'][skip:]
+        for timecode, trackId, seqNum, eta in result['tracks']:
+            if skip and timecode == firstTime: continue
+            tracks.append((timecode, resolve(trackId), seqNum, eta))
+    return counts, tracks
+
+
+def parallelReplay(manager, processes=None, windowCount=None, startTime=None, endTime=None):
+    '''
+    Replay all the schedules stored in manager's database in parallel.
+
+    manager: an initialized WMATAManager, backed by a database file.
+    processes: number of worker processes (defaults to the number of CPUs).
+    windowCount: number of time windows per line (defaults to processes).
+
+    Returns a dictionary keyed by (lineCode, reverse), with (counts, tracks)
+    tuples as returned by stitchWindows.
+    '''
+    if manager.db.database == ':memory:':
+        raise ValueError("Parallel replay requires a database file.")
+
+    pool = Pool(processes, _attachTopology, (manager.topology,))
+    if windowCount is None:
+        windowCount = pool._processes
+
+    manager.db.createIndexes()
+    timeStamps = manager.db.loadTimestamps(startTime, endTime)
+    if not timeStamps:
+        pool.close()
+        return {}
+    windows = splitWindows(timeStamps, windowCount)
+
+    archiveDirectory = None
+    if manager.db.archive is not None:
+        archiveDirectory = manager.db.archive.directory
+    jobs = []
+    for line in manager.rail_lines:
+        for windowIndex, window in enumerate(windows):
+            jobs.append((manager.db.database, archiveDirectory, line.lineCode, line.reverse,
+                         windowIndex, window))
+    try:
+        results = pool.map(replayWindow, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    replay = {}
+    for i, line in enumerate(manager.rail_lines):
+        lineResults = results[i*len(windows):(i+1)*len(windows)]
+        replay[(line.lineCode, line.reverse)] = stitchWindows(lineResults)
+    return replay
@@ -0,0 +1,177 @@
+'''
+Created on Jan 22, 2012
+
+@author: dmasad
+
+Columnar representation of a single PID schedule snapshot.
+
+Instead of one dictionary per PID entry, a ScheduleSnapshot holds the
+station, destination, minutes and assigned train of every entry in NumPy
+arrays, together with a sort/offset index for looking up the entries by
+(LocationCode, DestinationCode).
+'''
+
+import numpy as np
+
+from wmata import parseMinutes
+
+NO_TRAIN = -1 # Value of the train array for entries not assigned to a train.
+
+class ScheduleSnapshot(object):
+    '''
+    A single schedule, stored column-wise.
+
+    stationCodes: list of the station codes the index arrays refer to.
+    location: array of station indexes of each entry's LocationCode.
+    destination: array of station indexes of each entry's DestinationCode,
+        or -1 for entries with no destination.
+    minutes: array of minutes until arrival; 0 for arriving and boarding
+        trains, and -1 for unknown entries.
+    train: array of the train ID assigned to each entry, or NO_TRAIN.
+    '''
+
+    def __init__(self, stationCodes, location, destination, minutes, entryTime=None):
+        self.entryTime = entryTime
+        self.stationCodes = stationCodes
+        self.stationIndex = dict((code, i) for i, code in enumerate(stationCodes))
+
+        self.location = np.asarray(location, dtype=np.int16)
+        self.destination = np.asarray(destination, dtype=np.int16)
+        self.minutes = np.asarray(minutes, dtype=np.int16)
+        self.train = np.empty(len(self.location), dtype=np.int32)
+        self.train.fill(NO_TRAIN)
+
+        # Sort the entries by (location, destination, minutes):
+        self._keyBase = len(stationCodes) + 1
+        keys = self.location.astype(np.int32) * self._keyBase + (self.destination + 1)
+        self.order = np.lexsort((self.minutes, keys))
+        self.sortedKeys = keys[self.order]
+
+    @classmethod
+    def fromSchedule(cls, schedule, entryTime=None):
+        '''
+        Build a snapshot from a list of PID entry dictionaries.
+        '''
+        stationCodes = []
+        stationIndex = {}
+        def index(code):
+            if code is None: return -1
+            if code not in stationIndex:
+                stationIndex[code] = len(stationCodes)
+                stationCodes.append(code)
+            return stationIndex[code]
+
+        location = []
+        destination = []
+        minutes = []
+        for entry in schedule:
+            location.append(index(entry['LocationCode']))
+            destination.append(index(entry['DestinationCode']))
+            entryMinutes = entry['Min']
+            if not isinstance(entryMinutes, int):
+                entryMinutes = parseMinutes(entryMinutes)[0]
+            minutes.append(-1 if entryMinutes is None else entryMinutes)
+        return cls(stationCodes, location, destination, minutes, entryTime)
+
+    def __len__(self):
+        return len(self.location)
+
+    def lookup(self, locationCode, destinationCode):
+        '''
+        Return the indexes of the entries at locationCode headed to
+        destinationCode, in order of increasing minutes.
+        '''
+        if locationCode not in self.stationIndex:
+            return self.order[:0]
+        if destinationCode is None:
+            destination = -1
+        elif destinationCode in self.stationIndex:
+            destination = self.stationIndex[destinationCode]
+        else:
+            return self.order[:0]
+        key = self.stationIndex[locationCode] * self._keyBase + destination + 1
+        start, end = np.searchsorted(self.sortedKeys, [key, key + 1])
+        return self.order[start:end]
+
+    def arrivals(self, locationCode, destinationCodes):
+        '''
+        Return views of the known entries at locationCode headed to any of
+        destinationCodes, in order of increasing minutes.
+        '''
+        indexes = np.concatenate([self.lookup(locationCode, destinationCode)
+                                  for destinationCode in destinationCodes])
+        indexes = indexes[self.minutes[indexes] >= 0]
+        indexes = indexes[np.argsort(self.minutes[indexes], kind='mergesort')]
+        return [PIDEntry(self, index) for index in indexes]
+
+    def lineArrivals(self, locationCodes, destinationCodes):
+        '''
+        Find the known entries at any of locationCodes headed to any of
+        destinationCodes, for a whole line at once.
+
+        Returns arrays of the entries' indexes, their location (as an index
+        in locationCodes), their minutes and their destination (as an index
+        in destinationCodes), sorted by location, then by minutes; entries
+        with the same minutes are in the order of destinationCodes, then in
+        schedule order, as in arrivals().
+        '''
+        locationNumbers = np.empty(len(self.stationCodes), dtype=np.int32)
+        locationNumbers.fill(-1)
+        destinationNumbers = np.empty(len(self.stationCodes) + 1, dtype=np.int32)
+        destinationNumbers.fill(-1) # Offset by one, for entries with no destination.
+        for number, code in enumerate(locationCodes):
+            if code in self.stationIndex:
+                locationNumbers[self.stationIndex[code]] = number
+        for number, code in reversed(list(enumerate(destinationCodes))):
+            if code in self.stationIndex:
+                destinationNumbers[self.stationIndex[code] + 1] = number
+        location = locationNumbers[self.location]
+        destination = destinationNumbers[self.destination + 1]
+        indexes = np.nonzero((location >= 0) & (destination >= 0) & (self.minutes >= 0))[0]
+        location = location[indexes]
+        minutes = self.minutes[indexes]
+        destination = destination[indexes]
+        order = np.lexsort((destination, minutes, location))
+        return indexes[order], location[order], minutes[order], destination[order]
+
+    def entry(self, index):
+        '''
+        Return a dictionary-like view of a single entry.
+        '''
+        return PIDEntry(self, index)
+
+
+class PIDEntry(object):
+    '''
+    Lightweight view of one entry of a ScheduleSnapshot, supporting the
+    PID dictionary keys used by the train finder: 'LocationCode',
+    'DestinationCode', 'Min' and 'Train'.
+    Setting 'Min' or 'Train' writes through to the snapshot's arrays.
+    '''
+    __slots__ = ('snapshot', 'index')
+
+    def __init__(self, snapshot, index):
+        self.snapshot = snapshot
+        self.index = index
+
+    def __getitem__(self, key):
+        snapshot = self.snapshot
+        if key == 'Min':
+            return int(snapshot.minutes[self.index])
+        elif key == 'Train':
+            train = snapshot.train[self.index]
+            return None if train == NO_TRAIN else int(train)
+        elif key == 'DestinationCode':
+            destination = snapshot.destination[self.index]
+            return None if destination < 0 else snapshot.stationCodes[destination]
+        elif key == 'LocationCode':
+            return snapshot.stationCodes[snapshot.location[self.index]]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'Min':
+            self.snapshot.minutes[self.index] = value
+        elif key == 'Train':
+            self.snapshot.train[self.index] = NO_TRAIN if value is None else value
+        else:
+            raise KeyError(key)
@@ -8,12 +8,26 @@ A suite of functions to identify trains on a specific rail line.
 '''
 #from wmata import WMATA
 from __future__ import division
-from trainClustering import matchTrains
+from collections import deque
 
-class Train:
+import numpy as np
+
+from trainClustering import matchTrains, MATCH_THRESHOLD, MAX_GHOST_AGE
+from ScheduleSnapshot import ScheduleSnapshot, NO_TRAIN
+from wmata import parseMinutes
+from intervalStats import IntervalEstimator
+from NetworkTopology import LineTopology
+
+MAX_LISTINGS = 64 # Number of PID listings kept with each train.
+
+class Train(object):
     '''
     Class to hold the information and methods on trains as they are identified. 
     '''
+    __slots__ = ('railLine', 'lineCode', 'destinationCode', 'trainId', 'trackId',
+                 'listings', 'arrivalTimes', 'nextStation', 'matched',
+                 'confidence', 'ghost', 'end_of_track', 'lat', 'lon')
+    
     def __init__(self, railLine, destinationCode):
         '''
         Create a new train, associated with a RailLine object railLine.
@@ -21,18 +35,20 @@ class Train:
         self.railLine = railLine
         self.lineCode = railLine.lineCode
         self.destinationCode = destinationCode
-        self.listings = []     # List of all PID Listings associated with the train.
-        self.arrivalTimes = {} # Dictionary of arrival times for the train, by station.
-        
+        self.trainId = None    # Number of the train, within its line and snapshot.
+        self.trackId = None    # Identifier carried across snapshots, where used.
+        self.listings = deque(maxlen=MAX_LISTINGS) # The most recent PID Listings associated with the train.
+        # Arrival times for the train, indexed by station seqNum (None if unknown):
+        self.arrivalTimes = [None] * len(railLine.stationList)
         
         self.nextStation = None        # Station object for the next station.
-        
-        self.Trains = []
         self.matched = False
         
         self.confidence = 1          # Counter of number of iterations the train has been detected.
         self.ghost = 0               # Flag for a train that has vanished from the boards, but may still be on the track.
         self.end_of_track = False    # Flag set to TRUE when the train is at the end of the track.
+        self.lat = None
+        self.lon = None
     
     def update_location(self, nextStation):
         '''
@@ -44,7 +60,8 @@ class Train:
     
     def update_listings(self, newListing):
         self.listings.append(newListing)
-        self.arrivalTimes[newListing['LocationCode']] = newListing['Min']
+        seqNum = self.railLine.stationDict[newListing['LocationCode']].seqNum
+        self.arrivalTimes[seqNum] = newListing['Min']
         
     def fill_listings(self):
         '''
@@ -52,35 +69,42 @@ class Train:
         '''
         maxMinutes = 0
         for station in self.railLine.stationList[self.nextStation.seqNum:]:
-            if station.stationCode in self.arrivalTimes:
-                maxMinutes = self.arrivalTimes[station.stationCode]
+            if self.arrivalTimes[station.seqNum] is not None:
+                maxMinutes = self.arrivalTimes[station.seqNum]
                 # Temporary hack:
                 if type(maxMinutes) not in [int, float]: 
                     maxMinutes = float(maxMinutes) 
-            else:
-                maxMinutes += station.intervalTime()
-                self.arrivalTimes[station.stationCode] = maxMinutes
+            elif maxMinutes is not None:
+                interval = self.railLine.intervalTime(station)
+                if interval is None:
+                    maxMinutes = None # No estimates until the next listed station.
+                else:
+                    maxMinutes += interval
+                    self.arrivalTimes[station.seqNum] = maxMinutes
         
         
     
     def findETA(self, stationCode):
-        if stationCode in self.arrivalTimes:
-            return self.arrivalTimes[stationCode]
-        else:
+        station = self.railLine.stationDict.get(stationCode)
+        if station is None:
             return None
+        return self.arrivalTimes[station.seqNum]
     
     def advance(self, minutes):
         '''
         Advance all arrivalTimes by the given # of minutes, and adjust location accordingly.
         minutes: number of minutes to advance entries by.
         
-        TODO: Project forward using estimated travel times. 
+        To project trains past their listed arrival times, using the estimated
+        travel times, see simulation.Simulator.
         '''
         
-        for key in self.arrivalTimes:
-            self.arrivalTimes[key] -= minutes
+        for seqNum, eta in enumerate(self.arrivalTimes):
+            if eta is not None:
+                self.arrivalTimes[seqNum] = eta - minutes
         
-        while self.arrivalTimes[self.nextStation.stationCode] < 0:
+        while self.arrivalTimes[self.nextStation.seqNum] is not None \
+                and self.arrivalTimes[self.nextStation.seqNum] < 0:
             if self.nextStation.nextStation is None:
                 self.end_of_track = True
                 break
@@ -101,9 +125,9 @@ class Train:
             prevLon = prevStation.lon
             
             try:
-                fraction = self.findETA(self.nextStation.stationCode)/self.nextStation.intervalTime()
-            except:
-                # In face of divide by zero error.
+                fraction = self.findETA(self.nextStation.stationCode)/self.railLine.intervalTime(self.nextStation)
+            except (TypeError, ZeroDivisionError):
+                # No ETA or interval time (None), or an interval time of zero.
                 fraction = 0.5
             if fraction>1: 
                 # Temporary hack, until better intervalTime is resolved.
@@ -112,45 +136,54 @@ class Train:
             self.lat = prevLat + (nextLat - prevLat)*fraction
             self.lon = prevLon + (nextLon - prevLon)*fraction
     
-class Station:
+class Station(object):
     '''
     Class to store the data relating to stations on the line.
     '''
-    def __init__(self, railLine, station):
+    __slots__ = ('info', 'stationCode', 'stationName', 'seqNum', 'lat', 'lon',
+                 'arrivals', 'minutes', 'destinations', 'intervals', 'nextStation',
+                 'prevStation')
+    
+    def __init__(self, railLine, info):
         '''
         railLine: the parent RailLine object.
-        station: output from the Rail Path API Method.
+        info: the station's NetworkTopology.StationInfo, holding its static data.
         '''
-        self.stationCode = station['StationCode'] # The station code
-        self.stationName = station['StationName']
-        self.seqNum = int(station['SeqNum']) - 1 # Adjust the sequence number to correspond to the list.
-        self.arrivals = [] # List of PID entry objects associated with the station
-        self.intervalTimes = [] # List of estimated times from the previous station to this one.
+        self.info = info
+        self.stationCode = info.stationCode # The station code
+        self.stationName = info.stationName
+        self.seqNum = info.seqNum
+        self.lat = info.lat
+        self.lon = info.lon
+        
+        self.arrivals = [] # PID entries at the station (or their indexes in a ScheduleSnapshot).
+        self.minutes = []  # The arrivals' minutes, and destination codes.
+        self.destinations = []
+        self.intervals = IntervalEstimator() # Estimated times from the previous station to this one.
         
         # Pointers to the next and previous Station objects.
         self.nextStation = None
         self.prevStation = None
         
-        stationData = railLine.manager.stationData[self.stationCode]
-        self.lat = stationData['Lat']
-        self.lon = stationData['Lon']
-        
     
-    def intervalTime(self):
+    def intervalTime(self, timestamp=None):
         '''
-        Compute the current estimated travel time from the previous station.
+        The current estimated travel time from the previous station, for the
+        time of day of timestamp if given; None if there is no estimate yet.
         '''
-        return sum(self.intervalTimes)/len(self.intervalTimes)
+        return self.intervals.estimate(timestamp)
     
 
 class RailLine:
     
-    def __init__(self, Manager, lineCode, reverse = False):
+    def __init__(self, Manager, lineCode, reverse = False, topology = None):
         '''
         Create a new object storing data on a rail line in the WMATA system.
         Manager is an initialized MEtroManager Object
         lineCode is a valid WMATA rail line code (RD, OR, BL, YL, GR)
         reverse determines the direction
+        topology is the NetworkTopology.LineTopology of the line and direction;
+            if None, it is built from the Manager's API data.
         '''
         
         self.manager = Manager # An instance of MetroManager.
@@ -159,28 +192,25 @@ class RailLine:
         
         self.stationTimes = {}
         self.Trains = []
+        self.matchThreshold = MATCH_THRESHOLD # Maximum distance (minutes) to match trains across snapshots.
+        self.maxGhostAge = MAX_GHOST_AGE # Snapshots to keep unmatched trains (None to keep them forever).
+        self.intervalModel = None # intervalModel.IntervalModel of the interval times by time of week.
+        self.slotIntervals = None # The model's interval times for the current schedule, by seqNum.
+        self.snapshot = None # The current ScheduleSnapshot, if the schedule is one.
         # List and Dictionary directories of the stations on the line.
         self.stationList = []
         self.stationDict = {}
         
-        line = self.manager.lineData[self.lineCode]
-        self.startStation = [line['StartStationCode'], line['InternalDestination1'] ]
-        self.endStation = [line['EndStationCode'], line['InternalDestination2'] ]
+        if topology is None:
+            topology = LineTopology.fromAPI(self.manager.lineData[self.lineCode], 
+                                            self.manager.getRailPath, self.manager.stationData,
+                                            self.lineCode, self.reverse)
+        self.topology = topology
+        self.startStation = list(topology.startStation)
+        self.endStation = list(topology.endStation)
         
-        if self.lineCode == 'YL': # Temporary hard-coding to deal with error in WMATA Yellow Line coding:
-            self.startStation = [u'C15', '']
-            self.endStation[0] = u'E06'
-            self.endStation[1] = u'B06'
-            self.endStation.append(u'E01')
-        
-        if self.reverse == True: # Reverse the direction if needed: 
-            self.startStation, self.endStation = self.endStation, self.startStation
-        
-        
-        path = self.manager.getRailPath(self.startStation[0], self.endStation[0])
-        
-        for station in path:
-            newStation = Station(self, station)
+        for info in topology.stations:
+            newStation = Station(self, info)
             self.stationList.append(newStation)
             self.stationDict[newStation.stationCode] = newStation
         
@@ -191,134 +221,220 @@ class RailLine:
                 station.prevStation = self.stationList[index - 1]
    
     
+    def intervalTime(self, station):
+        '''
+        The estimated travel time to a station from the previous one: the
+        interval model's estimate for the time of the current schedule if 
+        there is one, else the station's current estimate (None if neither).
+        '''
+        if self.slotIntervals is not None:
+            interval = self.slotIntervals[station.seqNum]
+            if interval is not None:
+                return interval
+        return station.intervalTime()
+    
     def _matchPIDs(self, dictPID):
         '''
-        Get the current PIDs from a dictionary of PIDs, keyed with a tuple of locationCode and endStation.
+        Get the current PIDs from a dictionary of PIDs, keyed with a tuple of locationCode and endStation,
+        or from a ScheduleSnapshot.
+        
+        Each station's arrivals are sorted by minutes, and their minutes and
+        destination codes are also listed in station.minutes and 
+        station.destinations, which is all the train finder reads. From a
+        ScheduleSnapshot, the arrivals are the entries' indexes in the 
+        snapshot, found for the whole line at once; PID listings are only
+        built for the entries assigned to trains (see _listing).
         '''
-        
+        if isinstance(dictPID, ScheduleSnapshot):
+            self.snapshot = dictPID
+            endStations = [code for code in self.endStation if code != '']
+            indexes, location, minutes, destination = dictPID.lineArrivals(
+                [station.stationCode for station in self.stationList], endStations)
+            dictPID.train[indexes] = NO_TRAIN
+            bounds = np.searchsorted(location, np.arange(len(self.stationList) + 1)).tolist()
+            indexes = indexes.tolist()
+            minutes = minutes.tolist()
+            destinations = [endStations[number] for number in destination.tolist()]
+            for station, start, end in zip(self.stationList, bounds[:-1], bounds[1:]):
+                station.arrivals = indexes[start:end]
+                station.minutes = minutes[start:end]
+                station.destinations = destinations[start:end]
+            return
+        
+        self.snapshot = None
         for station in self.stationList:
             arrivals = []
             for i in range(len(self.endStation)):
                 if self.endStation[i] != '':
                     arrivals = arrivals + dictPID[(station.stationCode, self.endStation[i])]
             # Clean up entries:
+            cleanArrivals = []
             for entry in arrivals:
-                # Convert the arrival time to integers:
-                if entry['Min'] in ['ARR', "BRD"]: 
-                    entry['Min'] = 0
-                else:
-                    try: 
-                        int_min = int(entry['Min'])
-                        entry['Min'] = int_min
-                    except:
-                        arrivals.remove(entry) # Remove empty or nonstandard entries
-            station.arrivals = sorted(arrivals, key=lambda k: k['Min'])
-                
-        
+                # Stored entries are already integers; convert the live ones:
+                if not isinstance(entry['Min'], int):
+                    entry['Min'] = parseMinutes(entry['Min'])[0]
+                if entry['Min'] is not None: # Remove empty or nonstandard entries
+                    entry['Train'] = None
+                    cleanArrivals.append(entry)
+            station.arrivals = sorted(cleanArrivals, key=lambda k: k['Min'])
+            station.minutes = [entry['Min'] for entry in station.arrivals]
+            station.destinations = [entry['DestinationCode'] for entry in station.arrivals]
     
-    def findTrains(self, dictPID):
+    def _listing(self, station, position, trainId):
+        '''
+        Assign the entry at a position of a station's arrivals to a train, 
+        and return it as a PID listing. Entries of a ScheduleSnapshot are
+        copied into a small dictionary, so trains don't keep whole snapshots
+        in memory.
+        '''
+        if self.snapshot is None:
+            entry = station.arrivals[position]
+            entry['Train'] = trainId
+            return entry
+        self.snapshot.train[station.arrivals[position]] = trainId
+        return {'LocationCode': station.stationCode, 'DestinationCode': station.destinations[position],
+                'Min': station.minutes[position], 'Train': trainId}
+    
+    def resetTrains(self):
+        '''
+        Forget the trains found so far, before replaying schedules that
+        don't follow on from them.
+        '''
+        self.Trains = []
+
+    def resetIntervals(self):
+        '''
+        Forget the stations' interval estimates, e.g. before restoring the
+        saved ones.
+        '''
+        for station in self.stationList:
+            station.intervals = IntervalEstimator()
+
+    def findTrains(self, dictPID, timestamp=None):
         '''
         Estimate the locations of trains in the system.
         
         dictPID: A dictionary keyed with tuples (StationCode, EndStation)
-            listing all relevant PID entries for that station in that direction.
+            listing all relevant PID entries for that station in that direction,
+            or a ScheduleSnapshot.
+        timestamp: the time of the schedule; by default, the ScheduleSnapshot's
+            entryTime. The interval model needs it to look up the interval
+            times for the time of week.
+        
+        Every train is rebuilt from the schedule, and matched to the 
+        previous ones.
         '''
-        self._matchPIDs(dictPID)
+        instrumentation = self.manager.instrumentation
+        with instrumentation.timer('matchPIDs'):
+            self._matchPIDs(dictPID)
+        if timestamp is None and isinstance(dictPID, ScheduleSnapshot):
+            timestamp = dictPID.entryTime
+        if self.intervalModel is not None and timestamp:
+            self.slotIntervals = self.intervalModel.slotIntervals(self.lineCode, self.reverse,
+                                                                  timestamp)
         self.oldTrains = self.Trains
         self.newTrains = []
-
-        for station in self.stationList:
-            for entry in station.arrivals:
-                entry['Train'] = None 
-        
-
-        startingNumber = 0
         self.trainCount = 0
         
-        for station in self.stationList:
-            for entry in station.arrivals:
-                if entry['Train'] is None: self._seekTrainForward(startingNumber, len(self.newTrains))
-            startingNumber = startingNumber + 1
+        with instrumentation.timer('assembleTrains'):
+            self._assembleTrains()
         
         # Match the new trains to the old trains:
-        print self.lineCode, self.reverse
-        for train in self.newTrains:
-            train.fill_listings()
-        self.Trains = matchTrains(self.oldTrains, self.newTrains)
+        with instrumentation.timer('matchTrains'):
+            for train in self.newTrains:
+                train.fill_listings()
+            self.Trains = matchTrains(self.oldTrains, self.newTrains, self.matchThreshold,
+                                      maxGhost=self.maxGhostAge)
+        instrumentation.count('trains', len(self.newTrains))
 
-    def _seekTrainForward(self, startingNumber, initTrainCount, destinationCode=None):
+    def _assembleTrains(self):
         '''
-        startingNumber: Index of station to start with.
-        initTrainCount: Trains already added to the system.
-        
-        This function works as follows:
-        Start from an initial station: 
-            The first available entry (one not associated with a previous train)
-            becomes a new train. 
-            This arrival time becomes the current maxTime
-        Move to the next station:
-            If the first available entry has an arrival time > maxTime:
-                Associate it with the same train; this becomes new maxTime
-            If there is an available entry with time < maxTime:
-                Recursively launch the function forward, so that this becomes a new train.
+        Group the arrivals at each station into trains, appending them to newTrains.
+        
+        This works as follows:
+        Go through the stations in order. Each available entry (one not
+        associated with a previous train) starts a new train, whose arrival
+        time becomes the current maxWait. Then move on to the next station:
+            If the first available entry has the same destination and an 
+            arrival time > maxWait, associate it with the train; this 
+            becomes the new maxWait.
+            Otherwise, that entry starts a new train, which is followed all
+            the way down the line before returning to this one.
         Continue until all stations have been traversed.
-                
-        '''
         
-        
-        trainCount = initTrainCount
-        maxWait = 0 # Maximum wait time for this train.
-        # Create a new train
-        for entry in self.stationList[startingNumber].arrivals:
-            if entry['Train'] == None and (entry['DestinationCode']==destinationCode or destinationCode is None):
-                #Associate the entry with the new train:
-                trainCount = trainCount + 1
-                self.trainCount = self.trainCount + 1
-                newTrain = Train(self, destinationCode)
-                destinationCode = entry['DestinationCode']
-                # print "Creating a new train, between " + self.path[startingNumber - 1]['StationName'] + " and " +  self.path[startingNumber]['StationName']
-                newTrain.update_location(self.stationList[startingNumber])
-                entry['Train'] = trainCount
-                newTrain.update_listings(entry)
-                maxWait = entry['Min']
-                entry['Train'] = trainCount
-                break
-        
-        if trainCount == initTrainCount: return initTrainCount
-        
-        # Now advance forward:
-        # TODO: replace counter with enumerate.
-        counter = startingNumber + 1
-        while counter < len(self.stationList):
-            for entry in self.stationList[counter].arrivals:
-                if entry['Train'] == None: 
-                    if entry['Min'] > maxWait and entry['DestinationCode']==destinationCode:
-                        entry['Train'] = trainCount
-                        newTrain.update_listings(entry)
-                        maxWait = entry['Min']
-                        break
-                    elif entry['DestinationCode']==destinationCode:
-                        self._seekTrainForward(counter, self.trainCount, destinationCode)
+        Each station's arrivals are sorted, and the entries assigned to trains
+        always form a prefix of them, so the state is a pointer to the first
+        available entry at each station, plus a stack of the trains being
+        followed and their (destination, maxWait, next station index).
+        Every step either assigns an entry or advances a train by one station,
+        so the cost is O(stations x entries). Only the stations' minutes and
+        destination lists are read; the PID listings are built as entries
+        are assigned.
+        '''
+        stations = self.stationList
+        minutes = [station.minutes for station in stations]
+        destinations = [station.destinations for station in stations]
+        nextFree = [0] * len(stations) # Index of the first available entry, by station.
+        
+        def assign(train, stationNumber):
+            index = nextFree[stationNumber]
+            nextFree[stationNumber] = index + 1
+            train.arrivalTimes[stationNumber] = minutes[stationNumber][index]
+            train.listings.append(self._listing(stations[stationNumber], index, train.trainId))
+        
+        def startTrain(stationNumber):
+            # Start a new train from the first available entry at the station,
+            # and return its sweep state.
+            index = nextFree[stationNumber]
+            self.trainCount = self.trainCount + 1
+            newTrain = Train(self, destinations[stationNumber][index])
+            newTrain.trainId = self.trainCount
+            newTrain.update_location(stations[stationNumber])
+            assign(newTrain, stationNumber)
+            return [newTrain, newTrain.destinationCode, minutes[stationNumber][index], 
+                    stationNumber + 1]
+        
+        for startingNumber in range(len(stations)):
+            while nextFree[startingNumber] < len(minutes[startingNumber]):
+                stack = [startTrain(startingNumber)]
+                while stack:
+                    state = stack[-1]
+                    train, destinationCode, maxWait, counter = state
+                    if counter == len(stations):
+                        # Reached the end of the line:
+                        stack.pop()
+                        self.newTrains.append(train)
+                        continue
+                    index = nextFree[counter]
+                    if index == len(minutes[counter]):
+                        state[3] = counter + 1
+                        continue
+                    entryMinutes = minutes[counter][index]
+                    if entryMinutes > maxWait and destinations[counter][index] == destinationCode:
+                        assign(train, counter)
+                        state[2] = entryMinutes
+                        state[3] = counter + 1
                     else:
-                        self._seekTrainForward(counter, self.trainCount)
-            counter = counter + 1
-        self.newTrains.append(newTrain)
+                        stack.append(startTrain(counter))
         
                     
-    def updateStationIntervals(self):
+    def updateStationIntervals(self, timestamp=None):
         '''
         Run only after locating trains.
         Update the estimates of the travel time from station to station based on current PID data.
         
-        TODO: Make more elegant.
-        This is an hacked-together temporary solution.
-        Eventually, implement a full database and pull timings based on day/time.
+        timestamp: the time of the current PID data.
+        Returns the observed intervals, as IntervalTimes rows of 
+        (EntryTime, LineCode, Direction, StationCode, EstInterval).
         '''
+        observations = []
         for index, station in enumerate(self.stationList[1:]): # Index starts counting from 0.
-            station.intervalTimes = []
             for train in self.Trains:
                 etaStation = train.findETA(station.stationCode)
                 etaPrev = train.findETA(self.stationList[index].stationCode) # Index here = actual index - 1
                 if etaStation != None and etaPrev != None:
                     timing = etaStation - etaPrev
-                    station.intervalTimes.append(timing)
\ No newline at end of file
+                    station.intervals.update(timing, timestamp)
+                    observations.append((timestamp, self.lineCode, int(self.reverse), 
+                                         station.stationCode, timing))
+        return observations
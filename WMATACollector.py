@@ -0,0 +1,252 @@
+'''
+Created on Jan 28, 2012
+
+@author: dmasad
+
+Collection service that polls the WMATA prediction API at a fixed cadence
+and saves every schedule to the database.
+
+Three kinds of threads keep the parts independent of each other:
+    The scheduler fires polls at a fixed cadence (plus a random jitter),
+    backing off after consecutive failures.
+    A small pool of fetcher threads makes the requests, over pooled
+    keep-alive connections with timeouts, so a slow response never
+    delays the next poll.
+    The writer takes the schedules from a bounded queue and saves them
+    to the database, committing every bufferPolls schedules.
+If the writer falls behind and the queue is full, new schedules are dropped
+(and counted) rather than holding up the polls.
+
+Each schedule is saved with the time its poll was made, and the writer
+saves them in that order: a schedule that arrives before one polled
+earlier is held back until the earlier one is queued (or has failed), so
+the SnapshotIds follow the EntryTimes, as the delta encoding and the
+range queries expect.
+
+No trains are found here, so the aggregate tables are not updated as the
+schedules arrive; see AnalyticManager.materializeAggregates.
+'''
+
+import heapq
+import logging
+import random
+import sqlite3
+import time
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Full, Empty
+from threading import Thread, Event, Lock
+
+from instrumentation import NULL_INSTRUMENTATION
+from wmata import WMATA, WMATAError, DEFAULT_BASE_URL, DEFAULT_TIMEOUT
+from WMATADatabase import WMATADatabase
+
+log = logging.getLogger(__name__)
+
+_STOP = object() # Queue marker telling the writer to finish.
+_WAKE = object() # Queue marker telling the writer a poll has failed.
+
+class WMATACollector(object):
+    '''
+    Polls GetPrediction/All and writes the results to a SQLite database.
+    '''
+
+    def __init__(self, api_key, database, interval=20, jitter=1.0, maxBackoff=300,
+                 fetchers=2, queueSize=30, bufferPolls=1, keyframeInterval=1,
+                 base_url=DEFAULT_BASE_URL, timeout=DEFAULT_TIMEOUT, instrumentation=None):
+        '''
+        api_key: a valid WMATA API key.
+        database: path to an initialized database file.
+        interval: seconds between polls.
+        jitter: maximum random delay, in seconds, added to each poll.
+        maxBackoff: maximum seconds between polls after repeated failures.
+        fetchers: number of requests that can be in flight at once.
+        queueSize: maximum number of schedules waiting to be written.
+        bufferPolls: number of schedules to write per database transaction.
+        keyframeInterval: save every keyframeInterval-th schedule in full, and
+            only the changes in between (see WMATADatabase).
+        base_url, timeout: passed on to the WMATA API object.
+        instrumentation: an instrumentation.Instrumentation to time the
+            fetch and store stages.
+        '''
+        self.api = WMATA(api_key, base_url, timeout)
+        self.database = database
+        self.interval = interval
+        self.jitter = jitter
+        self.maxBackoff = maxBackoff
+        self.fetchers = fetchers
+        self.bufferPolls = bufferPolls
+        self.keyframeInterval = keyframeInterval
+        self.queue = Queue(queueSize)
+        self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+
+        self.stats = {'polls': 0, 'failures': 0, 'dropped': 0, 'written': 0}
+        self._failures = 0   # Consecutive failed polls.
+        self._lock = Lock()
+        self._stopping = Event()
+        self._threads = []
+        self._pool = None
+        self._inFlight = set() # Sequence numbers of the polls not yet queued or failed.
+
+    def start(self):
+        '''
+        Start collecting in the background.
+        '''
+        self._stopping.clear()
+        self._inFlight = set()
+        self._pool = ThreadPool(self.fetchers)
+        self._threads = [Thread(target=self._writeLoop, name="WMATACollector-writer"),
+                         Thread(target=self._scheduleLoop, name="WMATACollector-scheduler")]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        '''
+        Stop polling, wait for the requests in flight, and write everything
+        still queued to the database. Does nothing if the collector isn't running.
+        '''
+        if not self._threads: return
+        self._stopping.set()
+        self._threads[1].join()
+        self._pool.close()
+        self._pool.join()
+        writer = self._threads[0]
+        while writer.is_alive(): # A writer that has failed won't empty the queue.
+            try:
+                self.queue.put(_STOP, timeout=1)
+                break
+            except Full:
+                pass
+        writer.join()
+        self._threads = []
+        self.api.pool.close()
+
+    def run(self):
+        '''
+        Collect in the foreground until interrupted.
+        '''
+        self.start()
+        try:
+            while not self._stopping.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def nextDelay(self):
+        '''
+        Seconds from one scheduled poll to the next: the interval, or the
+        exponential backoff after consecutive failures.
+        '''
+        with self._lock:
+            failures = self._failures
+        if failures == 0:
+            return self.interval
+        return min(self.maxBackoff, self.interval * 2 ** failures)
+
+    def _scheduleLoop(self):
+        nextPoll = time.time()
+        sequence = 0
+        while not self._stopping.is_set():
+            delay = nextPoll + random.uniform(0, self.jitter) - time.time()
+            if delay > 0 and self._stopping.wait(delay):
+                break
+            sequence += 1
+            with self._lock:
+                self._inFlight.add(sequence)
+            self._pool.apply_async(self._fetch, (sequence, datetime.now()))
+            # Keep to the cadence; skip any polls we have fallen behind on.
+            step = self.nextDelay()
+            nextPoll += step
+            if nextPoll < time.time():
+                nextPoll = time.time() + step
+
+    def _fetch(self, sequence, entryTime):
+        '''
+        Fetch one schedule and queue it for writing.
+        sequence: the number of the poll, counting from 1.
+        entryTime: the time the poll was made.
+        '''
+        queued = False
+        try:
+            try:
+                with self.instrumentation.timer('fetch'):
+                    schedule = self.api.updateSchedule()
+            except (WMATAError, ValueError, KeyError) as error:
+                log.warning("Poll failed: %s", error)
+                with self._lock:
+                    self._failures += 1
+                    self.stats['failures'] += 1
+                return
+            with self._lock:
+                self._failures = 0
+                self.stats['polls'] += 1
+            try:
+                self.queue.put_nowait((sequence, entryTime, schedule))
+                queued = True
+            except Full:
+                log.warning("Write queue full; dropped the schedule from %s", entryTime)
+                with self._lock:
+                    self.stats['dropped'] += 1
+        finally:
+            # Only once the schedule is queued, so the writer can't pass it by:
+            with self._lock:
+                self._inFlight.discard(sequence)
+            if not queued:
+                self._wakeWriter()
+
+    def _wakeWriter(self):
+        '''
+        Let the writer save any schedules held back for a poll that wasn't queued.
+        '''
+        try:
+            self.queue.put_nowait(_WAKE)
+        except Full:
+            pass # The writer has plenty to wake up to.
+
+    def _writeLoop(self):
+        # SQLite connections can't be shared across threads, so open one here.
+        try:
+            db = WMATADatabase(None, self.database, self.bufferPolls, self.keyframeInterval)
+        except sqlite3.Error:
+            log.exception("Failed to open the database %s; nothing will be saved", self.database)
+            return
+        waiting = [] # Heap of the (sequence, entryTime, schedule) not yet written.
+        stopped = False
+        try:
+            while not stopped:
+                items = [self.queue.get()]
+                with self._lock:
+                    earliest = min(self._inFlight) if self._inFlight else None
+                # Every poll before the earliest one in flight is queued by now:
+                try:
+                    while True:
+                        items.append(self.queue.get_nowait())
+                except Empty:
+                    pass
+                for item in items:
+                    if item is _STOP:
+                        stopped = True
+                    elif item is not _WAKE:
+                        heapq.heappush(waiting, item)
+                while waiting and (earliest is None or waiting[0][0] < earliest):
+                    sequence, entryTime, schedule = heapq.heappop(waiting)
+                    self._save(db, entryTime, schedule)
+        finally:
+            db.close()
+
+    def _save(self, db, entryTime, schedule):
+        '''
+        Save one schedule. Any error is logged and the schedule skipped, so
+        one bad poll can't stop the writer.
+        '''
+        try:
+            with self.instrumentation.timer('store'):
+                db.saveSchedule(schedule, entryTime)
+        except Exception:
+            log.exception("Failed to save the schedule from %s", entryTime)
+            return
+        with self._lock:
+            self.stats['written'] += 1
@@ -6,24 +6,90 @@ Created on Jan 09, 2012
 Class to manage the Metro Database.
 '''
 
+import json
 import sqlite3
-from collections import defaultdict
+import sys
+from collections import defaultdict, OrderedDict
+from datetime import timedelta
+from itertools import groupby
+
+import numpy as np
+
+from wmata import parseMinutes
+from ScheduleSnapshot import ScheduleSnapshot
+from intervalStats import ALL_DAY
+from utilities import asDatetime
+
+TOMBSTONE = -1 # ArrivalState of a delta row marking an entry as gone.
+
+# Column order of the legacy ArrivalTimes table, as PID entry keys.
+SCHEDULE_KEYS = ["CurrentTime", "Group", "Min", "DestinationCode", "Car", "Destination",\
+                 "DestinationName", "LocationName", "Line", "LocationCode"]
+
 
 class WMATADatabase:
     '''
     A class intended to handle storing and retrieving Metro data from
     a SQLite database.
+    
+    PID entries are stored in a compact form: each poll is a row in the
+    Snapshots table, and each of its entries is a row of small integers in
+    the Arrivals table. The station, destination and line strings are
+    dictionary-encoded in the Locations, Destinations and Lines tables.
+    
+    Optionally, schedules can be delta-encoded: only every keyframeInterval-th
+    poll (a keyframe) is saved in full in Arrivals. The polls in between
+    save only the entries that changed since the poll before, to the 
+    ArrivalDeltas table, with tombstone rows for the entries that are gone.
+    Entries are matched across polls by their board (LocationId, 
+    DestinationId, LineId, TrainGroup) and their Rank among that board's
+    entries. The loading methods reconstruct the full schedules.
+    
+    Older schedules can be moved to a SnapshotArchive (see archive.py); the
+    loading methods then read the archive first, and the database only for
+    schedules newer than anything in the archive.
     '''
     
-    def __init__(self, Manager, database=':memory:'):
+    def __init__(self, Manager, database=':memory:', bufferPolls=1, keyframeInterval=1, 
+                 archive=None):
         '''
         Create a new WMATA Database connection.
         
         Manager: the parent WMATAManager object.
         database: the database connection path.
+        bufferPolls: number of schedules to hold in memory before 
+            writing them to the database in a single transaction.
+        keyframeInterval: save every keyframeInterval-th schedule in full, 
+            and only the changes in the rest (1 saves every schedule in full).
+        archive: an archive.SnapshotArchive of older schedules to read from.
         '''
         
+        self.database = database
         self.db = sqlite3.connect(database, detect_types=sqlite3.PARSE_DECLTYPES)
+        if database != ':memory:':
+            # Write-ahead logging, and only sync at checkpoints:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+        
+        self.bufferPolls = bufferPolls
+        self._pendingPolls = [] # Buffered (EntryTime, Arrivals rows) not yet written.
+        self._pendingCodes = [] # Buffered (query, row) inserts into the code tables.
+        
+        self.keyframeInterval = keyframeInterval
+        self.archive = archive
+        self._deltaState = None     # Keyed entries of the last poll written, for delta encoding.
+        self._sinceKeyframe = 0     # Polls written since the last keyframe.
+        self._deltaTablesReady = False
+        
+        # Dictionary encodings, loaded on first use:
+        self._codesLoaded = False
+        self.locationIds = {}     # LocationCode -> LocationId
+        self.destinationIds = {}  # (DestinationCode, Destination, DestinationName) -> DestinationId
+        self.lineIds = {}         # Line -> LineId
+        self.locations = {}       # LocationId -> (LocationCode, LocationName)
+        self.destinations = {}    # DestinationId -> (DestinationCode, Destination, DestinationName)
+        self.lines = {}           # LineId -> Line
+        self._snapshotCodes = None
     
     def initializeDatabase(self):
         '''
@@ -46,36 +112,224 @@ class WMATADatabase:
             )
         ''')
         
-        
-        # Create the ArrivalTimes table to store PIDs:
+        # Create IntervalTimes table to store between-station interval times.
+        cursor.execute('''
+            CREATE TABLE IntervalTimes
+            (
+            EntryTime TIMESTAMP,
+            LineCode TEXT,
+            Direction INTEGER,
+            StationCode TEXT,
+            EstInterval REAL
+            )
+            ''')
+        self.db.commit()
+        self.createIntervalStatsTable()
+        self.createMetadataTable()
+        self.createScheduleTables()
+        self.createAggregateTables()
+    
+    def createMetadataTable(self):
+        '''
+        Create the Metadata table, caching the static API data (lines, paths
+        and station information) as JSON. Safe to run against an existing database.
+        '''
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS Metadata
+            (
+            Key TEXT PRIMARY KEY,
+            Version INTEGER,
+            Fetched TIMESTAMP,
+            Value TEXT
+            )
+            ''')
+        self.db.commit()
+    
+    def createIntervalStatsTable(self):
+        '''
+        Create the IntervalStats table, holding the running interval statistics
+        of each station by time-of-day slot (slot -1 covers all times).
+        Safe to run against an existing database.
+        '''
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS IntervalStats
+            (
+            LineCode TEXT,
+            Direction INTEGER,
+            StationCode TEXT,
+            Slot INTEGER,
+            Count INTEGER,
+            Mean REAL,
+            M2 REAL,
+            Ewma REAL,
+            PRIMARY KEY (LineCode, Direction, StationCode, Slot)
+            )
+            ''')
+        self.db.commit()
+    
+    def createScheduleTables(self):
+        '''
+        Create the tables (and indexes) storing the PID entries.
+        Safe to run against an existing database.
+        '''
+        cursor = self.db.cursor()
         cursor.execute('''
-            CREATE TABLE ArrivalTimes
+            CREATE TABLE IF NOT EXISTS Snapshots
             (
+            SnapshotId INTEGER PRIMARY KEY,
             EntryTime TIMESTAMP,
-            TrainGroup TEXT, 
-            Min TEXT, 
-            DestinationCode TEXT, 
-            Car TEXT, 
-            Destination TEXT, 
-            DestinationName TEXT,
-            LocationName TEXT,
-            Line TEXT, 
-            LocationCode TEXT
+            Keyframe INTEGER NOT NULL DEFAULT 1
             )
         ''')
+        columns = [row[1] for row in cursor.execute("PRAGMA table_info(Snapshots)")]
+        if 'Keyframe' not in columns: # Databases from before delta encoding.
+            cursor.execute("ALTER TABLE Snapshots ADD COLUMN Keyframe INTEGER NOT NULL DEFAULT 1")
         
-        # Create IntervalTimes table to store between-station interval times.
+        # Each row is one PID entry, clustered by snapshot. 
+        # Minutes is NULL for UNKNOWN arrival states.
         cursor.execute('''
-            CREATE TABLE IntervalTimes
+            CREATE TABLE IF NOT EXISTS Arrivals
             (
-            EntryTime TIMESTAMP,
+            SnapshotId INTEGER,
+            Ordinal INTEGER,
+            LocationId INTEGER,
+            DestinationId INTEGER,
+            LineId INTEGER,
+            TrainGroup INTEGER,
+            Minutes INTEGER,
+            ArrivalState INTEGER,
+            Car INTEGER,
+            PRIMARY KEY (SnapshotId, Ordinal)
+            ) WITHOUT ROWID
+        ''')
+        
+        # The changed entries of delta-encoded snapshots; ArrivalState is
+        # TOMBSTONE (and Minutes and Car NULL) for entries that are gone.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ArrivalDeltas
+            (
+            SnapshotId INTEGER,
+            Ordinal INTEGER,
+            LocationId INTEGER,
+            DestinationId INTEGER,
+            LineId INTEGER,
+            TrainGroup INTEGER,
+            Rank INTEGER,
+            Minutes INTEGER,
+            ArrivalState INTEGER,
+            Car INTEGER,
+            PRIMARY KEY (SnapshotId, Ordinal)
+            ) WITHOUT ROWID
+        ''')
+        
+        # Dictionary tables for the string fields:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS Locations
+            (
+            LocationId INTEGER PRIMARY KEY,
+            LocationCode TEXT,
+            LocationName TEXT
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS Destinations
+            (
+            DestinationId INTEGER PRIMARY KEY,
+            DestinationCode TEXT,
+            Destination TEXT,
+            DestinationName TEXT
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS Lines
+            (
+            LineId INTEGER PRIMARY KEY,
+            Line TEXT
+            )
+        ''')
+        self.db.commit()
+        self.createIndexes()
+    
+    def createAggregateTables(self):
+        '''
+        Create the materialized aggregate tables, holding running totals by
+        time bucket (see aggregates.py):
+            TrainCounts: trains per line and direction.
+            Headways: gaps between listed arrivals, per station.
+            IntervalAverages: observed interval times, per station.
+        Safe to run against an existing database.
+        '''
+        cursor = self.db.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS TrainCounts
+            (
+            Bucket TIMESTAMP,
+            LineCode TEXT,
+            Direction INTEGER,
+            Snapshots INTEGER,
+            TrainTotal INTEGER,
+            MaxTrains INTEGER,
+            PRIMARY KEY (Bucket, LineCode, Direction)
+            )
+            ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS Headways
+            (
+            Bucket TIMESTAMP,
             LineCode TEXT,
             Direction INTEGER,
             StationCode TEXT,
-            EstInterval REAL
+            Count INTEGER,
+            Total REAL,
+            MinHeadway REAL,
+            MaxHeadway REAL,
+            PRIMARY KEY (Bucket, LineCode, Direction, StationCode)
+            )
+            ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS IntervalAverages
+            (
+            Bucket TIMESTAMP,
+            LineCode TEXT,
+            Direction INTEGER,
+            StationCode TEXT,
+            Count INTEGER,
+            Total REAL,
+            PRIMARY KEY (Bucket, LineCode, Direction, StationCode)
             )
             ''')
         self.db.commit()
+    
+    def createIndexes(self):
+        '''
+        Create the indexes used by the replay and lookup queries.
+        Safe to run against an existing database.
+        '''
+        cursor = self.db.cursor()
+        cursor.execute('''CREATE INDEX IF NOT EXISTS Snapshots_EntryTime
+                            ON Snapshots (EntryTime)''')
+        self.db.commit()
+
+    def createQueryIndexes(self):
+        '''
+        Create the covering indexes used by the range queries (see
+        WMATAQueries.py): the PID entries by station and snapshot, and the
+        interval times by line, direction, station and time. They slow down
+        saving, so they are only created on demand.
+        Safe to run against an existing database.
+        '''
+        self.createScheduleTables()
+        cursor = self.db.cursor()
+        cursor.execute('''CREATE INDEX IF NOT EXISTS Arrivals_Location
+                            ON Arrivals (LocationId, SnapshotId, Ordinal, DestinationId, LineId,
+                                         TrainGroup, Minutes, ArrivalState, Car)''')
+        table = cursor.execute("""SELECT name FROM sqlite_master
+                                    WHERE type = 'table' AND name = 'IntervalTimes'""").fetchone()
+        if table is not None:
+            cursor.execute('''CREATE INDEX IF NOT EXISTS IntervalTimes_Station
+                                ON IntervalTimes (LineCode, Direction, StationCode, EntryTime,
+                                                  EstInterval)''')
+        self.db.commit()
         
     def saveStations(self, stationList):
         '''
@@ -118,63 +372,718 @@ class WMATADatabase:
                            [entry for entry in intervalList])
         self.db.commit()
     
+    def saveMetadata(self, key, value, version, fetched):
+        '''
+        Cache a piece of static API data.
+        key: name of the data, e.g. 'lines' or 'path/A15/A01'.
+        value: the decoded API response.
+        version: format version of the cached data.
+        fetched: datetime the data was retrieved from the API.
+        '''
+        self.createMetadataTable()
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO Metadata VALUES (?, ?, ?, ?)",
+                            (key, version, fetched, json.dumps(value)))
+    
+    def loadMetadata(self):
+        '''
+        Load all the cached static API data.
+        Returns a dictionary of (version, fetched, value) tuples, keyed by key.
+        '''
+        self.createMetadataTable()
+        metadata = {}
+        for key, version, fetched, value in self.db.execute("SELECT * FROM Metadata"):
+            metadata[key] = (version, fetched, json.loads(value))
+        return metadata
+    
+    def saveIntervalStats(self, statsList):
+        '''
+        Write updated running interval statistics to the database.
+        statsList: list of (LineCode, Direction, StationCode, Slot, Count, Mean, M2, Ewma) tuples.
+        '''
+        self.createIntervalStatsTable()
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO IntervalStats VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                statsList)
+    
+    def loadIntervalStats(self):
+        '''
+        Load all the saved running interval statistics, as tuples of 
+        (LineCode, Direction, StationCode, Slot, Count, Mean, M2, Ewma).
+        '''
+        self.createIntervalStatsTable()
+        return self.db.execute("SELECT * FROM IntervalStats").fetchall()
+    
     def loadIntervals(self):
         '''
-        Import the interval timing between stations from the database.
-        At the moment, take a simple average.
+        Import the interval timing between stations from the database: the
+        running mean over all times (see intervalModel.py for estimates by 
+        time of week).
         
-        Returns a dictionary keyed by a tuple of (LineCode, Reverse)
+        Returns a dictionary of mean interval times, keyed by a tuple of 
+        (LineCode, Direction, StationCode).
         '''
-        cursor = self.db.cursor()
-        cursor.execute("""SELECT LineCode, Direction, StationCode, AVG(EstInterval)
-                                        FROM IntervalTimes
-                                        GROUP BY LineCode, Direction, StationCode
-                                        """)
-        intervalResults = cursor.fetchall()
-        results = defaultdict(list)
-        for result in intervalResults:
-            if result[1]==0: reverse = False
-            else: reverse = True
-            results[(result[0], reverse, result[2])].append(result[3])
-        return results
-        
+        self.createIntervalStatsTable()
+        cursor = self.db.execute("""SELECT LineCode, Direction, StationCode, Mean
+                                    FROM IntervalStats WHERE Slot = ?""", (ALL_DAY,))
+        return dict(((lineCode, direction, stationCode), mean) 
+                    for lineCode, direction, stationCode, mean in cursor)
+    
+    def iterIntervalTimes(self, afterRowId=0):
+        '''
+        Stream the IntervalTimes rows saved after the row with the given 
+        rowid, in the order they were saved, as (rowid, EntryTime, LineCode,
+        Direction, StationCode, EstInterval) tuples.
+        '''
+        cursor = self.db.execute("""SELECT rowid, EntryTime, LineCode, Direction, StationCode, 
+                                    EstInterval FROM IntervalTimes WHERE rowid > ? 
+                                    ORDER BY rowid""", (afterRowId,))
+        for row in cursor:
+            yield row
+    
+    def saveAggregates(self, trainCounts=(), headways=(), intervals=()):
+        '''
+        Add one snapshot's increments to the aggregate tables, in a single
+        transaction. The arguments are lists of rows as returned by
+        aggregates.trainCountRows, headwayRows and intervalRows.
+        '''
+        self.createAggregateTables()
+        with self.db:
+            cursor = self.db.cursor()
+            cursor.executemany("INSERT OR IGNORE INTO TrainCounts VALUES (?, ?, ?, 0, 0, 0)",
+                               [row[:3] for row in trainCounts])
+            cursor.executemany("""UPDATE TrainCounts SET Snapshots = Snapshots + ?, 
+                                    TrainTotal = TrainTotal + ?, MaxTrains = MAX(MaxTrains, ?)
+                                    WHERE Bucket = ? AND LineCode = ? AND Direction = ?""",
+                               [row[3:] + row[:3] for row in trainCounts])
+            cursor.executemany("INSERT OR IGNORE INTO Headways VALUES (?, ?, ?, ?, 0, 0, ?, ?)",
+                               [row[:4] + row[6:] for row in headways])
+            cursor.executemany("""UPDATE Headways SET Count = Count + ?, Total = Total + ?,
+                                    MinHeadway = MIN(MinHeadway, ?), MaxHeadway = MAX(MaxHeadway, ?)
+                                    WHERE Bucket = ? AND LineCode = ? AND Direction = ? 
+                                    AND StationCode = ?""",
+                               [row[4:] + row[:4] for row in headways])
+            cursor.executemany("INSERT OR IGNORE INTO IntervalAverages VALUES (?, ?, ?, ?, 0, 0)",
+                               [row[:4] for row in intervals])
+            cursor.executemany("""UPDATE IntervalAverages SET Count = Count + ?, Total = Total + ?
+                                    WHERE Bucket = ? AND LineCode = ? AND Direction = ? 
+                                    AND StationCode = ?""",
+                               [row[4:] + row[:4] for row in intervals])
+    
+    def deleteAggregates(self, startTime=None, endTime=None):
+        '''
+        Delete the aggregates of the buckets from startTime to endTime (inclusive;
+        both given as bucket start times), e.g. before recomputing them.
+        '''
+        self.createAggregateTables()
+        with self.db:
+            for table in ["TrainCounts", "Headways", "IntervalAverages"]:
+                query, params = self._bucketRange("DELETE FROM " + table, startTime, endTime)
+                self.db.execute(query, params)
+    
+    def loadTrainCounts(self, startTime=None, endTime=None, lineCode=None, direction=None):
+        '''
+        Return the train counts of each bucket from startTime to endTime, in
+        time order, as dictionaries with keys Bucket, LineCode, Direction, 
+        Snapshots, MeanTrains and MaxTrains.
+        '''
+        return self._loadAggregates("""SELECT Bucket, LineCode, Direction, Snapshots,
+                                        1.0 * TrainTotal / Snapshots, MaxTrains FROM TrainCounts""",
+                                    ["Bucket", "LineCode", "Direction", "Snapshots", 
+                                     "MeanTrains", "MaxTrains"],
+                                    startTime, endTime, lineCode, direction)
+    
+    def loadHeadways(self, startTime=None, endTime=None, lineCode=None, direction=None, 
+                     stationCode=None):
+        '''
+        Return the headways at each station in each bucket from startTime to 
+        endTime, in time order, as dictionaries with keys Bucket, LineCode, 
+        Direction, StationCode, Count, MeanHeadway, MinHeadway and MaxHeadway.
+        '''
+        return self._loadAggregates("""SELECT Bucket, LineCode, Direction, StationCode, Count,
+                                        Total / Count, MinHeadway, MaxHeadway FROM Headways""",
+                                    ["Bucket", "LineCode", "Direction", "StationCode", "Count",
+                                     "MeanHeadway", "MinHeadway", "MaxHeadway"],
+                                    startTime, endTime, lineCode, direction, stationCode)
+    
+    def loadIntervalAverages(self, startTime=None, endTime=None, lineCode=None, direction=None,
+                             stationCode=None):
+        '''
+        Return the average observed interval time to each station in each 
+        bucket from startTime to endTime, in time order, as dictionaries with
+        keys Bucket, LineCode, Direction, StationCode, Count and MeanInterval.
+        '''
+        return self._loadAggregates("""SELECT Bucket, LineCode, Direction, StationCode, Count,
+                                        Total / Count FROM IntervalAverages""",
+                                    ["Bucket", "LineCode", "Direction", "StationCode", "Count",
+                                     "MeanInterval"],
+                                    startTime, endTime, lineCode, direction, stationCode)
+    
+    def _loadAggregates(self, query, keys, startTime, endTime, lineCode=None, direction=None,
+                        stationCode=None):
+        self.createAggregateTables()
+        query, params = self._bucketRange(query, startTime, endTime, lineCode, 
+                                          None if direction is None else int(direction), 
+                                          stationCode)
+        cursor = self.db.execute(query + " ORDER BY Bucket", params)
+        return [dict(zip(keys, row)) for row in cursor]
+    
+    def _bucketRange(self, query, startTime, endTime, lineCode=None, direction=None, 
+                     stationCode=None):
+        '''
+        Add the WHERE clause selecting a range of buckets (and optionally, a 
+        line, direction and station) to a query on an aggregate table.
+        Returns the new query and its parameter list.
+        '''
+        conditions = []
+        params = []
+        for condition, value in [("Bucket >= ?", startTime), ("Bucket <= ?", endTime),
+                                 ("LineCode = ?", lineCode), ("Direction = ?", direction),
+                                 ("StationCode = ?", stationCode)]:
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return query, params
+    
     def saveSchedule(self, schedule, currentTime):
         '''
         Save a given schedule list to the database.
+        
+        The rows are buffered until bufferPolls schedules have been saved,
+        and then all written together; call flush() to write them sooner.
         '''
-        cursor = self.db.cursor()
+        self._pendingPolls.append((currentTime, self._scheduleRows(schedule)))
+        if len(self._pendingPolls) >= self.bufferPolls:
+            self.flush()
+    
+    def flush(self):
+        '''
+        Write any buffered schedules to the database in a single transaction.
+        '''
+        if not self._pendingPolls and not self._pendingCodes: return
+        if self.keyframeInterval > 1 and not self._deltaTablesReady:
+            self.createScheduleTables()
+            self._deltaTablesReady = True
+        try:
+            with self.db:
+                cursor = self.db.cursor()
+                for query, row in self._pendingCodes:
+                    cursor.execute(query, row)
+                rows = []
+                deltaRows = []
+                for currentTime, pollRows in self._pendingPolls:
+                    if self.keyframeInterval > 1:
+                        deltas = self._encodeDelta(pollRows)
+                    else:
+                        deltas = None
+                    if deltas is None:
+                        cursor.execute("INSERT INTO Snapshots (EntryTime) VALUES (?)", (currentTime,))
+                        snapshotId = cursor.lastrowid
+                        rows += [(snapshotId, ordinal) + row for ordinal, row in enumerate(pollRows)]
+                    else:
+                        cursor.execute("INSERT INTO Snapshots (EntryTime, Keyframe) VALUES (?, 0)",
+                                       (currentTime,))
+                        snapshotId = cursor.lastrowid
+                        deltaRows += [(snapshotId, ordinal) + row for ordinal, row in enumerate(deltas)]
+                cursor.executemany("INSERT INTO Arrivals VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                cursor.executemany("INSERT INTO ArrivalDeltas VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   deltaRows)
+        except sqlite3.Error:
+            self._deltaState = None # Start again from a keyframe.
+            raise
+        self._pendingCodes = []
+        self._pendingPolls = []
+    
+    def _encodeDelta(self, pollRows):
+        '''
+        Compare a poll's Arrivals rows to the last poll written.
+        Returns None if the poll should be written as a keyframe, or else
+        the list of changed entries, as ArrivalDeltas rows (without the 
+        SnapshotId and Ordinal).
+        '''
+        state = _keyRows(pollRows)
+        previous = self._deltaState
+        self._deltaState = state
+        if previous is None or self._sinceKeyframe >= self.keyframeInterval - 1:
+            self._sinceKeyframe = 0
+            return None
+        self._sinceKeyframe += 1
+        deltas = [key + value for key, value in state.iteritems() if previous.get(key) != value]
+        deltas += [key + (None, TOMBSTONE, None) for key in previous if key not in state]
+        return deltas
+    
+    def close(self):
+        '''
+        Write any buffered schedules and close the database connection.
+        '''
+        self.flush()
+        self.db.close()
+    
+    def _scheduleRows(self, schedule):
+        '''
+        Convert a list of PID entries into Arrivals row tuples (without
+        the SnapshotId and Ordinal), without modifying the entries.
+        '''
+        self._loadCodes()
+        rows = []
         for entry in schedule:
-            entry['CurrentTime'] = currentTime
-            cursor.execute('''
-                INSERT INTO ArrivalTimes 
-                VALUES (
-                :CurrentTime,
-                :Group,
-                :Min,
-                :DestinationCode,
-                :Car,
-                :Destination,
-                :DestinationName,
-                :LocationName,
-                :Line,
-                :LocationCode
-            )''', entry)
-        self.db.commit()
+            minutes, state = parseMinutes(entry['Min'])
+            rows.append((self._locationId(entry['LocationCode'], entry['LocationName']),
+                         self._destinationId(entry['DestinationCode'], entry['Destination'],
+                                             entry['DestinationName']),
+                         self._lineId(entry['Line']),
+                         _toInt(entry['Group']), minutes, state, _toInt(entry['Car'])))
+        return rows
     
     def loadSchedule(self, targetTime):
         '''
-        Loads a schedule saved with the targetTime Timestamp.
+        Loads a schedule saved with the targetTime Timestamp (to the second).
+        
+        The 'Min' field of each entry is an integer (0 for arriving and 
+        boarding trains, None for unknown entries); the 'ArrivalState' field
+        holds the arrival state code. Schedules in the archive are read from
+        it, and the rest from the database.
         '''
-        KEYS = ["CurrentTime", "Group", "Min", "DestinationCode", "Car", "Destination",\
-                "DestinationName", "LocationName", "Line", "LocationCode"]
+        second = asDatetime(targetTime).replace(microsecond=0)
+        start = second
         allArrivals = []
-        arrivalResults = self.db.execute("""SELECT * FROM ArrivalTimes 
-                                        WHERE DATETIME(EntryTime) = DATETIME(?)""",\
-                                        (targetTime,)).fetchall()
-        for arrivalTuple in arrivalResults:
-            newArrival = {}
-            for index in range(len(KEYS)):
-                newArrival[KEYS[index]] = arrivalTuple[index]
-            allArrivals.append(newArrival)
-        
-        return allArrivals
\ No newline at end of file
+        if self.archive is not None:
+            allArrivals = self.archive.loadSchedule(second)
+            start = self._liveStart(second)
+        self.flush()
+        self._loadCodes()
+        # Every schedule saved within the same second, as a range of the EntryTime index:
+        snapshotIds = [row[0] for row in self.db.execute("""SELECT SnapshotId FROM Snapshots
+                                        WHERE EntryTime >= ? AND EntryTime < ?
+                                        ORDER BY SnapshotId""",
+                                        (str(start), str(second + timedelta(seconds=1))))]
+        if self._hasDeltas():
+            for snapshotId in snapshotIds:
+                firstId = self._keyframeBefore(snapshotId)
+                for reconstructedId, rows in self._iterReconstructed(firstId, snapshotId):
+                    pass # Only the last one is wanted.
+                allArrivals += [self._rowToArrival(row) for row in rows]
+            return allArrivals
+        for snapshotId in snapshotIds:
+            arrivalResults = self.db.execute("""SELECT s.EntryTime, a.LocationId, a.DestinationId,
+                                        a.LineId, a.TrainGroup, a.Minutes, a.ArrivalState, a.Car
+                                        FROM Snapshots s JOIN Arrivals a ON a.SnapshotId = s.SnapshotId
+                                        WHERE s.SnapshotId = ?""", (snapshotId,))
+            allArrivals += [self._rowToArrival(arrivalTuple) for arrivalTuple in arrivalResults]
+        return allArrivals
+    
+    def loadTimestamps(self, startTime=None, endTime=None):
+        '''
+        Return the sorted list of distinct EntryTimes with saved schedules.
+        '''
+        timestamps = []
+        if self.archive is not None:
+            timestamps = self.archive.loadTimestamps(startTime, endTime)
+            startTime = self._liveStart(startTime)
+        self.flush()
+        query, params = self._timeRange("SELECT DISTINCT EntryTime FROM Snapshots s",
+                                        startTime, endTime)
+        cursor = self.db.cursor()
+        cursor.execute(query + " ORDER BY EntryTime", params)
+        return timestamps + [row[0] for row in cursor]
+    
+    def iterSchedules(self, startTime=None, endTime=None, locationCodes=None):
+        '''
+        Stream every saved schedule in EntryTime order, using a single cursor.
+        
+        Yields (EntryTime, schedule) tuples, where schedule is a list of PID
+        entries as returned by loadSchedule.
+        startTime, endTime: optional inclusive bounds on the EntryTime.
+        locationCodes: optionally, only load the entries for these stations.
+            Timestamps with no matching entries are not yielded.
+        '''
+        if self.archive is not None:
+            for timecode, schedule in self.archive.iterSchedules(startTime, endTime, locationCodes):
+                yield timecode, schedule
+            startTime = self._liveStart(startTime)
+        for timecode, rows in self._iterSnapshotRows(startTime, endTime, locationCodes):
+            yield timecode, [self._rowToArrival(row) for row in rows]
+    
+    def iterSnapshots(self, startTime=None, endTime=None, locationCodes=None):
+        '''
+        Stream every saved schedule in EntryTime order, as ScheduleSnapshots.
+        
+        Yields (EntryTime, ScheduleSnapshot) tuples. 
+        Arguments are the same as for iterSchedules.
+        '''
+        if self.archive is not None:
+            for timecode, snapshot in self.archive.iterSnapshots(startTime, endTime, locationCodes):
+                yield timecode, snapshot
+            startTime = self._liveStart(startTime)
+        for timecode, rows in self._iterSnapshotRows(startTime, endTime, locationCodes):
+            yield timecode, self._rowsToSnapshot(timecode, rows)
+    
+    def iterPredictions(self, stationCode, startTime=None, endTime=None):
+        '''
+        Stream the PID entries listed at one station from startTime to endTime
+        (inclusive), in time order, as returned by loadSchedule.
+        
+        The schedules in the range are found through the Snapshots_EntryTime
+        index, and the station's entries in each through the Arrivals_Location
+        index, if it has been created (see createQueryIndexes).
+        '''
+        for timecode, schedule in self.iterSchedules(startTime, endTime, [stationCode]):
+            for entry in schedule:
+                yield entry
+    
+    def _liveStart(self, startTime):
+        '''
+        Return the start of the range to read from the database, skipping
+        anything up to the end of the archive.
+        '''
+        archiveEnd = self.archive.endTime
+        if archiveEnd is None: return startTime
+        liveStart = archiveEnd + timedelta(microseconds=1)
+        if startTime is not None and asDatetime(startTime) > liveStart:
+            return startTime
+        return liveStart
+    
+    def deleteSchedules(self, startTime=None, endTime=None):
+        '''
+        Delete the schedules stored in the database between startTime and
+        endTime, for instance once they have been archived. If the first 
+        schedule left after them is delta-encoded, it is made a keyframe.
+        
+        Returns the number of schedules deleted.
+        '''
+        self.flush()
+        query, params = self._timeRange("SELECT MIN(SnapshotId), MAX(SnapshotId) FROM Snapshots s",
+                                        startTime, endTime)
+        firstId, lastId = self.db.execute(query, params).fetchone()
+        if firstId is None: return 0
+        hasDeltas = self._hasDeltas()
+        with self.db:
+            if hasDeltas:
+                following = self.db.execute("""SELECT SnapshotId, Keyframe FROM Snapshots 
+                                                WHERE SnapshotId > ? ORDER BY SnapshotId LIMIT 1""",
+                                            (lastId,)).fetchone()
+                if following is not None and not following[1]:
+                    self._makeKeyframe(following[0])
+                self.db.execute("DELETE FROM ArrivalDeltas WHERE SnapshotId BETWEEN ? AND ?",
+                                (firstId, lastId))
+            self.db.execute("DELETE FROM Arrivals WHERE SnapshotId BETWEEN ? AND ?", 
+                            (firstId, lastId))
+            deleted = self.db.execute("DELETE FROM Snapshots WHERE SnapshotId BETWEEN ? AND ?",
+                                      (firstId, lastId)).rowcount
+        return deleted
+    
+    def _makeKeyframe(self, snapshotId):
+        '''
+        Save a delta-encoded schedule in full, as a keyframe.
+        '''
+        self._loadCodes()
+        for reconstructedId, rows in self._iterReconstructed(self._keyframeBefore(snapshotId), 
+                                                             snapshotId):
+            pass # Only the last one is wanted.
+        self.db.executemany("INSERT INTO Arrivals VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            [(snapshotId, ordinal) + row[1:] for ordinal, row in enumerate(rows)])
+        self.db.execute("DELETE FROM ArrivalDeltas WHERE SnapshotId = ?", (snapshotId,))
+        self.db.execute("UPDATE Snapshots SET Keyframe = 1 WHERE SnapshotId = ?", (snapshotId,))
+    
+    def _rowsToSnapshot(self, timecode, rows):
+        '''
+        Build a ScheduleSnapshot directly from the encoded Arrivals rows.
+        '''
+        stationCodes, destinationIndex = self._stationCodes()
+        entryTimes, locationIds, destinationIds, lineIds, groups, minutes, states, cars = zip(*rows)
+        location = np.array(locationIds, dtype=np.int16) - 1
+        destination = destinationIndex[np.array(destinationIds, dtype=np.int32)]
+        minutes = [-1 if entryMinutes is None else entryMinutes for entryMinutes in minutes]
+        return ScheduleSnapshot(stationCodes, location, destination, minutes, timecode)
+    
+    def _stationCodes(self):
+        '''
+        Return the station code list used by the ScheduleSnapshots, where 
+        index LocationId - 1 is the LocationCode, followed by any destination
+        codes that are never a location, and an array mapping DestinationIds
+        to indexes in that list.
+        '''
+        sizes = (len(self.locations), len(self.destinations))
+        if self._snapshotCodes is None or self._snapshotCodes[0] != sizes:
+            stationCodes = [self.locations[i][0] for i in range(1, len(self.locations) + 1)]
+            stationIndex = dict((code, i) for i, code in enumerate(stationCodes))
+            destinationIndex = np.empty(len(self.destinations) + 1, dtype=np.int16)
+            destinationIndex.fill(-1)
+            for destinationId, destination in self.destinations.items():
+                code = destination[0]
+                if code is None: continue
+                if code not in stationIndex:
+                    stationIndex[code] = len(stationCodes)
+                    stationCodes.append(code)
+                destinationIndex[destinationId] = stationIndex[code]
+            self._snapshotCodes = (sizes, stationCodes, destinationIndex)
+        return self._snapshotCodes[1], self._snapshotCodes[2]
+    
+    def _iterSnapshotRows(self, startTime=None, endTime=None, locationCodes=None):
+        '''
+        Stream the raw Arrivals rows of each saved schedule in EntryTime order.
+        
+        Yields (EntryTime, rows) tuples, where each row is a tuple of
+        (EntryTime, LocationId, DestinationId, LineId, TrainGroup, Minutes, 
+        ArrivalState, Car).
+        '''
+        self.flush()
+        self._loadCodes()
+        query = """SELECT s.SnapshotId, s.EntryTime, a.LocationId, a.DestinationId, a.LineId,
+                        a.TrainGroup, a.Minutes, a.ArrivalState, a.Car
+                    FROM Snapshots s JOIN Arrivals a ON a.SnapshotId = s.SnapshotId"""
+        locationIds = None
+        if locationCodes is not None:
+            locationIds = [self.locationIds[code] for code in locationCodes 
+                           if code in self.locationIds]
+        if self._hasDeltas():
+            for timecode, rows in self._iterDeltaRange(startTime, endTime, locationIds):
+                yield timecode, rows
+            return
+        query, params = self._timeRange(query, startTime, endTime, locationIds)
+        cursor = self.db.cursor()
+        cursor.execute(query + " ORDER BY s.EntryTime, s.SnapshotId, a.Ordinal", params)
+        for snapshotId, rows in groupby(cursor, key=lambda row: row[0]):
+            rows = [row[1:] for row in rows]
+            yield rows[0][0], rows
+    
+    def _hasDeltas(self):
+        '''
+        True if any of the saved schedules are delta-encoded.
+        '''
+        table = self.db.execute("""SELECT name FROM sqlite_master 
+                                    WHERE type = 'table' AND name = 'ArrivalDeltas'""").fetchone()
+        if table is None: return False
+        return self.db.execute("SELECT 1 FROM ArrivalDeltas LIMIT 1").fetchone() is not None
+    
+    def _keyframeBefore(self, snapshotId):
+        '''
+        Return the SnapshotId of the last keyframe at or before snapshotId.
+        '''
+        return self.db.execute("""SELECT MAX(SnapshotId) FROM Snapshots 
+                                    WHERE Keyframe = 1 AND SnapshotId <= ?""", 
+                               (snapshotId,)).fetchone()[0]
+    
+    def _iterDeltaRange(self, startTime=None, endTime=None, locationIds=None):
+        '''
+        As _iterSnapshotRows, for databases with delta-encoded schedules: 
+        reconstruct the schedules from the keyframe before startTime on, in
+        SnapshotId order, and yield those in the time range.
+        '''
+        query, params = self._timeRange("SELECT MIN(SnapshotId), MAX(SnapshotId) FROM Snapshots s",
+                                        startTime, endTime)
+        firstId, lastId = self.db.execute(query, params).fetchone()
+        if firstId is None: return
+        for snapshotId, rows in self._iterReconstructed(self._keyframeBefore(firstId), lastId,
+                                                        locationIds):
+            if snapshotId >= firstId and rows:
+                yield rows[0][0], rows
+    
+    def _iterReconstructed(self, firstId, lastId, locationIds=None):
+        '''
+        Reconstruct the schedules with SnapshotIds from firstId (which must be
+        a keyframe) to lastId, optionally only at the given LocationIds.
+        
+        Yields (SnapshotId, rows) tuples for every snapshot, where rows is a 
+        list of (EntryTime, LocationId, DestinationId, LineId, TrainGroup, 
+        Minutes, ArrivalState, Car) tuples, as in _iterSnapshotRows.
+        '''
+        snapshots = self.db.execute("""SELECT SnapshotId, EntryTime, Keyframe FROM Snapshots
+                                        WHERE SnapshotId BETWEEN ? AND ? ORDER BY SnapshotId""",
+                                    (firstId, lastId))
+        locationFilter = ""
+        params = [firstId, lastId]
+        if locationIds is not None:
+            locationFilter = " AND LocationId IN (" + ", ".join("?" * len(locationIds)) + ")"
+            params += locationIds
+        rowCursor = self.db.execute("""SELECT SnapshotId, Ordinal, LocationId, DestinationId, 
+                                        LineId, TrainGroup, NULL, Minutes, ArrivalState, Car
+                                        FROM Arrivals WHERE SnapshotId BETWEEN ? AND ?""" 
+                                    + locationFilter + """
+                                    UNION ALL 
+                                    SELECT SnapshotId, Ordinal, LocationId, DestinationId, 
+                                        LineId, TrainGroup, Rank, Minutes, ArrivalState, Car
+                                        FROM ArrivalDeltas WHERE SnapshotId BETWEEN ? AND ?"""
+                                    + locationFilter + " ORDER BY 1, 2", params * 2)
+        rowGroups = groupby(rowCursor, key=lambda row: row[0])
+        nextGroup = next(rowGroups, (None, None))
+        state = OrderedDict()
+        for snapshotId, entryTime, keyframe in snapshots:
+            changes = []
+            if nextGroup[0] == snapshotId:
+                changes = list(nextGroup[1])
+                nextGroup = next(rowGroups, (None, None))
+            if keyframe:
+                state = _keyRows(row[2:6] + row[7:] for row in changes)
+            else:
+                for row in changes:
+                    key = row[2:7]
+                    if row[8] == TOMBSTONE:
+                        state.pop(key, None)
+                    else:
+                        state[key] = row[7:]
+            yield snapshotId, [(entryTime,) + key[:4] + value for key, value in state.iteritems()]
+    
+    def _timeRange(self, query, startTime, endTime, locationIds=None):
+        '''
+        Add the WHERE clause for an EntryTime range (and station list) to query,
+        which must name the Snapshots table s (and the Arrivals table a).
+        Returns the new query and its parameter list.
+        '''
+        conditions = []
+        params = []
+        if startTime is not None:
+            conditions.append("s.EntryTime >= ?")
+            params.append(startTime)
+        if endTime is not None:
+            conditions.append("s.EntryTime <= ?")
+            params.append(endTime)
+        if locationIds is not None:
+            conditions.append("a.LocationId IN (" + ", ".join("?" * len(locationIds)) + ")")
+            params += locationIds
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return query, params
+    
+    def _rowToArrival(self, arrivalTuple):
+        '''
+        Convert a decoded Arrivals row into a PID entry dictionary.
+        '''
+        entryTime, locationId, destinationId, lineId, group, minutes, state, car = arrivalTuple
+        locationCode, locationName = self.locations[locationId]
+        destinationCode, destination, destinationName = self.destinations[destinationId]
+        return {"CurrentTime": entryTime,
+                "Group": _toText(group),
+                "Min": minutes,
+                "ArrivalState": state,
+                "DestinationCode": destinationCode,
+                "Car": _toText(car),
+                "Destination": destination,
+                "DestinationName": destinationName,
+                "LocationName": locationName,
+                "Line": self.lines[lineId],
+                "LocationCode": locationCode}
+    
+    """
+    DICTIONARY ENCODING
+    """
+    
+    def _loadCodes(self):
+        '''
+        Load the dictionary tables into memory, if they haven't been already.
+        '''
+        if self._codesLoaded: return
+        for locationId, code, name in self.db.execute("SELECT * FROM Locations"):
+            self.locations[locationId] = (code, name)
+            self.locationIds[code] = locationId
+        for destinationId, code, destination, name in self.db.execute("SELECT * FROM Destinations"):
+            self.destinations[destinationId] = (code, destination, name)
+            self.destinationIds[(code, destination, name)] = destinationId
+        for lineId, line in self.db.execute("SELECT * FROM Lines"):
+            self.lines[lineId] = line
+            self.lineIds[line] = lineId
+        self._codesLoaded = True
+    
+    def _locationId(self, code, name):
+        if code not in self.locationIds:
+            newId = len(self.locations) + 1
+            self.locations[newId] = (code, name)
+            self.locationIds[code] = newId
+            self._pendingCodes.append(("INSERT INTO Locations VALUES (?, ?, ?)", 
+                                       (newId, code, name)))
+        return self.locationIds[code]
+    
+    def _destinationId(self, code, destination, name):
+        key = (code, destination, name)
+        if key not in self.destinationIds:
+            newId = len(self.destinations) + 1
+            self.destinations[newId] = key
+            self.destinationIds[key] = newId
+            self._pendingCodes.append(("INSERT INTO Destinations VALUES (?, ?, ?, ?)", 
+                                       (newId,) + key))
+        return self.destinationIds[key]
+    
+    def _lineId(self, line):
+        if line not in self.lineIds:
+            newId = len(self.lines) + 1
+            self.lines[newId] = line
+            self.lineIds[line] = newId
+            self._pendingCodes.append(("INSERT INTO Lines VALUES (?, ?)", (newId, line)))
+        return self.lineIds[line]
+    
+    """
+    MIGRATION
+    """
+    
+    def migrateArrivalTimes(self, dropLegacy=False, batchPolls=100):
+        '''
+        Copy the PID entries of the legacy ArrivalTimes table (all TEXT 
+        columns, one row per entry) into the compact schedule tables.
+        
+        dropLegacy: if True, drop the ArrivalTimes table and reclaim its space.
+        batchPolls: number of schedules to write per transaction.
+        
+        Returns the number of schedules migrated.
+        '''
+        self.createScheduleTables()
+        self.flush()
+        bufferPolls = self.bufferPolls
+        self.bufferPolls = batchPolls
+        
+        count = 0
+        cursor = self.db.cursor()
+        cursor.execute("SELECT * FROM ArrivalTimes ORDER BY EntryTime")
+        for timecode, rows in groupby(cursor, key=lambda row: row[0]):
+            schedule = [dict(zip(SCHEDULE_KEYS, row)) for row in rows]
+            self.saveSchedule(schedule, timecode)
+            count += 1
+        self.flush()
+        self.bufferPolls = bufferPolls
+        
+        if dropLegacy:
+            self.db.execute("DROP TABLE ArrivalTimes")
+            self.db.commit()
+            self.db.execute("VACUUM")
+        return count
+
+
+def _keyRows(rows):
+    '''
+    Key a poll's Arrivals rows (LocationId, DestinationId, LineId, TrainGroup,
+    Minutes, ArrivalState, Car) by their board and rank within the board.
+    Returns an OrderedDict of (Minutes, ArrivalState, Car) tuples, keyed by
+    (LocationId, DestinationId, LineId, TrainGroup, Rank).
+    '''
+    ranks = defaultdict(int)
+    state = OrderedDict()
+    for row in rows:
+        board = tuple(row[:4])
+        state[board + (ranks[board],)] = tuple(row[4:])
+        ranks[board] += 1
+    return state
+
+def _toInt(value):
+    '''
+    Convert a numeric PID field (such as Car or Group) to an integer, or None.
+    '''
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _toText(value):
+    if value is None: return None
+    return unicode(value)
+
+
+if __name__ == '__main__':
+    # Usage: python WMATADatabase.py path/to/database [--drop-legacy] [--keyframe-interval N]
+    keyframeInterval = 1
+    if '--keyframe-interval' in sys.argv:
+        keyframeInterval = int(sys.argv[sys.argv.index('--keyframe-interval') + 1])
+    database = WMATADatabase(None, sys.argv[1], keyframeInterval=keyframeInterval)
+    migrated = database.migrateArrivalTimes(dropLegacy='--drop-legacy' in sys.argv)
+    print "Migrated %i schedules." % migrated
+    database.close()
@@ -0,0 +1,102 @@
+'''
+Created on Feb 12, 2012
+
+@author: dmasad
+
+Range queries over a WMATA database, for analysis.
+
+WMATAQueries answers the common questions about the stored data, such as
+the predictions listed at a station between two times, or the interval
+times on a line by hour of the week, without scanning the raw tables.
+Each query is backed by a covering index (see
+WMATADatabase.createQueryIndexes), so it reads only the index entries in
+its range. The queries are parameterized, with a fixed SQL text for each
+combination of filters, so sqlite3 reuses the prepared statements from
+its cache. The results are generators over the open cursor, so long
+ranges can be streamed in constant memory.
+
+Usage:
+    queries = WMATAQueries(manager.db)
+    for entry in queries.predictions('C05', startTime, endTime):
+        ...
+'''
+
+from WMATADatabase import WMATADatabase
+
+HOUR_OF_WEEK = """((CAST(STRFTIME('%w', EntryTime) AS INTEGER) + 6) % 7) * 24
+                    + CAST(STRFTIME('%H', EntryTime) AS INTEGER)""" # Monday 00:00 is hour 0.
+
+class WMATAQueries(object):
+    '''
+    Range queries over a WMATADatabase.
+    '''
+
+    def __init__(self, database):
+        '''
+        database: a WMATADatabase, or the path to a database file.
+        Creates the query indexes, if they don't exist yet.
+        '''
+        if not isinstance(database, WMATADatabase):
+            database = WMATADatabase(None, database)
+        self.database = database
+        self.db = database.db # The sqlite3 connection.
+        database.createQueryIndexes()
+
+    def predictions(self, stationCode, startTime=None, endTime=None, destinationCode=None):
+        '''
+        Yield the PID entries listed at a station from startTime to endTime
+        (inclusive), in time order, as dictionaries in the form returned by
+        WMATADatabase.loadSchedule (including the CurrentTime).
+
+        destinationCode: optionally, only the entries for trains to this destination.
+        '''
+        for entry in self.database.iterPredictions(stationCode, startTime, endTime):
+            if destinationCode is None or entry['DestinationCode'] == destinationCode:
+                yield entry
+
+    def intervals(self, lineCode, direction, stationCode=None, startTime=None, endTime=None):
+        '''
+        Yield the interval times observed on a line, in one direction (and
+        optionally, to one station), from startTime to endTime (inclusive),
+        as IntervalTimes rows of (EntryTime, LineCode, Direction, StationCode,
+        EstInterval), in station and time order.
+        '''
+        query, params = self._intervalRange("""SELECT EntryTime, LineCode, Direction, StationCode,
+                                                EstInterval FROM IntervalTimes""",
+                                            lineCode, direction, stationCode, startTime, endTime)
+        return iter(self.db.execute(query + " ORDER BY StationCode, EntryTime", params))
+
+    def intervalsByHourOfWeek(self, lineCode, direction, stationCode=None, startTime=None,
+                              endTime=None):
+        '''
+        Yield the interval times observed on a line, in one direction (and
+        optionally, to one station), from startTime to endTime, by station
+        and hour of the week (0 to 167, from Monday 00:00), as dictionaries
+        with keys StationCode, HourOfWeek, Count, MeanInterval, MinInterval
+        and MaxInterval.
+        '''
+        query, params = self._intervalRange("SELECT StationCode, " + HOUR_OF_WEEK + """ AS Hour,
+                                                COUNT(*), AVG(EstInterval), MIN(EstInterval),
+                                                MAX(EstInterval) FROM IntervalTimes""",
+                                            lineCode, direction, stationCode, startTime, endTime)
+        keys = ["StationCode", "HourOfWeek", "Count", "MeanInterval", "MinInterval",
+                "MaxInterval"]
+        cursor = self.db.execute(query + " GROUP BY StationCode, Hour ORDER BY StationCode, Hour",
+                                 params)
+        for row in cursor:
+            yield dict(zip(keys, row))
+
+    def _intervalRange(self, query, lineCode, direction, stationCode, startTime, endTime):
+        '''
+        Add the WHERE clause selecting a line and direction (and optionally, a
+        station and EntryTime range) to a query on the IntervalTimes table.
+        Returns the new query and its parameter list.
+        '''
+        conditions = ["LineCode = ?", "Direction = ?"]
+        params = [lineCode, int(direction)]
+        for condition, value in [("StationCode = ?", stationCode), ("EntryTime >= ?", startTime),
+                                 ("EntryTime <= ?", endTime)]:
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        return query + " WHERE " + " AND ".join(conditions), params
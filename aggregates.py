@@ -0,0 +1,80 @@
+'''
+Created on Feb 8, 2012
+
+@author: dmasad
+
+Time-bucketed aggregates of each snapshot, for the materialized
+TrainCounts, Headways and IntervalAverages tables.
+
+Each function returns the increments one snapshot adds to a table, as
+rows keyed by the snapshot's time bucket (the start of its BUCKET_MINUTES
+period), line and direction (and station); WMATADatabase.saveAggregates
+adds them to the stored totals.
+
+Headways are measured from the boards: the gaps between the predicted
+arrivals of successive trains at each station.
+
+The tables are filled in batches, not as schedules are collected: the
+collector only stores the schedules, and AnalyticManager.materializeAggregates
+replays them (e.g. once a day, for the buckets collected since the last run).
+'''
+
+from collections import defaultdict
+from datetime import timedelta
+
+from intervalStats import SLOT_MINUTES
+from utilities import asDatetime
+
+BUCKET_MINUTES = SLOT_MINUTES
+
+def timeBucket(timestamp, minutes=BUCKET_MINUTES):
+    '''
+    Return the start of the bucket holding timestamp (a datetime, or a
+    string as stored in the database).
+    '''
+    timestamp = asDatetime(timestamp)
+    minute = timestamp.minute - timestamp.minute % minutes
+    return timestamp.replace(minute=minute, second=0, microsecond=0)
+
+def bucketEnd(timestamp, minutes=BUCKET_MINUTES):
+    '''
+    Return the last moment (to the microsecond) of the bucket holding timestamp.
+    '''
+    return timeBucket(timestamp, minutes) + timedelta(minutes=minutes, microseconds=-1)
+
+def trainCountRows(railLines, bucket):
+    '''
+    Rows of (Bucket, LineCode, Direction, Snapshots, TrainTotal, MaxTrains)
+    for the trains currently on each line.
+    '''
+    return [(bucket, line.lineCode, int(line.reverse), 1, len(line.Trains), len(line.Trains))
+            for line in railLines]
+
+def headwayRows(railLines, bucket):
+    '''
+    Rows of (Bucket, LineCode, Direction, StationCode, Count, Total, MinHeadway, MaxHeadway)
+    for the gaps between the arrivals currently listed at each station.
+    Run after finding trains, which loads the arrivals.
+    '''
+    rows = []
+    for line in railLines:
+        for station in line.stationList:
+            minutes = station.minutes # Already sorted.
+            headways = [later - earlier for earlier, later in zip(minutes, minutes[1:])
+                        if later > earlier]
+            if headways:
+                rows.append((bucket, line.lineCode, int(line.reverse), station.stationCode,
+                             len(headways), sum(headways), min(headways), max(headways)))
+    return rows
+
+def intervalRows(observations):
+    '''
+    Rows of (Bucket, LineCode, Direction, StationCode, Count, Total) from a
+    list of IntervalTimes rows, as returned by RailLine.updateStationIntervals.
+    '''
+    totals = defaultdict(lambda: [0, 0.0])
+    for entryTime, lineCode, direction, stationCode, interval in observations:
+        total = totals[(timeBucket(entryTime), lineCode, direction, stationCode)]
+        total[0] += 1
+        total[1] += interval
+    return [key + tuple(total) for key, total in sorted(totals.items())]
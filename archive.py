@@ -0,0 +1,347 @@
+'''
+Created on Feb 10, 2012
+
+@author: dmasad
+
+Archive of stored schedules, partitioned by day (or week) into fixed-width
+binary files that are memory-mapped when read.
+
+Each partition is a pair of NumPy .npy files:
+    <key>.snapshots.npy: one SNAPSHOT_DTYPE record per poll, in time order:
+        its EntryTime (microseconds since 1970), and the index and number of
+        its entries in the arrivals file.
+    <key>.arrivals.npy: one ARRIVAL_DTYPE record per PID entry.
+where key is the date of the day (or of the Monday of the week). Codes are
+indexes into the code lists in the catalog, and -1 stands for None.
+
+catalog.json lists the partitions with their time ranges and sizes, along
+with the location, destination and line code lists, so only the partitions
+covering a requested range are opened.
+
+A WMATADatabase created with an archive reads from it transparently,
+followed by whatever in the live database is newer than the archive.
+'''
+
+from __future__ import division
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from ScheduleSnapshot import ScheduleSnapshot
+from utilities import asDatetime, saveArray
+from wmata import UNKNOWN
+
+CATALOG_VERSION = 1
+SNAPSHOT_DTYPE = np.dtype([('entryTime', '<i8'), ('first', '<i8'), ('count', '<i4')])
+ARRIVAL_DTYPE = np.dtype([('location', '<i2'), ('destination', '<i2'), ('line', '<i2'),
+                          ('group', '<i2'), ('minutes', '<i2'), ('state', '<i1'), ('car', '<i1')])
+EPOCH = datetime(1970, 1, 1)
+
+class SnapshotArchive(object):
+    '''
+    A directory of schedule partitions, and its catalog.
+    '''
+
+    def __init__(self, directory, period='day'):
+        '''
+        directory: the archive directory; created if it doesn't exist.
+        period: 'day' or 'week'; the partition size of a new archive.
+            An existing archive keeps the period it was created with.
+        '''
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.catalogPath = os.path.join(directory, "catalog.json")
+        if os.path.exists(self.catalogPath):
+            f = open(self.catalogPath)
+            catalog = json.load(f)
+            f.close()
+            if catalog['version'] != CATALOG_VERSION:
+                raise ValueError("Unsupported archive catalog version %s" % catalog['version'])
+        else:
+            catalog = {'version': CATALOG_VERSION, 'period': period, 'locations': [],
+                       'destinations': [], 'lines': [], 'partitions': {}}
+        self.period = catalog['period']
+        self.partitions = catalog['partitions'] # Partition info, by key.
+        self.locations = [tuple(code) for code in catalog['locations']]
+        self.destinations = [tuple(code) for code in catalog['destinations']]
+        self.lines = catalog['lines']
+        self._indexes = [dict((code, i) for i, code in enumerate(codes))
+                         for codes in (self.locations, self.destinations, self.lines)]
+        self._snapshotCodes = None
+        self._mapped = {} # Memory-mapped (snapshots, arrivals) arrays, by partition key.
+
+    """
+    WRITING
+    """
+
+    def archive(self, db, startTime=None, endTime=None):
+        '''
+        Copy the schedules stored in a WMATADatabase between startTime and
+        endTime into the archive. Schedules already in the archive with the
+        same EntryTimes are replaced.
+
+        Returns the number of schedules archived.
+        '''
+        count = 0
+        currentKey = None
+        pending = []
+        for entryTime, rows in db._iterSnapshotRows(startTime, endTime):
+            key = self.partitionKey(entryTime)
+            if key != currentKey:
+                self._writePartition(currentKey, pending)
+                currentKey = key
+                pending = []
+            pending.append((_toMicros(entryTime), self._encodeRows(db, rows)))
+            count += 1
+        self._writePartition(currentKey, pending)
+        return count
+
+    def partitionKey(self, timestamp):
+        day = asDatetime(timestamp).date()
+        if self.period == 'week':
+            day -= timedelta(days=day.weekday())
+        return day.isoformat()
+
+    def _encodeRows(self, db, rows):
+        '''
+        Convert a WMATADatabase snapshot's rows to an ARRIVAL_DTYPE array.
+        '''
+        arrivals = np.empty(len(rows), dtype=ARRIVAL_DTYPE)
+        if not rows: return arrivals
+        entryTimes, locationIds, destinationIds, lineIds, groups, minutes, states, cars = zip(*rows)
+        arrivals['location'] = self._codeMap(0, self.locations, db.locations)[list(locationIds)]
+        arrivals['destination'] = self._codeMap(1, self.destinations, 
+                                                db.destinations)[list(destinationIds)]
+        arrivals['line'] = self._codeMap(2, self.lines, db.lines)[list(lineIds)]
+        arrivals['group'] = [_orMissing(group) for group in groups]
+        arrivals['minutes'] = [_orMissing(entryMinutes) for entryMinutes in minutes]
+        arrivals['state'] = states
+        arrivals['car'] = [_orMissing(car) for car in cars]
+        return arrivals
+
+    def _codeMap(self, table, codes, dbCodes):
+        '''
+        Return an array mapping the ids of one of a database's code tables
+        (a dictionary of values by id) to indexes in the archive's code list,
+        adding any new values to the list.
+        '''
+        index = self._indexes[table]
+        codeMap = np.zeros(max(dbCodes) + 1, dtype=np.int16)
+        for dbId, value in dbCodes.items():
+            if value not in index:
+                index[value] = len(codes)
+                codes.append(value)
+                self._snapshotCodes = None
+            codeMap[dbId] = index[value]
+        return codeMap
+
+    def _writePartition(self, key, snapshots):
+        '''
+        Write a list of (EntryTime, arrivals array) tuples to a partition,
+        merged with what it already holds, and update the catalog.
+        '''
+        if not snapshots: return
+        if key in self.partitions:
+            newTimes = set(entryTime for entryTime, arrivals in snapshots)
+            oldSnapshots, oldArrivals = self._load(key, mmap=False)
+            for entryTime, first, count in oldSnapshots:
+                if entryTime not in newTimes:
+                    snapshots.append((entryTime, oldArrivals[first:first+count]))
+            snapshots.sort(key=lambda snapshot: snapshot[0])
+            self._mapped.pop(key, None)
+
+        index = np.empty(len(snapshots), dtype=SNAPSHOT_DTYPE)
+        first = 0
+        for i, (entryTime, arrivals) in enumerate(snapshots):
+            index[i] = (entryTime, first, len(arrivals))
+            first += len(arrivals)
+        arrivals = np.concatenate([arrivals for entryTime, arrivals in snapshots])
+
+        snapshotPath, arrivalPath = self._paths(key)
+        saveArray(snapshotPath, index)
+        saveArray(arrivalPath, arrivals)
+        self.partitions[key] = {'start': int(index['entryTime'][0]),
+                                'end': int(index['entryTime'][-1]),
+                                'snapshots': len(index), 'entries': len(arrivals)}
+        self._saveCatalog()
+
+    def _saveCatalog(self):
+        catalog = {'version': CATALOG_VERSION, 'period': self.period,
+                   'locations': self.locations, 'destinations': self.destinations,
+                   'lines': self.lines, 'partitions': self.partitions}
+        f = open(self.catalogPath + ".tmp", "w")
+        json.dump(catalog, f, indent=1, sort_keys=True)
+        f.close()
+        os.rename(self.catalogPath + ".tmp", self.catalogPath)
+
+    """
+    READING
+    """
+
+    @property
+    def startTime(self):
+        if not self.partitions: return None
+        return _fromMicros(min(info['start'] for info in self.partitions.values()))
+
+    @property
+    def endTime(self):
+        if not self.partitions: return None
+        return _fromMicros(max(info['end'] for info in self.partitions.values()))
+
+    def covers(self, timestamp):
+        '''
+        True if timestamp falls within the time range of one of the partitions.
+        '''
+        micros = _toMicros(timestamp)
+        return any(info['start'] <= micros <= info['end'] for info in self.partitions.values())
+
+    def loadTimestamps(self, startTime=None, endTime=None):
+        '''
+        Return the sorted list of archived EntryTimes, as datetimes.
+        '''
+        timestamps = []
+        for key, snapshots, first, last in self._ranges(startTime, endTime):
+            timestamps += [_fromMicros(entryTime) for entryTime in
+                           snapshots['entryTime'][first:last].tolist()]
+        return timestamps
+
+    def loadSchedule(self, targetTime):
+        '''
+        Return the archived schedule saved at targetTime (to the second), as
+        a list of PID entry dictionaries (as returned by WMATADatabase.loadSchedule).
+        '''
+        second = asDatetime(targetTime).replace(microsecond=0)
+        schedule = []
+        for entryTime, arrivals in self._iterArrivals(second, second + timedelta(microseconds=999999)):
+            schedule += self._toSchedule(entryTime, arrivals)
+        return schedule
+
+    def iterSchedules(self, startTime=None, endTime=None, locationCodes=None):
+        '''
+        Stream the archived schedules in EntryTime order, as (EntryTime,
+        list of PID entry dictionaries) tuples, as WMATADatabase.iterSchedules.
+        '''
+        for entryTime, arrivals in self._iterArrivals(startTime, endTime, locationCodes):
+            yield entryTime, self._toSchedule(entryTime, arrivals)
+
+    def iterSnapshots(self, startTime=None, endTime=None, locationCodes=None):
+        '''
+        Stream the archived schedules in EntryTime order, as (EntryTime,
+        ScheduleSnapshot) tuples, as WMATADatabase.iterSnapshots.
+        '''
+        stationCodes, destinationIndex = self._stationCodes()
+        for entryTime, arrivals in self._iterArrivals(startTime, endTime, locationCodes):
+            minutes = np.where(arrivals['state'] == UNKNOWN, -1, arrivals['minutes'])
+            yield entryTime, ScheduleSnapshot(stationCodes, arrivals['location'],
+                                              destinationIndex[arrivals['destination']],
+                                              minutes, entryTime)
+
+    def _iterArrivals(self, startTime=None, endTime=None, locationCodes=None):
+        '''
+        Yield (EntryTime, arrivals array) for each archived schedule in the
+        range with any entries (at the given locations).
+        '''
+        locations = None
+        if locationCodes is not None:
+            codes = set(locationCodes)
+            locations = np.array([i for i, (code, name) in enumerate(self.locations)
+                                  if code in codes], dtype=np.int16)
+        for key, snapshots, first, last in self._ranges(startTime, endTime):
+            arrivals = self._load(key)[1]
+            for entryTime, start, count in snapshots[first:last].tolist():
+                entries = arrivals[start:start+count]
+                if locations is not None:
+                    entries = entries[np.in1d(entries['location'], locations)]
+                if len(entries):
+                    yield _fromMicros(entryTime), entries
+
+    def _ranges(self, startTime, endTime):
+        '''
+        Yield (key, snapshots array, first, last) for each partition overlapping
+        the time range, in time order, where snapshots[first:last] are in the range.
+        '''
+        start = None if startTime is None else _toMicros(startTime)
+        end = None if endTime is None else _toMicros(endTime)
+        for key in sorted(self.partitions):
+            info = self.partitions[key]
+            if (start is not None and info['end'] < start) or \
+               (end is not None and info['start'] > end):
+                continue
+            snapshots = self._load(key)[0]
+            times = snapshots['entryTime']
+            first = 0 if start is None else np.searchsorted(times, start, 'left')
+            last = len(times) if end is None else np.searchsorted(times, end, 'right')
+            yield key, snapshots, first, last
+
+    def _load(self, key, mmap=True):
+        '''
+        Return the (snapshots, arrivals) arrays of a partition, memory-mapped
+        unless mmap is False.
+        '''
+        if not mmap:
+            return tuple(np.load(path) for path in self._paths(key))
+        if key not in self._mapped:
+            self._mapped[key] = tuple(np.load(path, mmap_mode='r') for path in self._paths(key))
+        return self._mapped[key]
+
+    def _paths(self, key):
+        return (os.path.join(self.directory, key + ".snapshots.npy"),
+                os.path.join(self.directory, key + ".arrivals.npy"))
+
+    def _toSchedule(self, entryTime, arrivals):
+        schedule = []
+        for location, destination, line, group, minutes, state, car in arrivals.tolist():
+            locationCode, locationName = self.locations[location]
+            destinationCode, destinationText, destinationName = self.destinations[destination]
+            schedule.append({"CurrentTime": entryTime,
+                             "Group": _toText(group),
+                             "Min": None if state == UNKNOWN else minutes,
+                             "ArrivalState": state,
+                             "DestinationCode": destinationCode,
+                             "Car": _toText(car),
+                             "Destination": destinationText,
+                             "DestinationName": destinationName,
+                             "LocationName": locationName,
+                             "Line": self.lines[line],
+                             "LocationCode": locationCode})
+        return schedule
+
+    def _stationCodes(self):
+        '''
+        Return the station code list of the archive's ScheduleSnapshots: the
+        location codes, in order, followed by any destination codes that are
+        never a location; and an array mapping destination indexes to it.
+        '''
+        if self._snapshotCodes is None:
+            stationCodes = [code for code, name in self.locations]
+            stationIndex = dict((code, i) for i, code in enumerate(stationCodes))
+            destinationIndex = np.empty(len(self.destinations), dtype=np.int16)
+            for i, destination in enumerate(self.destinations):
+                code = destination[0]
+                if code is None:
+                    destinationIndex[i] = -1
+                    continue
+                if code not in stationIndex:
+                    stationIndex[code] = len(stationCodes)
+                    stationCodes.append(code)
+                destinationIndex[i] = stationIndex[code]
+            self._snapshotCodes = (stationCodes, destinationIndex)
+        return self._snapshotCodes
+
+
+def _toMicros(timestamp):
+    delta = asDatetime(timestamp) - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def _fromMicros(micros):
+    return EPOCH + timedelta(microseconds=micros)
+
+def _orMissing(value):
+    return -1 if value is None else value
+
+def _toText(value):
+    if value < 0: return None
+    return unicode(value)
@@ -0,0 +1,389 @@
+'''
+Created on Feb 3, 2012
+
+@author: dmasad
+
+Benchmarks of the main processing steps, run on synthetic schedules so
+they need neither an API key nor a collected database.
+
+PIDGenerator produces GetPrediction/All-style schedules from a
+NetworkTopology (a saved one, or a synthetic network), with trains running
+down every line at a given headway, plus noise and unknown ('---') entries.
+The scenarios time:
+    ingest: saving schedules to a database file.
+    listToDict, matchPIDs, findTrains, findTrainsSnapshot, matchTrains:
+        finding the trains in a single schedule, step by step.
+    loadSchedule: loading a single stored schedule.
+    replay: replaying a stored run of schedules (by default, a full day).
+    pipeline: fetching the stored schedules back from a replayServer, as
+        fast as possible, then saving them and finding their trains.
+    simulate: projecting the trains of a single schedule an hour forward,
+        under a batch of what-if delay scenarios.
+The results are written as JSON, and can be compared against an earlier
+results file to catch regressions:
+
+    python benchmark.py --output new.json --compare old.json
+'''
+
+from __future__ import division
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from MetroManager_SQL import WMATAManager
+from NetworkTopology import NetworkTopology, LineTopology, StationInfo, LINES
+from replayServer import ReplayServer
+from ScheduleSnapshot import ScheduleSnapshot
+from simulation import Simulator, Scenario
+from TrainLines import RailLine
+from trainClustering import matchTrains
+from trainPositions import TrainPositions
+from wmata import WMATA
+from WMATADatabase import WMATADatabase
+
+log = logging.getLogger(__name__)
+
+RESULTS_VERSION = 1
+START_TIME = datetime(2012, 1, 9, 5, 0, 0) # A Monday morning, at opening time.
+SIMULATION_SCENARIOS = 1000 # What-if scenarios per run of the simulate scenario.
+
+def syntheticTopology(lineCodes=LINES, stationCount=20):
+    '''
+    Build a NetworkTopology of straight, separate lines, each with
+    stationCount stations, for use when no saved topology is available.
+    '''
+    lines = []
+    for lineNumber, lineCode in enumerate(lineCodes):
+        stations = []
+        for i in range(stationCount):
+            code = "%s%02i" % (chr(ord('A') + lineNumber), i + 1)
+            stations.append(StationInfo(code, "Station " + code, i,
+                                        38.8 + 0.01 * i, -77.1 + 0.05 * lineNumber))
+        for reverse in [False, True]:
+            ordered = stations[::-1] if reverse else stations
+            ordered = [StationInfo(s.stationCode, s.stationName, i, s.lat, s.lon)
+                       for i, s in enumerate(ordered)]
+            lines.append(LineTopology(lineCode, reverse, [ordered[0].stationCode, ''],
+                                      [ordered[-1].stationCode, ''], ordered))
+    return NetworkTopology(lines)
+
+
+class PIDGenerator(object):
+    '''
+    Generates realistic schedules for a network.
+
+    Trains enter each line and direction every headway minutes and take a
+    fixed (per station, randomly drawn) time to reach each station from the
+    previous one. Each station board lists the next boardSize trains in each
+    direction, with normally distributed noise (of standard deviation noise
+    minutes) on their ETAs; a fraction unknownRate of entries show '---'.
+    '''
+
+    def __init__(self, topology, headway=6, interval=2.0, noise=0.5, unknownRate=0.01,
+                 boardSize=4, seed=0):
+        self.topology = topology
+        self.headway = headway
+        self.noise = noise
+        self.unknownRate = unknownRate
+        self.boardSize = boardSize
+        self.random = random.Random(seed)
+
+        # Minutes from the first station to each station, by line:
+        self.arrivalOffsets = []
+        for line in topology.lines:
+            offsets = [0.0]
+            for station in line.stations[1:]:
+                offsets.append(offsets[-1] + interval * self.random.uniform(0.7, 1.3))
+            self.arrivalOffsets.append(offsets)
+
+    def stationList(self):
+        '''
+        Station data for every station, as saved by WMATADatabase.saveStations.
+        '''
+        stations = {}
+        for line in self.topology.lines:
+            for station in line.stations:
+                stations[station.stationCode] = {'Code': station.stationCode,
+                    'Name': station.stationName, 'Lat': station.lat, 'Lon': station.lon,
+                    'LineCode1': line.lineCode, 'LineCode2': None, 'StationTogether1': None}
+        return stations.values()
+
+    def snapshot(self, minute):
+        '''
+        The schedule at the given number of minutes since the start of service.
+        '''
+        schedule = []
+        for line, offsets in zip(self.topology.lines, self.arrivalOffsets):
+            destination = line.stations[-1]
+            group = '2' if line.reverse else '1'
+            # Minutes since each train still on the line entered it:
+            firstTrain = int(math.ceil((minute - offsets[-1]) / self.headway))
+            ages = [minute - k * self.headway
+                    for k in range(max(0, firstTrain), int(minute // self.headway) + 1)]
+            for station, offset in zip(line.stations, offsets):
+                etas = sorted(offset - age for age in ages if offset >= age)
+                for eta in etas[:self.boardSize]:
+                    schedule.append({'Car': '6', 'Group': group, 'Line': line.lineCode,
+                                     'LocationCode': station.stationCode,
+                                     'LocationName': station.stationName,
+                                     'DestinationCode': destination.stationCode,
+                                     'Destination': destination.stationName[:8],
+                                     'DestinationName': destination.stationName,
+                                     'Min': self._minText(eta)})
+        return schedule
+
+    def schedules(self, count, step=1, startTime=START_TIME):
+        '''
+        Generate (timestamp, schedule) tuples for count polls, step minutes apart.
+        '''
+        for i in range(count):
+            yield startTime + timedelta(minutes=i * step), self.snapshot(i * step)
+
+    def _minText(self, eta):
+        if self.random.random() < self.unknownRate:
+            return '---'
+        eta = max(0, eta + self.random.gauss(0, self.noise))
+        if eta < 0.5: return 'BRD'
+        if eta < 1: return 'ARR'
+        return str(int(round(eta)))
+
+
+class _BenchmarkManager(WMATAManager):
+    '''
+    WMATAManager over a synthetic network, with no API access.
+    '''
+
+    def __init__(self, topology, database=':memory:'):
+        self.db = WMATADatabase(self, database)
+        self.db.initializeDatabase()
+        self.topology = topology
+        self.current_time = None
+        self.currentSchedule = []
+        self.rail_lines = []
+        for lineTopology in topology.lines:
+            self.rail_lines.append(RailLine(self, lineTopology.lineCode,
+                                            lineTopology.reverse, lineTopology))
+        self.trainPositions = TrainPositions(self.rail_lines)
+
+
+def timeRuns(function, repeat, items=1, setup=None):
+    '''
+    Time repeat calls of function(), each preceded by an (untimed) call of
+    setup() if given, whose return value is passed to function instead.
+
+    items: the number of items (polls, entries...) each call processes.
+    Returns a dictionary of the timings, in seconds.
+    '''
+    seconds = []
+    for i in range(repeat):
+        args = () if setup is None else (setup(),)
+        start = time.time()
+        function(*args)
+        seconds.append(time.time() - start)
+    ordered = sorted(seconds)
+    return {'seconds': seconds, 'min': ordered[0], 'median': ordered[len(ordered) // 2],
+            'items': items, 'perItem': ordered[0] / items}
+
+
+def runBenchmarks(topology=None, repeat=5, headway=6, noise=0.5, days=1,
+                  pollInterval=1, seed=0, scenarios=None):
+    '''
+    Run the benchmark scenarios.
+
+    topology: the NetworkTopology to generate schedules for; synthetic by default.
+    repeat: number of timed runs of each single-snapshot scenario.
+    headway, noise: passed to the PIDGenerator.
+    days, pollInterval: length of the replay, and minutes between its polls.
+    scenarios: list of the scenario names to run; all by default.
+
+    Returns the results, as a JSON-serializable dictionary.
+    '''
+    if topology is None:
+        topology = syntheticTopology()
+    generator = PIDGenerator(topology, headway=headway, noise=noise, seed=seed)
+    pollCount = int(days * 24 * 60 // pollInterval)
+    # A schedule from mid-morning, when every line is full:
+    schedule = generator.snapshot(240)
+    nextSchedule = generator.snapshot(240 + pollInterval)
+
+    def wanted(name):
+        return scenarios is None or name in scenarios
+
+    def copies():
+        return [dict(entry) for entry in schedule]
+
+    results = {}
+    manager = _BenchmarkManager(topology)
+    if wanted('listToDict'):
+        results['listToDict'] = timeRuns(
+            lambda: manager._listToDict(schedule, ['LocationCode','DestinationCode']),
+            repeat, len(schedule))
+    if wanted('matchPIDs'):
+        def matchPIDs(entries):
+            pidDict = manager._listToDict(entries, ['LocationCode','DestinationCode'])
+            for line in manager.rail_lines:
+                line._matchPIDs(pidDict)
+        results['matchPIDs'] = timeRuns(matchPIDs, repeat, len(schedule), copies)
+    if wanted('findTrains'):
+        def findTrains(entries):
+            manager.currentSchedule = entries
+            manager.findTrains()
+        results['findTrains'] = timeRuns(findTrains, repeat, len(schedule), copies)
+    if wanted('findTrainsSnapshot'):
+        def findTrainsSnapshot():
+            manager.currentSchedule = ScheduleSnapshot.fromSchedule(schedule)
+            manager.findTrains()
+        results['findTrainsSnapshot'] = timeRuns(findTrainsSnapshot, repeat, len(schedule))
+    if wanted('matchTrains'):
+        manager.currentSchedule = copies()
+        manager.findTrains()
+        oldTrains = [line.Trains for line in manager.rail_lines]
+        manager.currentSchedule = [dict(entry) for entry in nextSchedule]
+        manager.findTrains()
+        newTrains = [line.newTrains for line in manager.rail_lines]
+        def match():
+            for line, old, new in zip(manager.rail_lines, oldTrains, newTrains):
+                matchTrains(old, new, line.matchThreshold, maxGhost=line.maxGhostAge)
+        results['matchTrains'] = timeRuns(match, repeat, sum(len(new) for new in newTrains))
+    if wanted('simulate'):
+        manager.currentSchedule = copies()
+        manager.findTrains()
+        simulator = Simulator(manager.rail_lines)
+        state = simulator.trainState()
+        stationCodes = sorted(simulator.stationIndex)
+        whatIfs = [Scenario(delays={stationCodes[i % len(stationCodes)]: 1 + i % 5})
+                   for i in range(SIMULATION_SCENARIOS)]
+        results['simulate'] = timeRuns(lambda: simulator.run(60, whatIfs, state),
+                                       repeat, len(whatIfs))
+
+    directory = tempfile.mkdtemp()
+    try:
+        database = os.path.join(directory, "benchmark.db")
+        fileManager = _BenchmarkManager(topology, database)
+        fileManager.db.saveStations(generator.stationList())
+        polls = list(generator.schedules(pollCount, pollInterval))
+
+        def ingest():
+            for timestamp, entries in polls:
+                fileManager.db.saveSchedule(entries, timestamp)
+            fileManager.db.flush()
+        if wanted('ingest'):
+            results['ingest'] = timeRuns(ingest, 1, len(polls))
+        else:
+            ingest()
+
+        if wanted('loadSchedule'):
+            targets = [polls[i * len(polls) // repeat][0] for i in range(repeat)]
+            results['loadSchedule'] = timeRuns(lambda target: fileManager.db.loadSchedule(target),
+                                               repeat, 1, iter(targets).next)
+        def replay():
+            fileManager.db.createIndexes()
+            for timecode, snapshot in fileManager.db.iterSnapshots():
+                fileManager.currentSchedule = snapshot
+                fileManager.current_time = timecode
+                fileManager.findTrains()
+        if wanted('replay'):
+            results['replay'] = timeRuns(replay, 1, len(polls))
+        if wanted('pipeline'):
+            server = ReplayServer(database, speed=None)
+            api = WMATA('benchmark', server.start())
+            sinkManager = _BenchmarkManager(topology, os.path.join(directory, "pipeline.db"))
+            def pipeline():
+                for timestamp, entries in polls:
+                    schedule = api.updateSchedule()
+                    sinkManager.db.saveSchedule(schedule, timestamp)
+                    sinkManager.currentSchedule = schedule
+                    sinkManager.current_time = timestamp
+                    sinkManager.findTrains()
+                sinkManager.db.flush()
+            try:
+                results['pipeline'] = timeRuns(pipeline, 1, len(polls))
+            finally:
+                server.stop()
+                api.pool.close()
+                sinkManager.db.close()
+        fileManager.db.close()
+    finally:
+        shutil.rmtree(directory)
+
+    for name in scenarios or []:
+        if name not in results:
+            log.warning("Scenario %s was requested, but produced no result.", name)
+    return {'version': RESULTS_VERSION,
+            'created': datetime.now().isoformat(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'parameters': {'stations': sum(len(line.stations) for line in topology.lines),
+                           'entries': len(schedule), 'repeat': repeat, 'headway': headway,
+                           'noise': noise, 'days': days, 'pollInterval': pollInterval,
+                           'seed': seed},
+            'results': results}
+
+
+def compareResults(baseline, current, tolerance=0.1):
+    '''
+    Compare two sets of results by the best time per item of each scenario.
+    Returns a list of (scenario, baseline, current, ratio, regressed) tuples,
+    where regressed is True if current is slower by more than tolerance.
+    '''
+    comparison = []
+    for name in sorted(current['results']):
+        if name not in baseline['results']: continue
+        old = baseline['results'][name]['perItem']
+        new = current['results'][name]['perItem']
+        ratio = new / old if old else float('inf')
+        comparison.append((name, old, new, ratio, ratio > 1 + tolerance))
+    return comparison
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the train-finding pipeline.")
+    parser.add_argument("--topology", help="saved NetworkTopology file (default: synthetic)")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="slowdown ratio counted as a regression (default: 0.1)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--headway", type=float, default=6)
+    parser.add_argument("--noise", type=float, default=0.5)
+    parser.add_argument("--days", type=float, default=1)
+    parser.add_argument("--poll-interval", type=float, default=1, dest="pollInterval")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("scenarios", nargs="*", help="scenarios to run (default: all)")
+    args = parser.parse_args(argv)
+    logging.basicConfig()
+
+    topology = NetworkTopology.load(args.topology) if args.topology else None
+    results = runBenchmarks(topology, args.repeat, args.headway, args.noise, args.days,
+                            args.pollInterval, args.seed, args.scenarios or None)
+    for name in sorted(results['results']):
+        result = results['results'][name]
+        print "%-20s %10.4f s  %12.2f us/item" % (name, result['min'], result['perItem'] * 1e6)
+    if args.output:
+        f = open(args.output, "w")
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.close()
+
+    if args.compare:
+        f = open(args.compare)
+        baseline = json.load(f)
+        f.close()
+        regressions = 0
+        for name, old, new, ratio, regressed in compareResults(baseline, results, args.tolerance):
+            print "%-20s %6.2fx%s" % (name, ratio, "  REGRESSION" if regressed else "")
+            regressions += regressed
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+'''
+Created on Feb 6, 2012
+
+@author: dmasad
+
+Streaming writers for tables of records.
+
+Each exporter is created with a fixed list of fields, takes records (one
+dictionary per row, keyed by field) one at a time or from any iterable,
+and writes them out as it goes, so the full table never has to be held in
+memory:
+    CSVExporter writes each row as it arrives.
+    ParquetExporter and ArrowExporter buffer rowGroupSize rows at a time,
+    and write each group as a Parquet row group or Arrow record batch.
+The columnar formats require pyarrow. Their column types are given by a
+dictionary of pyarrow type names (e.g. 'int64'), by field; the types of
+any other fields are inferred from the first group of rows.
+'''
+
+import csv
+import os
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+TRAIN_COUNT_FIELDS = ["TimeStamp", "Line", "Direction", "TrainCount"]
+TRAIN_COUNT_TYPES = {"TimeStamp": "timestamp[us]", "Line": "string", "Direction": "bool",
+                     "TrainCount": "int64"}
+ROW_GROUP_SIZE = 65536 # Rows per Parquet row group or Arrow record batch.
+
+class _Exporter(object):
+
+    def writeMany(self, records):
+        for record in records:
+            self.write(record)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+class CSVExporter(_Exporter):
+    '''
+    Writes records to a CSV file, with a header row of the field names.
+    '''
+
+    def __init__(self, filepath, fields, types=None):
+        self.fields = list(fields)
+        self.rowCount = 0
+        self._file = open(filepath, "wb")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(self.fields)
+
+    def write(self, record):
+        self._writer.writerow([record[field] for field in self.fields])
+        self.rowCount += 1
+
+    def close(self):
+        self._file.close()
+
+
+class _ColumnarExporter(_Exporter):
+    '''
+    Base for the pyarrow exporters: collects the records into columns, and
+    writes them rowGroupSize rows at a time. The column types not given in
+    types are inferred from the first group, and the rest are converted to
+    the same types. If every type is given, the file is written with that 
+    schema even when there are no records.
+    '''
+
+    def __init__(self, filepath, fields, types=None, rowGroupSize=ROW_GROUP_SIZE):
+        if pyarrow is None:
+            raise ImportError("Writing %s files requires pyarrow." % self.formatName)
+        self.filepath = filepath
+        self.fields = list(fields)
+        self.rowGroupSize = rowGroupSize
+        self.rowCount = 0
+        types = types or {}
+        self._types = [pyarrow.type_for_alias(types[field]) if field in types else None
+                       for field in self.fields]
+        self.schema = None
+        if None not in self._types:
+            self.schema = pyarrow.schema([pyarrow.field(field, fieldType)
+                                          for field, fieldType in zip(self.fields, self._types)])
+        self._writer = None
+        self._columns = [[] for field in self.fields]
+
+    def write(self, record):
+        for column, field in zip(self._columns, self.fields):
+            column.append(record[field])
+        self.rowCount += 1
+        if len(self._columns[0]) >= self.rowGroupSize:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the buffered rows as a row group.
+        '''
+        if not self._columns[0]: return
+        if self.schema is None:
+            arrays = [pyarrow.array(column, type=fieldType)
+                      for column, fieldType in zip(self._columns, self._types)]
+        else:
+            arrays = [pyarrow.array(column, type=self.schema[i].type)
+                      for i, column in enumerate(self._columns)]
+        batch = pyarrow.RecordBatch.from_arrays(arrays, self.fields)
+        if self._writer is None:
+            self.schema = batch.schema
+            self._writer = self._openWriter()
+        self._writeBatch(batch)
+        self._columns = [[] for field in self.fields]
+
+    def close(self):
+        self.flush()
+        if self._writer is None and self.schema is not None:
+            self._writer = self._openWriter() # No records: write an empty file.
+        if self._writer is not None:
+            self._writer.close()
+
+
+class ParquetExporter(_ColumnarExporter):
+    '''
+    Writes records to a Parquet file, in row groups of rowGroupSize rows.
+    '''
+    formatName = "Parquet"
+
+    def _openWriter(self):
+        return pyarrow.parquet.ParquetWriter(self.filepath, self.schema)
+
+    def _writeBatch(self, batch):
+        self._writer.write_table(pyarrow.Table.from_batches([batch]))
+
+
+class ArrowExporter(_ColumnarExporter):
+    '''
+    Writes records to an Arrow IPC file, in batches of rowGroupSize rows.
+    '''
+    formatName = "Arrow"
+
+    def _openWriter(self):
+        self._sink = pyarrow.OSFile(self.filepath, "wb")
+        return pyarrow.RecordBatchFileWriter(self._sink, self.schema)
+
+    def _writeBatch(self, batch):
+        self._writer.write_batch(batch)
+
+    def close(self):
+        _ColumnarExporter.close(self)
+        if self._writer is not None:
+            self._sink.close()
+
+
+EXPORTERS = {'csv': CSVExporter, 'parquet': ParquetExporter, 'arrow': ArrowExporter}
+EXTENSIONS = {'.csv': 'csv', '.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow'}
+
+def exportRecords(records, filepath, fields, format=None, types=None):
+    '''
+    Write an iterable of records to filepath, in constant memory.
+
+    fields: the list of fields (columns) to write, in order.
+    types: dictionary of the pyarrow type names of the fields (e.g. 
+        'int64'), for the columnar formats.
+    format: 'csv', 'parquet' or 'arrow'; by default, chosen by the file
+        extension, or CSV for unknown extensions.
+
+    Returns the number of records written.
+    '''
+    if format is None:
+        format = EXTENSIONS.get(os.path.splitext(filepath)[1].lower(), 'csv')
+    with EXPORTERS[format](filepath, fields, types) as exporter:
+        exporter.writeMany(records)
+    return exporter.rowCount
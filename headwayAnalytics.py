@@ -0,0 +1,348 @@
+'''
+Created on Feb 14, 2012
+
+@author: dmasad
+
+Station-level headway, wait time, bunching and gap analytics.
+
+The analytics are built on the arrival events of the trains at each
+station, which are found from the station boards a whole (service) day of
+snapshots at a time, without replaying findTrains:
+    For each board (station and destination), the leading ETA in every
+    poll is collected into a (boards x polls) array.
+    A train has arrived when the leading ETA reaches 0 (ARR or BRD), or
+    when a train due within APPROACH_MINUTES vanishes from the head of the
+    board for good, replaced by a later one (it arrived and left between
+    polls).
+The events of each day are cached, in memory and optionally as .npy files,
+so reports over long ranges only have to process each day once.
+
+Each event is assigned to every line and direction that serves its board
+(the station is on the line, and the destination is one of the line's
+terminals), and the headways are the times between successive arrivals at
+a station on a line, in one direction. Headways longer than MAX_HEADWAY
+are breaks in service, and are left out. From them:
+    mean wait: the expected wait of a passenger arriving at random,
+        E[H^2] / (2 E[H]).
+    bunching: headways under BUNCHING_FRACTION of the typical headway
+        (the median at the station in that hour of the day, over the range).
+    gaps: headways over GAP_FACTOR times the typical headway.
+
+Usage:
+    analytics = HeadwayAnalytics(manager, cacheDirectory='headways')
+    report = analytics.stationReport(startTime, endTime)
+'''
+
+from __future__ import division
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from utilities import asDatetime, saveArray
+
+CACHE_VERSION = 1
+DAY_START = timedelta(hours=4) # Service days run from 4 AM to 4 AM.
+APPROACH_MINUTES = 3   # Farthest (minutes) a train can be when it's last listed, and have arrived.
+DEPARTURE_JUMP = 2     # Rise (minutes) in the leading ETA that means the leading train has left.
+MAX_POLL_GAP = 5       # Longest gap (minutes) between polls to detect arrivals across.
+MAX_HEADWAY = 60       # Longest headway (minutes) not treated as a break in service.
+BUNCHING_FRACTION = 0.5
+GAP_FACTOR = 2.0
+NOT_LISTED = np.iinfo(np.int16).max # Leading ETA of boards with no known entries.
+EVENT_DTYPE = np.dtype([('time', '<f8'), ('location', 'S4'), ('destination', 'S4')])
+EPOCH = datetime(1970, 1, 1)
+REPORT_FIELDS = ["LineCode", "Direction", "StationCode", "Arrivals", "Headways", "MeanHeadway",
+                 "MaxHeadway", "MeanWait", "Bunching", "Gaps"]
+REPORT_TYPES = {"LineCode": "string", "Direction": "int64", "StationCode": "string",
+                "Arrivals": "int64", "Headways": "int64", "MeanHeadway": "double",
+                "MaxHeadway": "double", "MeanWait": "double", "Bunching": "int64", "Gaps": "int64"}
+
+def detectArrivals(times, boards, polls, minutes, boardCount):
+    '''
+    Find the arrival events in a run of polls.
+
+    times: array of the time of each poll, in minutes.
+    boards, polls, minutes: arrays of the board number, poll number and
+        minutes (-1 if unknown) of each PID entry.
+    boardCount: the number of boards.
+
+    Returns arrays of the board number and time (in minutes) of each arrival.
+    '''
+    pollCount = len(times)
+    lead = np.empty((boardCount, pollCount), dtype=np.int16)
+    lead.fill(NOT_LISTED)
+    known = minutes >= 0
+    cells = boards[known].astype(np.int64) * pollCount + polls[known]
+    entryMinutes = minutes[known]
+    order = np.lexsort((entryMinutes, cells))
+    cells = cells[order]
+    first = np.ones(len(cells), dtype=bool)
+    first[1:] = cells[1:] != cells[:-1]
+    lead.flat[cells[first]] = entryMinutes[order][first]
+
+    previous = lead[:, :-1].astype(np.int32)
+    current = lead[:, 1:].astype(np.int32)
+    following = np.empty_like(current) # The leading ETA a poll later.
+    following[:, :-1] = current[:, 1:]
+    following[:, -1] = NOT_LISTED
+    approaching = (previous > 0) & (previous <= APPROACH_MINUTES)
+    # A jump only counts if the leading train doesn't reappear in the next poll:
+    departed = (current > previous + DEPARTURE_JUMP) & (following > previous)
+    arrived = approaching & ((current == 0) | departed)
+    arrived &= (times[1:] - times[:-1] <= MAX_POLL_GAP)[np.newaxis, :]
+    board, poll = np.nonzero(arrived)
+    arrivalTimes = np.minimum(times[poll + 1], times[poll] + previous[board, poll])
+    return board, arrivalTimes
+
+
+class HeadwayAnalytics(object):
+    '''
+    Headway analytics over the schedules stored by a WMATAManager.
+    '''
+
+    def __init__(self, manager, cacheDirectory=None):
+        '''
+        manager: a WMATAManager, whose database holds the schedules and
+            whose rail lines define the stations and directions.
+        cacheDirectory: directory to cache each day's arrival events in;
+            by default, they are only cached in memory.
+        '''
+        self.manager = manager
+        self.db = manager.db
+        self.cacheDirectory = cacheDirectory
+        if cacheDirectory is not None and not os.path.isdir(cacheDirectory):
+            os.makedirs(cacheDirectory)
+        self._days = {} # Arrival events, by service day.
+
+        # The (lineCode, reverse, stationCode) groups, and the groups of each board:
+        self.groups = []
+        self.boardGroups = {}
+        for line in manager.rail_lines:
+            destinations = [code for code in line.endStation if code]
+            for station in line.stationList:
+                for destination in destinations:
+                    self.boardGroups.setdefault((station.stationCode, destination),
+                                                []).append(len(self.groups))
+                self.groups.append((line.lineCode, line.reverse, station.stationCode))
+
+    """
+    ARRIVAL EVENTS
+    """
+
+    def dayArrivals(self, day, refresh=False):
+        '''
+        Return the arrival events of a service day (a date), as an array of
+        EVENT_DTYPE records (time in seconds since 1970), in time order.
+        Days before the current one are cached once computed.
+        refresh: if True, recompute the events even if they are cached.
+        '''
+        if not refresh and day in self._days:
+            return self._days[day]
+        complete = day < serviceDay(datetime.now())
+        path = None
+        if self.cacheDirectory is not None:
+            path = os.path.join(self.cacheDirectory, "%s.v%i.npy" % (day.isoformat(), CACHE_VERSION))
+            if not refresh and os.path.exists(path):
+                events = np.load(path)
+                self._days[day] = events
+                return events
+        events = self._computeDay(day)
+        if complete:
+            self._days[day] = events
+            if path is not None:
+                saveArray(path, events)
+        return events
+
+    def _computeDay(self, day):
+        '''
+        Find the arrival events of a service day from its stored schedules.
+        '''
+        start = datetime(day.year, day.month, day.day) + DAY_START
+        end = start + timedelta(days=1) - timedelta(microseconds=1)
+        codes = []          # The station codes, in a single index for the whole day.
+        codeIndex = {}
+        translations = {}   # Arrays mapping each snapshot code list to the day's index.
+        times = []
+        locations = []
+        destinations = []
+        minutes = []
+        polls = []
+        for timecode, snapshot in self.db.iterSnapshots(start, end):
+            translation = translations.get(id(snapshot.stationCodes))
+            if translation is None or len(translation) != len(snapshot.stationCodes) + 1:
+                for code in snapshot.stationCodes:
+                    if code not in codeIndex:
+                        codeIndex[code] = len(codes)
+                        codes.append(code)
+                translation = np.array([codeIndex[code] for code in snapshot.stationCodes] + [-1],
+                                       dtype=np.int32)
+                translations[id(snapshot.stationCodes)] = translation
+            polls.append(np.empty(len(snapshot), dtype=np.int32))
+            polls[-1].fill(len(times))
+            times.append(_minutesSince(start, timecode))
+            locations.append(translation[snapshot.location])
+            destinations.append(translation[snapshot.destination]) # -1 stays -1.
+            minutes.append(snapshot.minutes)
+        if len(times) < 2:
+            return np.zeros(0, dtype=EVENT_DTYPE)
+        locations = np.concatenate(locations)
+        destinations = np.concatenate(destinations)
+        minutes = np.concatenate(minutes)
+        minutes[destinations < 0] = -1
+        base = len(codes) + 1
+        keys = locations.astype(np.int64) * base + destinations + 1
+        boardKeys, boards = np.unique(keys, return_inverse=True)
+        board, arrivalTimes = detectArrivals(np.array(times), boards, np.concatenate(polls),
+                                             minutes, len(boardKeys))
+        order = np.argsort(arrivalTimes, kind='mergesort')
+        boardKeys = boardKeys[board[order]]
+        codes = np.array(codes, dtype='S4')
+        events = np.zeros(len(order), dtype=EVENT_DTYPE)
+        events['time'] = _seconds(start) + arrivalTimes[order] * 60
+        events['location'] = codes[boardKeys // base]
+        events['destination'] = codes[boardKeys % base - 1]
+        return events
+
+    def arrivals(self, startTime, endTime):
+        '''
+        Return the arrival events from startTime to endTime (inclusive), as
+        an array of EVENT_DTYPE records, in time order.
+        '''
+        startTime = asDatetime(startTime)
+        endTime = asDatetime(endTime)
+        days = []
+        day = serviceDay(startTime)
+        while day <= serviceDay(endTime):
+            days.append(self.dayArrivals(day))
+            day += timedelta(days=1)
+        events = np.concatenate(days) if days else np.zeros(0, dtype=EVENT_DTYPE)
+        inRange = (events['time'] >= _seconds(startTime)) & (events['time'] <= _seconds(endTime))
+        return events[inRange]
+
+    """
+    HEADWAYS
+    """
+
+    def headways(self, startTime, endTime):
+        '''
+        Compute the headways from startTime to endTime.
+
+        Returns a dictionary of arrays, one entry per headway:
+            group: the index of its (lineCode, reverse, stationCode) in groups.
+            time: the time of the arrival ending it, in seconds since 1970.
+            headway: its length, in minutes.
+            typical: the median headway at the station, in the same hour of
+                the day, over the whole range.
+        and, per group, 'arrivals': the number of arrivals.
+        '''
+        events = self.arrivals(startTime, endTime)
+        eventGroups, eventTimes = self._groupEvents(events)
+        arrivals = np.bincount(eventGroups, minlength=len(self.groups))
+
+        order = np.lexsort((eventTimes, eventGroups))
+        eventGroups = eventGroups[order]
+        eventTimes = eventTimes[order]
+        headway = (eventTimes[1:] - eventTimes[:-1]) / 60
+        keep = (eventGroups[1:] == eventGroups[:-1]) & (headway <= MAX_HEADWAY)
+        group = eventGroups[1:][keep]
+        time = eventTimes[1:][keep]
+        headway = headway[keep]
+
+        # The median headway of each group in each hour of the day:
+        hours = ((time % 86400) // 3600).astype(np.intp)
+        keys = group * 24 + hours
+        order = np.lexsort((headway, keys))
+        sortedHeadways = headway[order]
+        uniqueKeys, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+        medians = (sortedHeadways[starts + (counts - 1) // 2] + sortedHeadways[starts + counts // 2]) / 2
+        typical = medians[np.searchsorted(uniqueKeys, keys)]
+        return {'group': group, 'time': time, 'headway': headway, 'typical': typical,
+                'arrivals': arrivals}
+
+    def _groupEvents(self, events):
+        '''
+        Assign arrival events to the groups serving their boards.
+        Returns arrays of the group and time of each (event, group) pair.
+        '''
+        boards = np.char.add(np.char.add(events['location'], '|'), events['destination'])
+        uniqueBoards, inverse = np.unique(boards, return_inverse=True)
+        boardGroups = [self.boardGroups.get(tuple(board.split('|')), ())
+                       for board in uniqueBoards]
+        groupCounts = np.array([len(groups) for groups in boardGroups], dtype=np.intp)
+        firstGroup = np.cumsum(groupCounts) - groupCounts
+        allGroups = np.array([group for groups in boardGroups for group in groups], dtype=np.intp)
+        # Repeat each event once per group, and pick out its groups in turn:
+        repeats = groupCounts[inverse]
+        eventNums = np.repeat(np.arange(len(events)), repeats)
+        within = np.arange(len(eventNums)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+        groups = allGroups[firstGroup[inverse][eventNums] + within]
+        return groups, events['time'][eventNums]
+
+    def stationReport(self, startTime, endTime):
+        '''
+        Summarize the headways at each station, on each line and direction,
+        from startTime to endTime.
+
+        Returns a list of dictionaries with keys LineCode, Direction,
+        StationCode, Arrivals, Headways, MeanHeadway, MaxHeadway, MeanWait,
+        Bunching and Gaps (the means are None with no headways).
+        '''
+        headways = self.headways(startTime, endTime)
+        group = headways['group']
+        headway = headways['headway']
+        groupCount = len(self.groups)
+        counts = np.bincount(group, minlength=groupCount)
+        totals = np.bincount(group, headway, minlength=groupCount)
+        squares = np.bincount(group, headway ** 2, minlength=groupCount)
+        maxima = np.zeros(groupCount)
+        np.maximum.at(maxima, group, headway)
+        bunching = np.bincount(group, headway < BUNCHING_FRACTION * headways['typical'],
+                               minlength=groupCount)
+        gaps = np.bincount(group, headway > GAP_FACTOR * headways['typical'],
+                           minlength=groupCount)
+        report = []
+        for i, (lineCode, reverse, stationCode) in enumerate(self.groups):
+            row = {'LineCode': lineCode, 'Direction': int(reverse), 'StationCode': stationCode,
+                   'Arrivals': int(headways['arrivals'][i]), 'Headways': int(counts[i]),
+                   'MeanHeadway': None, 'MaxHeadway': None, 'MeanWait': None,
+                   'Bunching': int(bunching[i]), 'Gaps': int(gaps[i])}
+            if counts[i]:
+                row['MeanHeadway'] = totals[i] / counts[i]
+                row['MaxHeadway'] = maxima[i]
+                row['MeanWait'] = squares[i] / (2 * totals[i])
+            report.append(row)
+        return report
+
+    def irregularHeadways(self, startTime, endTime):
+        '''
+        List the bunching and gap events from startTime to endTime, as
+        (time, lineCode, direction, stationCode, headway, typical headway,
+        'bunching' or 'gap') tuples, in time order.
+        '''
+        headways = self.headways(startTime, endTime)
+        headway = headways['headway']
+        typical = headways['typical']
+        bunched = headway < BUNCHING_FRACTION * typical
+        irregular = np.nonzero(bunched | (headway > GAP_FACTOR * typical))[0]
+        irregular = irregular[np.argsort(headways['time'][irregular], kind='mergesort')]
+        events = []
+        for i in irregular:
+            lineCode, reverse, stationCode = self.groups[headways['group'][i]]
+            events.append((EPOCH + timedelta(seconds=float(headways['time'][i])), lineCode,
+                           int(reverse), stationCode, float(headway[i]), float(typical[i]),
+                           'bunching' if bunched[i] else 'gap'))
+        return events
+
+
+def serviceDay(timestamp):
+    '''
+    Return the service day (as a date) that a datetime falls in.
+    '''
+    return (timestamp - DAY_START).date()
+
+def _seconds(timestamp):
+    return (timestamp - EPOCH).total_seconds()
+
+def _minutesSince(start, timestamp):
+    return (asDatetime(timestamp) - start).total_seconds() / 60
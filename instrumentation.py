@@ -0,0 +1,259 @@
+'''
+Created on Feb 4, 2012
+
+@author: dmasad
+
+Timers and counters for the stages of collecting and processing schedules.
+
+An Instrumentation object keeps, for each stage (fetch, parse, store,
+matchPIDs, assembleTrains, matchTrains, export), the number of times it ran
+and the total and longest time it took, along with a set of named counters.
+These can be written to a log as JSON, or exported in the Prometheus text
+format, as a string or from a small HTTP endpoint.
+
+NULL_INSTRUMENTATION, whose timers and counters do nothing, is used wherever
+instrumentation hasn't been turned on, so it costs next to nothing when off.
+
+For finer detail, profile() runs cProfile around a block of code, and
+SamplingProfiler samples the call stack at regular intervals.
+'''
+
+import cProfile
+import json
+import logging
+import os
+import signal
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock, Thread
+
+log = logging.getLogger(__name__)
+
+STAGES = ['fetch', 'parse', 'store', 'matchPIDs', 'assembleTrains', 'matchTrains', 'export']
+
+class _StageTimer(object):
+    __slots__ = ('instrumentation', 'stage', 'start')
+
+    def __init__(self, instrumentation, stage):
+        self.instrumentation = instrumentation
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.record(self.stage, time.time() - self.start)
+        return False
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class Instrumentation(object):
+    '''
+    Thread-safe per-stage timers and counters.
+
+    Usage:
+        with instrumentation.timer('fetch'):
+            ...
+        instrumentation.count('polls')
+    '''
+    enabled = True
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}    # [calls, total seconds, longest call], by stage.
+            self.counters = {}
+
+    def timer(self, stage):
+        '''
+        Return a context manager timing the block it wraps as one call of stage.
+        '''
+        return _StageTimer(self, stage)
+
+    def record(self, stage, seconds):
+        with self._lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                self.stages[stage] = [1, seconds, seconds]
+            else:
+                stats[0] += 1
+                stats[1] += seconds
+                if seconds > stats[2]: stats[2] = seconds
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        '''
+        Return the current timings and counters as a dictionary.
+        '''
+        with self._lock:
+            stages = dict((stage, {'calls': calls, 'seconds': total, 'max': longest})
+                          for stage, (calls, total, longest) in self.stages.items())
+            return {'stages': stages, 'counters': dict(self.counters)}
+
+    def log(self, logger=log, level=logging.INFO):
+        '''
+        Write the current timings and counters to a log, as a line of JSON.
+        '''
+        logger.log(level, "instrumentation %s", json.dumps(self.report(), sort_keys=True))
+
+    def prometheusText(self, prefix="wmata"):
+        '''
+        Return the current timings and counters in the Prometheus text format.
+        '''
+        report = self.report()
+        lines = []
+        for name, kind, field, description in [
+                ('stage_calls_total', 'counter', 'calls', 'Number of runs of each stage.'),
+                ('stage_seconds_total', 'counter', 'seconds', 'Total time spent in each stage.'),
+                ('stage_max_seconds', 'gauge', 'max', 'Longest single run of each stage.')]:
+            lines.append("# HELP %s_%s %s" % (prefix, name, description))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+            for stage in sorted(report['stages']):
+                lines.append('%s_%s{stage="%s"} %r' % (prefix, name, stage,
+                                                       report['stages'][stage][field]))
+        for counter in sorted(report['counters']):
+            lines.append("# TYPE %s_%s_total counter" % (prefix, counter))
+            lines.append("%s_%s_total %r" % (prefix, counter, report['counters'][counter]))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=9100, host=''):
+        '''
+        Serve prometheusText() at /metrics from a background thread.
+        Returns the HTTPServer; call its shutdown() method to stop it.
+        '''
+        instrumentation = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = instrumentation.prometheusText()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format, *args)
+
+        server = HTTPServer((host, port), MetricsHandler)
+        thread = Thread(target=server.serve_forever, name="Instrumentation-metrics")
+        thread.daemon = True
+        thread.start()
+        return server
+
+    @contextmanager
+    def profile(self, filepath=None):
+        '''
+        Run cProfile over the block; the profiler is bound by the with statement.
+        filepath: if given, the file to save the pstats data to afterwards.
+        '''
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            if filepath is not None:
+                profiler.dump_stats(filepath)
+
+
+class NullInstrumentation(Instrumentation):
+    '''
+    Instrumentation that records nothing.
+    '''
+    enabled = False
+
+    def timer(self, stage):
+        return _NULL_TIMER
+
+    def record(self, stage, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+
+class SamplingProfiler(object):
+    '''
+    Statistical profiler: records the call stack of the main thread every
+    interval seconds of CPU time. Relies on SIGPROF, so it only works on
+    Unix, and must be started from the main thread.
+
+    Usage:
+        with SamplingProfiler() as profiler:
+            ...
+        print profiler.topFunctions()
+    '''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = defaultdict(int) # Number of samples, by call stack.
+        self._previousHandler = None
+
+    def start(self):
+        self._previousHandler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previousHandler or signal.SIG_DFL)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        stack.reverse()
+        self.samples[tuple(stack)] += 1
+
+    def topFunctions(self, count=20):
+        '''
+        Return a list of (samples, function) tuples for the functions most
+        often found running, innermost frame only.
+        '''
+        totals = defaultdict(int)
+        for stack, samples in self.samples.items():
+            totals[stack[-1]] += samples
+        return sorted(((samples, function) for function, samples in totals.items()),
+                      reverse=True)[:count]
+
+    def collapsed(self):
+        '''
+        Return the samples in the collapsed-stack format read by flame graph tools.
+        '''
+        return "\n".join("%s %i" % (";".join(stack), samples)
+                         for stack, samples in sorted(self.samples.items()))
@@ -0,0 +1,228 @@
+'''
+Created on Feb 13, 2012
+
+@author: dmasad
+
+Time-of-week model of the travel times between stations, precomputed into
+dense lookup tables.
+
+IntervalModel holds the observed interval times (the IntervalTimes table)
+as running counts and totals, in arrays indexed by
+    (line and direction, station seqNum, 15-minute slot of the week),
+and from them an array of estimates, so looking up the interval time to
+a station at a given time is a single array access. A slot with fewer than
+MIN_SLOT_COUNT observations falls back on the same time of day over all
+days of the week, and then on all the observations of the station.
+
+The model is updated incrementally: it remembers the rowid of the last
+IntervalTimes row it has added, and update() only reads the rows after it.
+It is saved as a directory of .npy files, which load() memory-maps.
+
+To build or update a saved model from a database:
+    python intervalModel.py path/to/database path/to/model [--topology path/to/topology]
+'''
+
+from __future__ import division
+import argparse
+import json
+import os
+
+import numpy as np
+
+from intervalStats import SLOTS_PER_DAY, SLOTS_PER_WEEK, weekSlot
+from utilities import asDatetime, saveArray
+
+MODEL_VERSION = 1
+MIN_SLOT_COUNT = 3  # Observations needed in a slot for its own estimate.
+BATCH_SIZE = 65536  # IntervalTimes rows added to the arrays at a time.
+ARRAY_NAMES = ['counts', 'totals', 'estimates']
+
+class IntervalModel(object):
+    '''
+    Interval time estimates by line, direction, station and time of week.
+
+    Usage:
+        model = IntervalModel.fromTopology(manager.topology)
+        model.update(manager.db)
+        model.save('intervals')
+        ...
+        model = IntervalModel.load('intervals')
+        model.estimate('RD', False, 'A05', timestamp)
+    '''
+
+    def __init__(self, lines, counts=None, totals=None, estimates=None, lastRowId=0):
+        '''
+        lines: list of (lineCode, reverse, stationCodes) tuples, one per line
+            and direction, with the station codes in seqNum order.
+        counts, totals, estimates: the arrays of an existing model.
+        lastRowId: the rowid of the last IntervalTimes row in the model.
+        '''
+        self.lines = [(lineCode, bool(reverse), list(stationCodes))
+                      for lineCode, reverse, stationCodes in lines]
+        self.lineIndex = {}     # Index in the arrays of each (lineCode, reverse).
+        self.stationIndex = {}  # (line index, seqNum) of each (lineCode, reverse, stationCode).
+        for i, (lineCode, reverse, stationCodes) in enumerate(self.lines):
+            self.lineIndex[(lineCode, reverse)] = i
+            for seqNum, stationCode in enumerate(stationCodes):
+                self.stationIndex[(lineCode, reverse, stationCode)] = (i, seqNum)
+        shape = (len(self.lines), max([len(line[2]) for line in self.lines] or [0]), SLOTS_PER_WEEK)
+        self.counts = np.zeros(shape, dtype=np.int32) if counts is None else counts
+        self.totals = np.zeros(shape) if totals is None else totals
+        self.lastRowId = lastRowId
+        self.estimates = estimates
+        if estimates is None:
+            self._estimate()
+
+    @classmethod
+    def fromTopology(cls, topology):
+        '''
+        Create an empty model of the lines of a NetworkTopology.
+        '''
+        return cls([(line.lineCode, line.reverse, [station.stationCode for station in line.stations])
+                    for line in topology.lines])
+
+    def update(self, database):
+        '''
+        Add the IntervalTimes rows saved to a WMATADatabase since the last
+        update, and recompute the estimates.
+        Returns the number of rows added.
+        '''
+        if not self.counts.flags.writeable: # Memory-mapped; copy to update.
+            self.counts = np.array(self.counts)
+            self.totals = np.array(self.totals)
+        added = 0
+        lineNums = []
+        seqNums = []
+        slots = []
+        intervals = []
+        for rowId, entryTime, lineCode, direction, stationCode, interval \
+                in database.iterIntervalTimes(self.lastRowId):
+            self.lastRowId = rowId
+            index = self.stationIndex.get((lineCode, bool(direction), stationCode))
+            if index is None or interval is None or not entryTime: continue
+            lineNums.append(index[0])
+            seqNums.append(index[1])
+            slots.append(weekSlot(asDatetime(entryTime)))
+            intervals.append(interval)
+            if len(intervals) >= BATCH_SIZE:
+                added += self._add(lineNums, seqNums, slots, intervals)
+                lineNums, seqNums, slots, intervals = [], [], [], []
+        added += self._add(lineNums, seqNums, slots, intervals)
+        self._estimate()
+        return added
+
+    def _add(self, lineNums, seqNums, slots, intervals):
+        index = (np.array(lineNums, dtype=np.intp), np.array(seqNums, dtype=np.intp),
+                 np.array(slots, dtype=np.intp))
+        np.add.at(self.counts, index, 1)
+        np.add.at(self.totals, index, np.array(intervals, dtype=float))
+        return len(intervals)
+
+    def _estimate(self):
+        '''
+        Recompute the estimates array from the counts and totals.
+        '''
+        weekShape = self.counts.shape[:2] + (7, SLOTS_PER_DAY)
+        dayCounts = self.counts.reshape(weekShape).sum(axis=2)
+        dayTotals = self.totals.reshape(weekShape).sum(axis=2)
+        allCounts = dayCounts.sum(axis=2)
+        allTotals = dayTotals.sum(axis=2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            estimates = np.where(allCounts > 0, allTotals / allCounts, np.nan)[:, :, np.newaxis]
+            estimates = np.where(dayCounts >= MIN_SLOT_COUNT, dayTotals / dayCounts, estimates)
+            estimates = np.tile(estimates, (1, 1, 7))
+            estimates = np.where(self.counts >= MIN_SLOT_COUNT, self.totals / self.counts,
+                                 estimates)
+        self.estimates = estimates
+
+    def estimate(self, lineCode, reverse, stationCode, timestamp):
+        '''
+        The estimated interval time to a station from the previous one on a
+        line, at the time of timestamp; None if there is no estimate.
+        '''
+        index = self.stationIndex.get((lineCode, bool(reverse), stationCode))
+        if index is None: return None
+        interval = self.estimates[index[0], index[1], weekSlot(asDatetime(timestamp))]
+        if np.isnan(interval): return None
+        return float(interval)
+
+    def slotIntervals(self, lineCode, reverse, timestamp):
+        '''
+        The estimated interval time to each station of a line from the
+        previous one, at the time of timestamp, as a list indexed by seqNum
+        (None where there is no estimate); None if the line isn't modeled.
+        '''
+        i = self.lineIndex.get((lineCode, bool(reverse)))
+        if i is None: return None
+        intervals = self.estimates[i, :len(self.lines[i][2]), weekSlot(asDatetime(timestamp))]
+        return [None if np.isnan(interval) else interval for interval in intervals.tolist()]
+
+    def stationCodes(self, lineCode, reverse):
+        '''
+        The station codes of a line, in seqNum order; None if the line isn't modeled.
+        '''
+        i = self.lineIndex.get((lineCode, bool(reverse)))
+        if i is None: return None
+        return self.lines[i][2]
+
+    def save(self, directory):
+        '''
+        Save the model as a directory of .npy files, plus model.json.
+        '''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in ARRAY_NAMES:
+            saveArray(os.path.join(directory, name + ".npy"), getattr(self, name))
+        path = os.path.join(directory, "model.json")
+        f = open(path + ".tmp", "w")
+        json.dump({'version': MODEL_VERSION, 'lines': self.lines, 'lastRowId': self.lastRowId},
+                  f, indent=1)
+        f.close()
+        os.rename(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        '''
+        Load a saved model; its arrays are memory-mapped (read-only) unless mmap is False.
+        '''
+        f = open(os.path.join(directory, "model.json"))
+        info = json.load(f)
+        f.close()
+        if info['version'] != MODEL_VERSION:
+            raise ValueError("Unsupported interval model version %s" % info['version'])
+        arrays = [np.load(os.path.join(directory, name + ".npy"), mmap_mode='r' if mmap else None)
+                  for name in ARRAY_NAMES]
+        return cls(info['lines'], *arrays, lastRowId=info['lastRowId'])
+
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or update an interval model from a database.")
+    parser.add_argument('database', help="Database with an IntervalTimes table.")
+    parser.add_argument('model', help="Directory of the model; created if it doesn't exist.")
+    parser.add_argument('--topology', help="Saved NetworkTopology of a new model; by default, "
+                                           "built from the line data cached in the database.")
+    args = parser.parse_args()
+
+    from WMATADatabase import WMATADatabase
+    if os.path.exists(os.path.join(args.model, "model.json")):
+        model = IntervalModel.load(args.model)
+    else:
+        if args.topology:
+            from NetworkTopology import NetworkTopology
+            topology = NetworkTopology.load(args.topology)
+        else:
+            from MetroManager_SQL import WMATAManager
+            manager = WMATAManager(None, args.database, metadataTTL=None)
+            topology = manager.topology
+            manager.db.close()
+        model = IntervalModel.fromTopology(topology)
+    database = WMATADatabase(None, args.database)
+    added = model.update(database)
+    database.close()
+    model.save(args.model)
+    print "Added %i interval times; the model is up to rowid %i." % (added, model.lastRowId)
+
+if __name__ == '__main__':
+    main()
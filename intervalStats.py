@@ -0,0 +1,132 @@
+'''
+Created on Jan 26, 2012
+
+@author: dmasad
+
+Streaming estimates of the travel time between stations.
+'''
+
+from __future__ import division
+from math import sqrt
+
+SLOT_MINUTES = 15                     # Width of the time-of-day buckets.
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+SLOTS_PER_WEEK = 7 * SLOTS_PER_DAY
+ALL_DAY = -1                          # Slot number of the statistics over all times.
+EWMA_WEIGHT = 0.1                     # Weight of each new observation in the moving average.
+
+def timeSlot(timestamp):
+    '''
+    Return the time-of-day bucket of a datetime.
+    '''
+    return (timestamp.hour * 60 + timestamp.minute) // SLOT_MINUTES
+
+def weekSlot(timestamp):
+    '''
+    Return the time-of-week bucket of a datetime, counting from Monday 00:00.
+    '''
+    return timestamp.weekday() * SLOTS_PER_DAY + timeSlot(timestamp)
+
+
+class RunningStats(object):
+    '''
+    Running count, mean and variance of a series (Welford's method),
+    plus an exponentially weighted moving average.
+    '''
+    __slots__ = ('count', 'mean', 'm2', 'ewma')
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, ewma=None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2          # Sum of squared deviations from the mean.
+        self.ewma = ewma
+
+    def update(self, value, weight=EWMA_WEIGHT):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.ewma is None:
+            self.ewma = value
+        else:
+            self.ewma += weight * (value - self.ewma)
+
+    def variance(self):
+        if self.count < 2: return None
+        return self.m2 / (self.count - 1)
+
+    def std(self):
+        variance = self.variance()
+        if variance is None: return None
+        return sqrt(variance)
+
+
+class IntervalEstimator(object):
+    '''
+    Estimates the travel time to one station from the previous one on a line,
+    over all times and by time of day, updated one observation at a time.
+    '''
+
+    def __init__(self, weight=EWMA_WEIGHT):
+        self.weight = weight
+        self.stats = {}     # RunningStats, keyed by slot (or ALL_DAY).
+        self.dirty = set()  # Slots updated since the last call to changedStats().
+
+    def update(self, interval, timestamp=None):
+        '''
+        Add an observed interval time, in minutes.
+        timestamp: the datetime of the observation, for the time-of-day buckets.
+        '''
+        slots = [ALL_DAY]
+        if timestamp is not None:
+            slots.append(timeSlot(timestamp))
+        for slot in slots:
+            if slot not in self.stats:
+                self.stats[slot] = RunningStats()
+            self.stats[slot].update(interval, self.weight)
+            self.dirty.add(slot)
+
+    def count(self, slot=ALL_DAY):
+        if slot not in self.stats: return 0
+        return self.stats[slot].count
+
+    def mean(self, slot=ALL_DAY):
+        '''
+        The mean of all observations (in the given slot), or None if there are none.
+        '''
+        if slot not in self.stats: return None
+        return self.stats[slot].mean
+
+    def ewma(self, slot=ALL_DAY):
+        '''
+        The moving average of recent observations (in the given slot), or None.
+        '''
+        if slot not in self.stats: return None
+        return self.stats[slot].ewma
+
+    def estimate(self, timestamp=None):
+        '''
+        The best current estimate: the moving average for the time of day if
+        there is one, else the overall moving average; None with no observations.
+        '''
+        if timestamp is not None and timeSlot(timestamp) in self.stats:
+            return self.stats[timeSlot(timestamp)].ewma
+        return self.ewma()
+
+    def changedStats(self):
+        '''
+        Return a list of (slot, count, mean, m2, ewma) tuples for the slots
+        updated since the last call, and mark them as saved.
+        '''
+        rows = []
+        for slot in sorted(self.dirty):
+            stats = self.stats[slot]
+            rows.append((slot, stats.count, stats.mean, stats.m2, stats.ewma))
+        self.dirty = set()
+        return rows
+
+    def restore(self, slot, count, mean, m2, ewma):
+        '''
+        Restore the saved statistics of a slot.
+        '''
+        self.stats[slot] = RunningStats(count, mean, m2, ewma)
@@ -0,0 +1,296 @@
+'''
+Created on Feb 10, 2012
+
+@author: dmasad
+
+Local stand-in for the WMATA API, replaying the data recorded in a database.
+
+ReplayServer serves the JLines, JPath, JStationInfo and GetPrediction
+methods over HTTP: the line, path and station data from the API responses
+cached in the Metadata table (station data falls back on the Stations
+table), and the predictions from the saved schedules. Pointing a WMATA
+object, WMATAManager or WMATACollector at its base_url runs the whole
+collect, store and track pipeline offline, with no API key.
+
+The schedules are replayed on a clock that starts at the first
+GetPrediction request:
+    speed=1: in real time; each request gets the latest schedule recorded
+        up to that point of the recording.
+    speed=100: the same, 100 times faster.
+    speed=None: as fast as possible; each request gets the next schedule.
+Once the recording runs out, GetPrediction returns HTTP 404 (or, with
+loop=True, starts over).
+
+Usage: python replayServer.py path/to/database [--port 8000] [--speed 100|max]
+'''
+
+import argparse
+import json
+import logging
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from threading import Event, Thread
+from urlparse import urlparse, parse_qs
+
+from wmata import ARRIVING, BOARDING
+from WMATADatabase import WMATADatabase
+from utilities import asDatetime
+
+log = logging.getLogger(__name__)
+
+END_GRACE = 60 # Seconds of recorded time the last schedule is served for, in timed replays.
+PREDICTION_FIELDS = ['Car', 'Destination', 'DestinationCode', 'DestinationName', 'Group',
+                     'Line', 'LocationCode', 'LocationName', 'Min']
+
+def apiEntry(entry):
+    '''
+    Convert a PID entry, as loaded from the database, back to the form the
+    API returns it in, with 'Min' as text.
+    '''
+    record = dict((field, entry[field]) for field in PREDICTION_FIELDS)
+    if entry['ArrivalState'] == ARRIVING:
+        record['Min'] = 'ARR'
+    elif entry['ArrivalState'] == BOARDING:
+        record['Min'] = 'BRD'
+    elif entry['Min'] is None:
+        record['Min'] = '---'
+    else:
+        record['Min'] = str(entry['Min'])
+    return record
+
+
+class ReplayServer(object):
+    '''
+    Serves the recorded API data from a database over HTTP.
+
+    Usage:
+        server = ReplayServer('wmata.db', speed=100)
+        server.start()
+        api = WMATA('any key', server.base_url)
+        ...
+        server.stop()
+    '''
+
+    def __init__(self, database, speed=1.0, startTime=None, endTime=None, loop=False,
+                 archive=None):
+        '''
+        database: path to a database of recorded schedules.
+        speed: how many times faster than real time to replay the schedules,
+            or None to replay them as fast as they are requested.
+        startTime, endTime: optional inclusive bounds on the schedules replayed.
+        loop: if True, start over at the end of the recording.
+        archive: an archive.SnapshotArchive holding older schedules.
+        '''
+        self.database = database
+        self.speed = speed
+        self.startTime = startTime
+        self.endTime = endTime
+        self.loop = loop
+        self.archive = archive
+        self.finished = Event() # Set when the recording runs out.
+        self.requests = 0       # Number of GetPrediction requests served.
+        self.httpServer = None
+        self._thread = None
+        self._db = None
+        self._metadata = {}     # Cached API data, as loaded by WMATADatabase.loadMetadata.
+        self._stations = {}
+        self._schedules = None  # Iterator over the recorded (EntryTime, schedule) tuples.
+        self._current = None    # The (EntryTime, schedule) being served.
+        self._next = None
+        self._clockStart = None # (wall time, recorded time) when the replay started.
+
+    @property
+    def base_url(self):
+        host, port = self.httpServer.server_address[:2]
+        return "http://%s:%i" % (host, port)
+
+    def start(self, port=0, host='127.0.0.1'):
+        '''
+        Start serving from a background thread.
+        port: the port to listen on; by default, any free one (see base_url).
+        Returns the base URL of the server.
+        '''
+        self.httpServer = HTTPServer((host, port), _ReplayHandler)
+        self.httpServer.replay = self
+        self._thread = Thread(target=self._serve, name="ReplayServer")
+        self._thread.daemon = True
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self.httpServer.shutdown()
+        self._thread.join()
+        self.httpServer.server_close()
+
+    def serveForever(self, port=8000, host='127.0.0.1'):
+        '''
+        Serve in the foreground until interrupted.
+        '''
+        self.httpServer = HTTPServer((host, port), _ReplayHandler)
+        self.httpServer.replay = self
+        try:
+            self._serve()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.httpServer.server_close()
+
+    def _serve(self):
+        # SQLite connections can't be shared across threads, so open one here.
+        self._db = WMATADatabase(None, self.database, archive=self.archive)
+        self._metadata = self._db.loadMetadata()
+        self._stations = self._db.loadStations()
+        try:
+            self.httpServer.serve_forever()
+        finally:
+            self._db.close()
+
+    """
+    API METHODS
+    """
+
+    def lines(self):
+        return {'Lines': self._cached('lines')}
+
+    def path(self, fromStation, toStation):
+        return {'Path': self._cached('path/%s/%s' % (fromStation, toStation))}
+
+    def stationInfo(self, stationCode):
+        if 'station/' + stationCode in self._metadata:
+            return self._cached('station/' + stationCode)
+        station = self._stations.get(stationCode)
+        if station is None:
+            raise KeyError(stationCode)
+        return {'Code': station['Code'], 'Name': station['Name'],
+                'Lat': station['Lat'], 'Lon': station['Lon'],
+                'LineCode1': station['LineCode1'], 'LineCode2': station['LineCode2'],
+                'LineCode3': None, 'LineCode4': None,
+                'StationTogether1': station['StationTogether1'] or '', 'StationTogether2': ''}
+
+    def predictions(self, stationCodes="All"):
+        '''
+        Return the current recorded schedule, as GetPrediction would, for
+        'All' or a comma-separated list of station codes.
+        Raises KeyError once the recording has run out.
+        '''
+        entryTime, schedule = self._advance()
+        self.requests += 1
+        if stationCodes != "All":
+            codes = set(stationCodes.split(','))
+            schedule = [entry for entry in schedule if entry['LocationCode'] in codes]
+        return {'Trains': [apiEntry(entry) for entry in schedule]}
+
+    def _cached(self, key):
+        if key not in self._metadata:
+            raise KeyError(key)
+        return self._metadata[key][2]
+
+    """
+    REPLAY CLOCK
+    """
+
+    def _advance(self):
+        '''
+        Move the replay on to the schedule due now, and return it.
+        '''
+        if self._schedules is None:
+            self._restart()
+        if self.speed is None:
+            # One schedule per request:
+            if self._clockStart is None:
+                self._clockStart = (time.time(), None)
+            else:
+                self._current, self._next = self._next, self._fetchNext()
+        else:
+            now = time.time()
+            if self._clockStart is None:
+                self._clockStart = (now, asDatetime(self._current[0]))
+            wallStart, recordedStart = self._clockStart
+            elapsed = (now - wallStart) * self.speed
+            while self._next is not None and \
+                    _secondsBetween(recordedStart, self._next[0]) <= elapsed:
+                self._current, self._next = self._next, self._fetchNext()
+            if self._next is None and self._current is not None \
+                    and _secondsBetween(recordedStart, self._current[0]) + END_GRACE < elapsed:
+                self._current = None
+        if self._current is None:
+            if self.loop:
+                self._restart()
+                return self._advance()
+            self.finished.set()
+            raise KeyError("End of the recording")
+        return self._current
+
+    def _restart(self):
+        self._schedules = self._db.iterSchedules(self.startTime, self.endTime)
+        self._current = self._fetchNext()
+        self._next = self._fetchNext()
+        self._clockStart = None
+        if self._current is None:
+            self.finished.set()
+            raise KeyError("No recorded schedules")
+
+    def _fetchNext(self):
+        return next(self._schedules, None)
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    '''
+    Dispatches the API URLs to the ReplayServer. Connections are closed after
+    each response, so a single thread can serve several clients.
+    '''
+
+    def do_GET(self):
+        replay = self.server.replay
+        url = urlparse(self.path)
+        query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+        try:
+            if url.path.endswith('/Rail.svc/json/JLines'):
+                body = replay.lines()
+            elif url.path.endswith('/Rail.svc/json/JPath'):
+                body = replay.path(query['FromStationCode'], query['ToStationCode'])
+            elif url.path.endswith('/Rail.svc/json/JStationInfo'):
+                body = replay.stationInfo(query['StationCode'])
+            elif '/StationPrediction.svc/json/GetPrediction/' in url.path:
+                body = replay.predictions(url.path.rsplit('/', 1)[1])
+            else:
+                self.send_error(404, "Unknown API method")
+                return
+        except KeyError as error:
+            self.send_error(404, "Not recorded: %s" % error)
+            return
+        body = json.dumps(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+def _secondsBetween(earlier, later):
+    return (asDatetime(later) - earlier).total_seconds()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve recorded WMATA API data from a database.")
+    parser.add_argument('database', help="Database of recorded schedules.")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--speed', default='1',
+                        help="Times faster than real time, or 'max' for as fast as requested.")
+    parser.add_argument('--start', help="First EntryTime to replay.")
+    parser.add_argument('--end', help="Last EntryTime to replay.")
+    parser.add_argument('--loop', action='store_true', help="Start over at the end.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    speed = None if args.speed == 'max' else float(args.speed)
+    server = ReplayServer(args.database, speed, args.start, args.end, args.loop)
+    log.info("Replaying %s at http://%s:%i", args.database, args.host, args.port)
+    server.serveForever(args.port, args.host)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+'''
+Created on Feb 11, 2012
+
+@author: dmasad
+
+Vectorized forward simulation of the trains on the system.
+
+Simulator projects every tracked train forward minute by minute, the way
+Train.advance does: each minute the ETAs count down, and a train whose
+ETA at its next station runs out has arrived there and moves on, due at
+the station after it once the travel time between the two has passed.
+The travel times are the ones implied by the train's own listed arrival
+times where it has them, and the learned station interval times
+elsewhere: by default, each RailLine's estimates (from its interval model,
+for the time of week, if it has one; see intervalModel.py), or else those
+loaded by WMATADatabase.loadIntervals.
+
+What-if scenarios are run side by side on the same trains, as one more
+array dimension:
+    Scenario(delays={'C05': 4}): single-tracking, or any other slowdown;
+        trains take 4 more minutes to reach C05 from the previous station,
+        on every line through it.
+    Scenario(closures=['C05']): trains pass through C05 without stopping,
+        so it has no arrivals.
+Delays can be limited to a window of the simulated period (start, end).
+
+Usage:
+    simulator = Simulator(manager.rail_lines)
+    projection = simulator.run(60, [Scenario(), Scenario(delays={'C05': 4})])
+    projection.firstArrivals() # First arrival at every station, by scenario.
+'''
+
+from __future__ import division
+import numpy as np
+
+DEFAULT_INTERVAL = 2.0 # Travel time (minutes) to stations with no interval estimate.
+
+class Scenario(object):
+    '''
+    A what-if scenario to simulate.
+
+    delays: dictionary of extra minutes it takes to reach each station (by
+        station code) from the previous one.
+    closures: list of the codes of stations where trains don't stop.
+    start, end: the minutes of the simulation during which the delays apply,
+        by the time the train leaves the previous station; by default, all of it.
+    '''
+
+    def __init__(self, delays=None, closures=(), start=0, end=None, name=None):
+        self.delays = dict(delays or {})
+        self.closures = list(closures)
+        self.start = start
+        self.end = end
+        self.name = name
+
+    def __repr__(self):
+        if self.name is not None:
+            return "Scenario(%r)" % self.name
+        return "Scenario(delays=%r, closures=%r)" % (self.delays, self.closures)
+
+
+class Simulator(object):
+    '''
+    Simulates the trains on a set of RailLines. The stations of all the lines
+    are concatenated into one set of arrays, as in trainPositions.TrainPositions.
+    '''
+
+    def __init__(self, railLines, intervals=None, defaultInterval=DEFAULT_INTERVAL):
+        '''
+        railLines: the RailLine objects whose trains to simulate.
+        intervals: the interval times, as returned by WMATADatabase.loadIntervals;
+            by default, the current estimates of each RailLine (see 
+            RailLine.intervalTime), for the time of the current schedule.
+        defaultInterval: the interval time of stations with no estimate.
+        '''
+        self.railLines = railLines
+        self.offsets = []       # Index of each line's first station in the arrays.
+        self.stations = []      # (lineCode, reverse, stationCode) of each station.
+        self.stationIndex = {}  # Indices of each station code, on every line through it.
+        intervalTimes = []
+        for line in railLines:
+            self.offsets.append(len(self.stations))
+            for station in line.stationList:
+                self.stationIndex.setdefault(station.stationCode, []).append(len(self.stations))
+                self.stations.append((line.lineCode, line.reverse, station.stationCode))
+                if intervals is None:
+                    interval = line.intervalTime(station)
+                else:
+                    interval = intervals.get((line.lineCode, int(line.reverse), station.stationCode))
+                intervalTimes.append(np.nan if interval is None else interval)
+        self.intervals = np.array(intervalTimes, dtype=float)
+        self.intervals[np.isnan(self.intervals)] = defaultInterval
+
+    def trainState(self, includeGhosts=False):
+        '''
+        Collect the current trains on every line.
+        includeGhosts: if True, include the trains that have vanished from the
+            boards (see trainClustering.matchTrains), from where they were last seen.
+
+        Returns a TrainState: the trains, each one's line offset and length,
+        its next station (by seqNum) and ETA there, and a (trains, max line
+        length) array of the minutes it takes to reach each station of its
+        line from the previous one.
+        '''
+        trains = []
+        offsets = []
+        lengths = []
+        for offset, line in zip(self.offsets, self.railLines):
+            for train in line.Trains:
+                if train.end_of_track or train.nextStation is None: continue
+                if train.ghost and not includeGhosts: continue
+                trains.append(train)
+                offsets.append(offset)
+                lengths.append(len(line.stationList))
+        maxLength = max(lengths) if lengths else 0
+        travel = np.zeros((len(trains), maxLength))
+        seqNums = np.zeros(len(trains), dtype=np.intp)
+        etas = np.zeros(len(trains))
+        for i, train in enumerate(trains):
+            length = lengths[i]
+            intervals = self.intervals[offsets[i]:offsets[i] + length]
+            # The listed times between consecutive listed stations, where known:
+            times = np.array([np.nan if eta is None else eta for eta in train.arrivalTimes],
+                             dtype=float)
+            listed = times[1:] - times[:-1]
+            with np.errstate(invalid='ignore'):
+                listed[listed < 0] = np.nan
+            travel[i, 1:length] = np.where(np.isnan(listed), intervals[1:], listed)
+            seqNum = train.nextStation.seqNum
+            seqNums[i] = seqNum
+            eta = times[seqNum]
+            if np.isnan(eta):
+                # As in Train.findLocation, assume it's halfway there.
+                eta = intervals[seqNum] / 2 if seqNum > 0 else 0
+            etas[i] = eta
+        return TrainState(trains, np.array(offsets, dtype=np.intp),
+                          np.array(lengths, dtype=np.intp), seqNums, etas, travel)
+
+    def scenarioArrays(self, scenarios):
+        '''
+        Convert a list of Scenarios to (scenarios, stations) arrays of the
+        extra travel time to each station and whether it is closed, and
+        arrays of each scenario's delay window.
+        '''
+        delays = np.zeros((len(scenarios), len(self.stations)))
+        closed = np.zeros((len(scenarios), len(self.stations)), dtype=bool)
+        starts = np.zeros(len(scenarios))
+        ends = np.zeros(len(scenarios))
+        for i, scenario in enumerate(scenarios):
+            for stationCode, minutes in scenario.delays.items():
+                delays[i, self.stationIndex[stationCode]] += minutes
+            for stationCode in scenario.closures:
+                closed[i, self.stationIndex[stationCode]] = True
+            starts[i] = scenario.start
+            ends[i] = np.inf if scenario.end is None else scenario.end
+        return delays, closed, starts, ends
+
+    def run(self, minutes, scenarios=None, state=None, step=1):
+        '''
+        Simulate the next minutes minutes.
+
+        scenarios: list of Scenarios to run; by default, just the baseline
+            (Scenario() with no changes).
+        state: the TrainState to start from; by default, the current trains
+            (see trainState). Reuse one to run more scenarios on the same trains.
+        step: the minutes per simulation step.
+
+        Returns a Projection of the arrivals.
+        '''
+        if scenarios is None:
+            scenarios = [Scenario()]
+        if state is None:
+            state = self.trainState()
+        delays, closed, starts, ends = self.scenarioArrays(scenarios)
+        scenarioCount = len(scenarios)
+        trainCount = len(state.trains)
+
+        # The state of each train, in each scenario:
+        seqNums = np.tile(state.seqNums, (scenarioCount, 1))
+        remaining = np.tile(state.etas, (scenarioCount, 1)) # Minutes to the next station.
+        running = np.ones((scenarioCount, trainCount), dtype=bool)
+        offsets = state.offsets[np.newaxis, :]
+        lengths = state.lengths[np.newaxis, :]
+        trainNums = np.arange(trainCount)[np.newaxis, :]
+
+        events = [] # (scenario, train, station, minutes) arrays of the arrivals.
+        now = 0
+        while now <= minutes:
+            while True:
+                arrived = running & (remaining <= 0)
+                if not arrived.any(): break
+                scenario, train = np.nonzero(arrived)
+                station = state.offsets[train] + seqNums[scenario, train]
+                time = now + remaining[scenario, train]
+                stops = ~closed[scenario, station]
+                events.append((scenario[stops], train[stops], station[stops], time[stops]))
+                # Move on to the next station:
+                seqNum = seqNums[scenario, train] + 1
+                atEnd = seqNum >= state.lengths[train]
+                running[scenario[atEnd], train[atEnd]] = False
+                scenario, train, seqNum, time = (scenario[~atEnd], train[~atEnd],
+                                                 seqNum[~atEnd], time[~atEnd])
+                delay = delays[scenario, state.offsets[train] + seqNum]
+                delay[(time < starts[scenario]) | (time >= ends[scenario])] = 0
+                seqNums[scenario, train] = seqNum
+                remaining[scenario, train] += state.travel[train, seqNum] + delay
+            now += step
+            remaining -= step
+
+        if events:
+            arrays = [np.concatenate(columns) for columns in zip(*events)]
+        else:
+            arrays = [np.zeros(0, dtype=np.intp)] * 3 + [np.zeros(0)]
+        scenario, train, station, time = arrays
+        keep = time <= minutes
+        return Projection(self, scenarios, state, scenario[keep], train[keep],
+                          station[keep], time[keep])
+
+
+class TrainState(object):
+    '''
+    The starting point of a simulation, as arrays over the trains
+    (see Simulator.trainState).
+    '''
+
+    def __init__(self, trains, offsets, lengths, seqNums, etas, travel):
+        self.trains = trains
+        self.offsets = offsets
+        self.lengths = lengths
+        self.seqNums = seqNums
+        self.etas = etas
+        self.travel = travel
+
+
+class Projection(object):
+    '''
+    The predicted arrivals of a simulation run, as parallel arrays of the
+    scenario number, train number (in state.trains), station number (in
+    simulator.stations) and minutes from the start of each arrival.
+    '''
+
+    def __init__(self, simulator, scenarios, state, scenario, train, station, minutes):
+        self.simulator = simulator
+        self.scenarios = scenarios
+        self.state = state
+        self.scenario = scenario
+        self.train = train
+        self.station = station
+        self.minutes = minutes
+
+    def arrivals(self, scenario=0, stationCode=None):
+        '''
+        List the arrivals in a scenario (at one station, if given), in order,
+        as (lineCode, reverse, stationCode, trainId, minutes) tuples.
+        '''
+        mask = self.scenario == scenario
+        if stationCode is not None:
+            mask &= np.in1d(self.station, self.simulator.stationIndex.get(stationCode, []))
+        order = np.nonzero(mask)[0]
+        order = order[np.argsort(self.minutes[order], kind='mergesort')]
+        results = []
+        for i in order:
+            lineCode, reverse, code = self.simulator.stations[self.station[i]]
+            results.append((lineCode, reverse, code, self.state.trains[self.train[i]].trainId,
+                            float(self.minutes[i])))
+        return results
+
+    def firstArrivals(self):
+        '''
+        Return a (scenarios, stations) array of the first arrival at each
+        station, in minutes (NaN if none).
+        '''
+        stationCount = len(self.simulator.stations)
+        first = np.empty(len(self.scenarios) * stationCount)
+        first.fill(np.nan)
+        keys = self.scenario * stationCount + self.station
+        order = np.lexsort((self.minutes, keys))
+        keys = keys[order]
+        isFirst = np.ones(len(keys), dtype=bool)
+        isFirst[1:] = keys[1:] != keys[:-1]
+        first[keys[isFirst]] = self.minutes[order][isFirst]
+        return first.reshape(len(self.scenarios), stationCount)
+
+    def arrivalCounts(self):
+        '''
+        Return a (scenarios, stations) array of the number of arrivals at each station.
+        '''
+        stationCount = len(self.simulator.stations)
+        counts = np.bincount(self.scenario * stationCount + self.station,
+                             minlength=len(self.scenarios) * stationCount)
+        return counts.reshape(len(self.scenarios), stationCount)
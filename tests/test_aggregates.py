@@ -0,0 +1,65 @@
+'''
+Created on Feb 16, 2012
+
+@author: dmasad
+
+Tests of the materialized aggregate tables (see aggregates.py and
+AnalyticManager.materializeAggregates), on a synthetic network.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from AnalyticManager import AnalyticManager
+from benchmark import PIDGenerator, syntheticTopology
+from WMATADatabase import WMATADatabase
+
+class MaterializeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, 'aggregates.sqlite')
+        self.topology = syntheticTopology(stationCount=10)
+        generator = PIDGenerator(self.topology, unknownRate=0.05)
+        db = WMATADatabase(None, self.database)
+        db.initializeDatabase()
+        db.saveStations(generator.stationList())
+        for timestamp, schedule in generator.schedules(40):
+            db.saveSchedule(schedule, timestamp)
+        db.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def aggregates(self, manager):
+        return (manager.db.loadTrainCounts(), manager.db.loadHeadways(),
+                manager.db.loadIntervalAverages())
+
+    def testStartsFromScratch(self):
+        fresh = AnalyticManager('key', self.database, topology=self.topology)
+        self.assertEqual(fresh.materializeAggregates(), 40)
+        expected = self.aggregates(fresh)
+        self.assertTrue(expected[0])
+        # A manager that has already replayed the schedules, and so has
+        # trains left over from the last of them:
+        manager = AnalyticManager('key', self.database, topology=self.topology)
+        list(manager.iterTrainCounts())
+        self.assertTrue(any(line.Trains for line in manager.rail_lines))
+        self.assertEqual(manager.materializeAggregates(), 40)
+        self.assertTrue(self.aggregates(manager) == expected)
+
+    def testReplaysWholeBuckets(self):
+        manager = AnalyticManager('key', self.database, topology=self.topology)
+        manager.materializeAggregates()
+        expected = self.aggregates(manager)
+        # An end time partway into the 05:15 bucket still replays all of it:
+        self.assertEqual(manager.materializeAggregates(None, "2012-01-09 05:20:00"), 30)
+        self.assertTrue(self.aggregates(manager) == expected)
+        self.assertEqual([row['Snapshots'] for row in manager.db.loadTrainCounts()
+                          if row['LineCode'] == 'RD' and row['Direction'] == 0], [15, 15, 10])
+
+
+if __name__ == '__main__':
+    unittest.main()
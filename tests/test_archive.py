@@ -0,0 +1,84 @@
+'''
+Created on Feb 16, 2012
+
+@author: dmasad
+
+Tests of the schedule archive (see archive.py), and of deleting archived
+schedules from a delta-encoded database, on synthetic schedules.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import timedelta
+
+from archive import SnapshotArchive
+from benchmark import PIDGenerator, syntheticTopology
+from WMATADatabase import WMATADatabase
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        generator = PIDGenerator(syntheticTopology(stationCount=5), unknownRate=0.05)
+        # Polls a few hundred milliseconds past the minute, as the collector saves them:
+        self.polls = [(timestamp + timedelta(milliseconds=250), schedule)
+                      for timestamp, schedule in generator.schedules(12)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def database(self, name, keyframeInterval=4, archive=None):
+        db = WMATADatabase(None, os.path.join(self.directory, name),
+                           keyframeInterval=keyframeInterval, archive=archive)
+        db.initializeDatabase()
+        for timestamp, schedule in self.polls:
+            db.saveSchedule(schedule, timestamp)
+        db.flush()
+        return db
+
+    def testRoundTrip(self):
+        for keyframeInterval in [1, 4]:
+            name = 'live%i.sqlite' % keyframeInterval
+            expected = self.database('expected' + name, keyframeInterval)
+            archive = SnapshotArchive(os.path.join(self.directory, 'archive%i' % keyframeInterval))
+            db = self.database(name, keyframeInterval, archive)
+            middle = self.polls[5][0]
+            self.assertEqual(archive.archive(db, None, middle), 6)
+            self.assertEqual(db.deleteSchedules(None, middle), 6)
+            self.assertEqual(db.loadTimestamps(), expected.loadTimestamps())
+            self.assertEqual(list(db.iterSchedules()), list(expected.iterSchedules()))
+            self.assertEqual(list(db.iterSchedules(self.polls[3][0], self.polls[8][0], ['A02'])),
+                             list(expected.iterSchedules(self.polls[3][0], self.polls[8][0],
+                                                         ['A02'])))
+            self.assertEqual([(timecode, snapshot.entryTime, len(snapshot))
+                              for timecode, snapshot in db.iterSnapshots()],
+                             [(timecode, snapshot.entryTime, len(snapshot))
+                              for timecode, snapshot in expected.iterSnapshots()])
+            for timestamp, schedule in self.polls:
+                # Looked up to the second, from the archive or the database:
+                second = timestamp.replace(microsecond=0)
+                self.assertTrue(db.loadSchedule(second))
+                self.assertEqual(db.loadSchedule(second), expected.loadSchedule(second))
+                self.assertEqual(db.loadSchedule(str(timestamp)), expected.loadSchedule(second))
+            db.close()
+            expected.close()
+
+    def testDeleteKeepsDeltasDecodable(self):
+        expected = list(self.database('expected.sqlite').iterSchedules())
+        db = self.database('live.sqlite')
+        # The third poll after a keyframe is left first, and has to become one:
+        self.assertEqual(db.deleteSchedules(None, self.polls[6][0]), 7)
+        self.assertEqual(list(db.iterSchedules()), expected[7:])
+        for timecode, schedule in expected[7:]:
+            self.assertEqual(db.loadSchedule(timecode), schedule)
+        # And again, leaving only the polls after the next keyframe:
+        self.assertEqual(db.deleteSchedules(self.polls[7][0], self.polls[7][0]), 1)
+        self.assertEqual(list(db.iterSchedules()), expected[8:])
+        self.assertEqual(db.deleteSchedules(self.polls[7][0], self.polls[7][0]), 0)
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
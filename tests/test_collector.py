@@ -0,0 +1,197 @@
+'''
+Created on Feb 15, 2012
+
+@author: dmasad
+
+Tests of the collection service (see WMATACollector.py), against a stub
+API and a replayServer.ReplayServer.
+'''
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from threading import Lock
+
+from benchmark import PIDGenerator, syntheticTopology
+from replayServer import ReplayServer
+from WMATACollector import WMATACollector
+from WMATADatabase import WMATADatabase
+
+POLLS = 12
+
+def scheduleKeys(schedule):
+    '''
+    The content of a schedule, as loaded from a database, in a comparable form.
+    '''
+    return sorted((entry['LocationCode'], entry['DestinationCode'], entry['Min'],
+                   entry['ArrivalState']) for entry in schedule)
+
+def waitFor(condition, timeout=10):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+
+
+class _StubPool(object):
+    def close(self):
+        pass
+
+class _SlowStubAPI(object):
+    '''
+    Serves the schedules of a PIDGenerator in order, but answers every other
+    request slowly, so the responses come back out of order.
+    '''
+
+    def __init__(self, generator, delay=0.1):
+        self.generator = generator
+        self.delay = delay
+        self.pool = _StubPool()
+        self.calls = 0
+        self.finished = [] # Call numbers, in the order the responses came back.
+        self.schedules = {} # The schedule returned by each call.
+        self.lock = Lock()
+
+    def updateSchedule(self):
+        with self.lock:
+            call = self.calls
+            self.calls += 1
+        with self.lock:
+            schedule = self.generator.snapshot(call)
+            self.schedules[call] = schedule
+        if call % 2 == 0:
+            time.sleep(self.delay)
+        with self.lock:
+            self.finished.append(call)
+        return schedule
+
+
+class _BadStubAPI(_SlowStubAPI):
+    '''
+    As _SlowStubAPI, but every third schedule has an entry that can't be saved.
+    '''
+
+    def __init__(self, generator, delay=0.1):
+        _SlowStubAPI.__init__(self, generator, delay)
+        self.bad = 0 # Number of bad schedules returned.
+
+    def updateSchedule(self):
+        schedule = _SlowStubAPI.updateSchedule(self)
+        with self.lock:
+            if len(self.finished) % 3 == 0:
+                self.bad += 1
+                return schedule + [{'LocationCode': 'A01'}]
+        return schedule
+
+
+class CollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.generator = PIDGenerator(syntheticTopology(), unknownRate=0.05)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def newDatabase(self, name):
+        path = os.path.join(self.directory, name)
+        database = WMATADatabase(None, path)
+        database.initializeDatabase()
+        database.close()
+        return path
+
+    def storedSchedules(self, path):
+        database = WMATADatabase(None, path)
+        stored = [(timecode, schedule) for timecode, schedule in database.iterSchedules()]
+        entryTimes = [row[0] for row in 
+                      database.db.execute("SELECT EntryTime FROM Snapshots ORDER BY SnapshotId")]
+        database.close()
+        return stored, entryTimes
+
+    def testStopBeforeStart(self):
+        collector = WMATACollector('key', self.newDatabase("unused.db"))
+        collector.stop()
+        collector.stop()
+
+    def testWritesInPollOrder(self):
+        path = self.newDatabase("collected.db")
+        collector = WMATACollector('key', path, interval=0.02, jitter=0, fetchers=4,
+                                   keyframeInterval=3)
+        collector.api = _SlowStubAPI(self.generator)
+        collector.start()
+        waitFor(lambda: collector.api.calls >= POLLS)
+        collector.stop()
+        api = collector.api
+        self.assertNotEqual(api.finished, sorted(api.finished)) # Responses were out of order.
+        self.assertEqual(collector.stats['written'], api.calls)
+
+        stored, entryTimes = self.storedSchedules(path)
+        self.assertEqual(len(stored), api.calls)
+        self.assertEqual(entryTimes, sorted(entryTimes))
+        self.assertEqual(len(set(entryTimes)), len(entryTimes))
+        # Each poll's schedule is reconstructed intact from the delta encoding:
+        expected = sorted(scheduleKeys(self.loadBack(schedule))
+                          for schedule in api.schedules.values())
+        self.assertTrue(sorted(scheduleKeys(schedule) for timecode, schedule in stored) == expected,
+                        "The stored schedules differ from the ones polled.")
+
+    def testSkipsSchedulesThatFailToSave(self):
+        path = self.newDatabase("collected.db")
+        collector = WMATACollector('key', path, interval=0.02, jitter=0, fetchers=1)
+        collector.api = _BadStubAPI(self.generator, delay=0)
+        collector.start()
+        waitFor(lambda: collector.api.calls >= POLLS)
+        collector.stop()
+        self.assertTrue(collector.api.bad > 0)
+        self.assertEqual(collector.stats['written'], collector.stats['polls'] - collector.api.bad)
+        self.assertEqual(len(self.storedSchedules(path)[0]), collector.stats['written'])
+
+    def testStopsWithoutWriter(self):
+        # The writer can't open the database, and the queue fills up:
+        collector = WMATACollector('key', os.path.join(self.directory, "missing", "x.db"),
+                                   interval=0.01, jitter=0, queueSize=1)
+        collector.api = _SlowStubAPI(self.generator, delay=0)
+        collector.start()
+        waitFor(lambda: collector.stats['dropped'] > 0)
+        collector.stop()
+        self.assertEqual(collector.stats['written'], 0)
+
+    def loadBack(self, schedule):
+        # Round-trip a generated schedule through a database, to parse it the same way.
+        database = WMATADatabase(None)
+        database.initializeDatabase()
+        database.saveSchedule(schedule, "2012-01-09 05:00:00")
+        loaded = database.loadSchedule("2012-01-09 05:00:00")
+        database.close()
+        return loaded
+
+    def testCollectsFromReplayServer(self):
+        source = self.newDatabase("source.db")
+        database = WMATADatabase(None, source)
+        for timestamp, schedule in self.generator.schedules(POLLS):
+            database.saveSchedule(schedule, timestamp)
+        recorded = [scheduleKeys(schedule) for timecode, schedule in database.iterSchedules()]
+        database.close()
+
+        server = ReplayServer(source, speed=None)
+        path = self.newDatabase("collected.db")
+        collector = WMATACollector('key', path, interval=0.02, jitter=0, fetchers=2,
+                                   keyframeInterval=4, base_url=server.start())
+        try:
+            collector.start()
+            waitFor(lambda: collector.stats['polls'] >= POLLS // 2)
+            collector.stop()
+        finally:
+            server.stop()
+        self.assertTrue(collector.stats['written'] >= POLLS // 2)
+
+        stored, entryTimes = self.storedSchedules(path)
+        self.assertEqual(len(stored), collector.stats['written'])
+        self.assertEqual(entryTimes, sorted(entryTimes))
+        for timecode, schedule in stored:
+            self.assertTrue(scheduleKeys(schedule) in recorded)
+
+
+if __name__ == '__main__':
+    unittest.main()
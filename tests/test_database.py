@@ -0,0 +1,159 @@
+'''
+Created on Feb 16, 2012
+
+@author: dmasad
+
+Tests of the schedule storage (see WMATADatabase.py): the delta encoding
+between keyframes, and the migration from the legacy ArrivalTimes table.
+'''
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from datetime import timedelta
+
+from benchmark import PIDGenerator, syntheticTopology, START_TIME
+from wmata import parseMinutes
+from WMATADatabase import WMATADatabase
+
+def entry(location, destination, minutes, group='1', line='RD', car='6'):
+    return {'LocationCode': location, 'LocationName': "Station " + location,
+            'DestinationCode': destination, 'Destination': destination,
+            'DestinationName': "Station " + destination, 'Line': line, 'Group': group,
+            'Min': minutes, 'Car': car}
+
+def entryKeys(schedule):
+    '''
+    The content of a schedule, original or loaded, in a comparable form.
+    '''
+    return sorted((entry['LocationCode'], entry['DestinationCode'], entry['Line'],
+                   unicode(entry['Group']), minutes(entry), unicode(entry['Car']))
+                  for entry in schedule)
+
+def minutes(entry):
+    if 'ArrivalState' in entry: # Already parsed, when loaded.
+        return entry['Min'], entry['ArrivalState']
+    return parseMinutes(entry['Min'])
+
+def changingSchedules():
+    '''
+    Schedules with entries added, removed and changed from one poll to the next.
+    '''
+    schedule = [entry('A01', 'A05', '3'), entry('A01', 'A05', '9'), entry('A02', 'A05', '1'),
+                entry('A02', 'A01', 'BRD', group='2'), entry('A03', 'A01', '---', group='2')]
+    schedules = [list(schedule)]
+    for change in range(9):
+        schedule = [dict(item) for item in schedule]
+        if change % 3 == 0:
+            # A train arrives, and another is listed behind it on the same board:
+            schedule[0]['Min'] = 'ARR'
+            schedule.append(entry('A01', 'A05', str(12 + change)))
+        elif change % 3 == 1:
+            # The first train leaves, and an unknown entry gets a time:
+            del schedule[0]
+            for item in schedule:
+                if item['Min'] == '---':
+                    item['Min'] = '4'
+        else:
+            # Times count down, a car count changes, and an entry goes unknown:
+            for item in schedule:
+                if item['Min'] not in ['ARR', 'BRD', '---']:
+                    item['Min'] = str(max(1, int(item['Min']) - 1))
+            schedule[-1]['Car'] = '8'
+            schedule[1]['Min'] = '---'
+        schedules.append(schedule)
+    schedules.append([]) # An empty poll.
+    schedules.append([entry('A04', 'A01', '7', group='2')])
+    return [(START_TIME + timedelta(minutes=i), schedule) for i, schedule in enumerate(schedules)]
+
+
+class DeltaEncodingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.polls = changingSchedules()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testRoundTrip(self):
+        for keyframeInterval in [1, 2, 4]:
+            for bufferPolls in [1, 3]:
+                name = "delta%i-%i.db" % (keyframeInterval, bufferPolls)
+                path = os.path.join(self.directory, name)
+                db = WMATADatabase(None, path, bufferPolls, keyframeInterval)
+                db.initializeDatabase()
+                for timestamp, schedule in self.polls:
+                    db.saveSchedule(schedule, timestamp)
+                db.close()
+
+                db = WMATADatabase(None, path)
+                keyframes = [row[0] for row in
+                             db.db.execute("SELECT Keyframe FROM Snapshots ORDER BY SnapshotId")]
+                self.assertEqual(keyframes, [int(i % keyframeInterval == 0)
+                                             for i in range(len(self.polls))])
+                # Empty schedules have no rows, so aren't yielded:
+                stored = list(db.iterSchedules())
+                expected = [(timestamp, schedule) for timestamp, schedule in self.polls if schedule]
+                self.assertEqual([timecode for timecode, schedule in stored],
+                                 [timestamp for timestamp, schedule in expected])
+                for (timecode, schedule), (timestamp, original) in zip(stored, expected):
+                    self.assertEqual(entryKeys(schedule), entryKeys(original),
+                                     "Keyframe interval %i, at %s" % (keyframeInterval, timecode))
+                for timestamp, original in self.polls:
+                    self.assertEqual(entryKeys(db.loadSchedule(timestamp)), entryKeys(original))
+                # A range starting between keyframes:
+                self.assertEqual([entryKeys(schedule) for timecode, schedule in
+                                  db.iterSchedules(self.polls[3][0], self.polls[6][0], ['A01'])],
+                                 [entryKeys(item for item in original
+                                            if item['LocationCode'] == 'A01')
+                                  for timestamp, original in self.polls[3:7]])
+                db.close()
+
+
+class MigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "legacy.db")
+        generator = PIDGenerator(syntheticTopology(stationCount=5), unknownRate=0.1)
+        self.polls = list(generator.schedules(8))
+        # A database in the schema from before the compact tables:
+        db = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES)
+        db.execute('''CREATE TABLE ArrivalTimes
+                      (EntryTime TIMESTAMP, TrainGroup TEXT, Min TEXT, DestinationCode TEXT,
+                       Car TEXT, Destination TEXT, DestinationName TEXT, LocationName TEXT,
+                       Line TEXT, LocationCode TEXT)''')
+        for timestamp, schedule in self.polls:
+            db.executemany('''INSERT INTO ArrivalTimes VALUES (:CurrentTime, :Group, :Min,
+                                :DestinationCode, :Car, :Destination, :DestinationName,
+                                :LocationName, :Line, :LocationCode)''',
+                           [dict(item, CurrentTime=timestamp) for item in schedule])
+        db.commit()
+        db.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testMigrateArrivalTimes(self):
+        textFields = ['LocationCode', 'LocationName', 'DestinationCode', 'Destination',
+                      'DestinationName', 'Line', 'Group', 'Car']
+        db = WMATADatabase(None, self.path)
+        self.assertEqual(db.migrateArrivalTimes(dropLegacy=True, batchPolls=3), len(self.polls))
+        self.assertEqual(db.db.execute("SELECT name FROM sqlite_master WHERE name = 'ArrivalTimes'")
+                         .fetchall(), [])
+        self.assertEqual(db.loadTimestamps(), [timestamp for timestamp, schedule in self.polls])
+        for timestamp, schedule in self.polls:
+            loaded = db.loadSchedule(timestamp)
+            self.assertEqual(entryKeys(loaded), entryKeys(schedule))
+            self.assertEqual(set(item['CurrentTime'] for item in loaded), set([timestamp]))
+            # The text fields come back as they were:
+            self.assertEqual(sorted(tuple(item[key] for key in textFields) for item in loaded),
+                             sorted(tuple(item[key] for key in textFields) for item in schedule))
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
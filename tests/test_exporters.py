@@ -0,0 +1,70 @@
+'''
+Created on Feb 16, 2012
+
+@author: dmasad
+
+Tests of the streaming table writers (see exporters.py).
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from exporters import (exportRecords, pyarrow, ArrowExporter, ParquetExporter,
+                       TRAIN_COUNT_FIELDS, TRAIN_COUNT_TYPES)
+from headwayAnalytics import REPORT_FIELDS, REPORT_TYPES
+
+def trainCounts(count):
+    return [{'TimeStamp': datetime(2012, 1, 9, 8, minute), 'Line': 'RD',
+             'Direction': bool(minute % 2), 'TrainCount': minute} for minute in range(count)]
+
+def readTable(filepath):
+    if filepath.endswith('.parquet'):
+        return pyarrow.parquet.read_table(filepath)
+    return pyarrow.ipc.open_file(pyarrow.memory_map(filepath)).read_all()
+
+
+@unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+class ColumnarExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testEmptyExport(self):
+        for name in ['counts.parquet', 'counts.arrow']:
+            filepath = os.path.join(self.directory, name)
+            self.assertEqual(exportRecords([], filepath, TRAIN_COUNT_FIELDS,
+                                           types=TRAIN_COUNT_TYPES), 0)
+            table = readTable(filepath)
+            self.assertEqual(table.num_rows, 0)
+            self.assertEqual(table.schema.names, TRAIN_COUNT_FIELDS)
+            self.assertEqual(str(table.schema.field_by_name('TrainCount').type), 'int64')
+
+    def testRowGroups(self):
+        for name, exporterClass in [('counts.parquet', ParquetExporter),
+                                    ('counts.arrow', ArrowExporter)]:
+            filepath = os.path.join(self.directory, name)
+            with exporterClass(filepath, TRAIN_COUNT_FIELDS, TRAIN_COUNT_TYPES,
+                               rowGroupSize=16) as exporter:
+                exporter.writeMany(trainCounts(50))
+            self.assertEqual(readTable(filepath).column('TrainCount').to_pylist(), range(50))
+
+    def testTypesOfMissingValues(self):
+        # Without types, a first group of None values would be inferred as null:
+        row = dict((field, None) for field in REPORT_FIELDS)
+        row.update({'LineCode': 'RD', 'Direction': 0, 'StationCode': 'A01', 'Arrivals': 1,
+                    'Headways': 0, 'Bunching': 0, 'Gaps': 0})
+        full = dict(row, Headways=2, MeanHeadway=6.0, MaxHeadway=7.5, MeanWait=3.1)
+        filepath = os.path.join(self.directory, 'report.parquet')
+        with ParquetExporter(filepath, REPORT_FIELDS, REPORT_TYPES, rowGroupSize=1) as exporter:
+            exporter.writeMany([row, full])
+        self.assertEqual(readTable(filepath).column('MeanHeadway').to_pylist(), [None, 6.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+'''
+Created on Feb 16, 2012
+
+@author: dmasad
+
+Tests of the caching of the static API data (see
+WMATAManager._cachedMetadata), against a stub API.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import MetroManager_SQL
+from MetroManager_SQL import WMATAManager
+from NetworkTopology import LINES
+from WMATADatabase import WMATADatabase
+
+class _StubAPI(object):
+    '''
+    Serves a two-station path for each line, and counts the requests.
+    '''
+
+    def __init__(self, api_key, base_url=None):
+        self.requests = 0
+
+    def getRailLines(self):
+        self.requests += 1
+        return [{'LineCode': lineCode,
+                 'StartStationCode': lineCode + '1', 'InternalDestination1': '',
+                 'EndStationCode': lineCode + '2', 'InternalDestination2': ''}
+                for lineCode in LINES]
+
+    def getRailPath(self, startStation, endStation):
+        self.requests += 1
+        return [{'StationCode': startStation, 'StationName': startStation, 'SeqNum': '1'},
+                {'StationCode': endStation, 'StationName': endStation, 'SeqNum': '2'}]
+
+def stationList():
+    codes = [lineCode + end for lineCode in LINES for end in '12'] + ['C15', 'E06']
+    return [{'Code': code, 'Name': code, 'Lat': 38.9, 'Lon': -77.0, 'LineCode1': None,
+             'LineCode2': None, 'StationTogether1': None} for code in codes]
+
+
+class MetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, 'metadata.sqlite')
+        db = WMATADatabase(None, self.database)
+        db.initializeDatabase()
+        db.saveStations(stationList())
+        db.close()
+        self.realAPI = MetroManager_SQL.WMATA
+        MetroManager_SQL.WMATA = _StubAPI
+
+    def tearDown(self):
+        MetroManager_SQL.WMATA = self.realAPI
+        shutil.rmtree(self.directory)
+
+    def testCacheIsUsed(self):
+        first = WMATAManager('key', self.database)
+        self.assertTrue(first.api.requests > 0)
+        second = WMATAManager('key', self.database)
+        self.assertEqual(second.api.requests, 0)
+
+    def testRefreshOnlyAtStartup(self):
+        manager = WMATAManager('key', self.database, refreshMetadata=True)
+        requests = manager.api.requests
+        self.assertTrue(requests > 0)
+        manager.getRailPath('RD1', 'RD2')
+        self.assertEqual(manager.api.requests, requests)
+        manager.refreshMetadata()
+        self.assertTrue(manager.api.requests > requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
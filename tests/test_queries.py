@@ -0,0 +1,99 @@
+'''
+Created on Feb 16, 2012
+
+@author: dmasad
+
+Tests of the range queries (see WMATAQueries.py), on synthetic schedules.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from benchmark import PIDGenerator, syntheticTopology, START_TIME
+from wmata import parseMinutes
+from WMATADatabase import WMATADatabase
+from WMATAQueries import WMATAQueries
+
+START = "2012-01-09 05:10:00"
+END = "2012-01-09 05:20:00"
+
+class PredictionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.generator = PIDGenerator(syntheticTopology(stationCount=5), unknownRate=0.05)
+        self.polls = list(self.generator.schedules(30))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def database(self, keyframeInterval):
+        path = os.path.join(self.directory, 'queries%i.sqlite' % keyframeInterval)
+        db = WMATADatabase(None, path, keyframeInterval=keyframeInterval)
+        db.initializeDatabase()
+        for timestamp, schedule in self.polls:
+            db.saveSchedule(schedule, timestamp)
+        return db
+
+    def expected(self, stationCode, destinationCode=None):
+        # The station's entries of every schedule in the range, in listing order:
+        return [(str(timestamp), entry['DestinationCode'], parseMinutes(entry['Min'])[0])
+                for timestamp, schedule in self.polls if START <= str(timestamp) <= END
+                for entry in schedule if entry['LocationCode'] == stationCode
+                and destinationCode in (None, entry['DestinationCode'])]
+
+    def testPredictions(self):
+        for keyframeInterval in [1, 4]:
+            queries = WMATAQueries(self.database(keyframeInterval))
+            entries = list(queries.predictions('A03', START, END))
+            self.assertEqual([(str(entry['CurrentTime']), entry['DestinationCode'], entry['Min'])
+                              for entry in entries], self.expected('A03'))
+            self.assertEqual(len(list(queries.predictions('A03', START, END, 'A05'))),
+                             len(self.expected('A03', 'A05')))
+            self.assertEqual(list(queries.predictions('Z99', START, END)), [])
+            queries.database.close()
+
+
+class IntervalsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = WMATADatabase(None)
+        self.db.initializeDatabase()
+        # At A02 in the 05:00 and 06:00 hours of Monday and 05:00 on Tuesday, at A03,
+        # and in the other direction:
+        self.rows = [(START_TIME, 'RD', 0, 'A02', 2.0),
+                     (START_TIME + timedelta(minutes=10), 'RD', 0, 'A02', 4.0),
+                     (START_TIME + timedelta(minutes=20), 'RD', 0, 'A03', 3.0),
+                     (START_TIME + timedelta(hours=1), 'RD', 0, 'A02', 5.0),
+                     (START_TIME + timedelta(days=1), 'RD', 0, 'A02', 1.0),
+                     (START_TIME, 'RD', 1, 'A02', 9.0)]
+        self.db.saveIntervals(self.rows)
+        self.queries = WMATAQueries(self.db)
+
+    def tearDown(self):
+        self.db.close()
+
+    def testIntervals(self):
+        self.assertEqual([row[-1] for row in self.queries.intervals('RD', False)],
+                         [2.0, 4.0, 5.0, 1.0, 3.0])
+        self.assertEqual([row[-1] for row in self.queries.intervals('RD', True)], [9.0])
+        self.assertEqual([row[-1] for row in self.queries.intervals('RD', 0, 'A02', START_TIME,
+                                                                     datetime(2012, 1, 9, 6))],
+                         [2.0, 4.0, 5.0])
+
+    def testIntervalsByHourOfWeek(self):
+        rows = list(self.queries.intervalsByHourOfWeek('RD', 0))
+        self.assertEqual([(row['StationCode'], row['HourOfWeek'], row['Count'])
+                          for row in rows],
+                         [('A02', 5, 2), ('A02', 6, 1), ('A02', 29, 1), ('A03', 5, 1)])
+        self.assertEqual((rows[0]['MeanInterval'], rows[0]['MinInterval'],
+                          rows[0]['MaxInterval']), (3.0, 2.0, 4.0))
+        rows = list(self.queries.intervalsByHourOfWeek('RD', 0, 'A02', endTime=END))
+        self.assertEqual([(row['HourOfWeek'], row['Count']) for row in rows], [(5, 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+'''
+Created on Feb 15, 2012
+
+@author: dmasad
+
+Regression tests of the train finder, on synthetic schedules (see benchmark.py).
+
+Run from the repository root with:
+    python -m unittest discover -s tests -t .
+'''
+
+import unittest
+
+from benchmark import PIDGenerator, syntheticTopology, _BenchmarkManager
+from intervalStats import ALL_DAY
+from ScheduleSnapshot import ScheduleSnapshot, NO_TRAIN
+from TrainLines import Train
+
+SEEDS = range(6)
+SETTINGS = [(0.5, 0.01), (2.0, 0.1), (0.0, 0.0)] # (noise, unknownRate) of the schedules.
+
+def legacyFindTrains(line, pidDict):
+    '''
+    Assemble the trains of a line the way findTrains did before the ordered
+    sweep, with the recursive _seekTrainForward below.
+    '''
+    line._matchPIDs(pidDict)
+    line.newTrains = []
+    line.trainCount = 0
+    for startingNumber, station in enumerate(line.stationList):
+        for entry in station.arrivals:
+            if entry['Train'] is None:
+                _seekTrainForward(line, startingNumber, len(line.newTrains))
+    return line.newTrains
+
+def _seekTrainForward(line, startingNumber, initTrainCount, destinationCode=None):
+    trainCount = initTrainCount
+    maxWait = 0
+    for entry in line.stationList[startingNumber].arrivals:
+        if entry['Train'] == None and (entry['DestinationCode'] == destinationCode
+                                       or destinationCode is None):
+            trainCount = trainCount + 1
+            line.trainCount = line.trainCount + 1
+            newTrain = Train(line, destinationCode)
+            destinationCode = entry['DestinationCode']
+            newTrain.update_location(line.stationList[startingNumber])
+            entry['Train'] = trainCount
+            newTrain.update_listings(entry)
+            maxWait = entry['Min']
+            break
+    if trainCount == initTrainCount: return initTrainCount
+    counter = startingNumber + 1
+    while counter < len(line.stationList):
+        for entry in line.stationList[counter].arrivals:
+            if entry['Train'] == None:
+                if entry['Min'] > maxWait and entry['DestinationCode'] == destinationCode:
+                    entry['Train'] = trainCount
+                    newTrain.update_listings(entry)
+                    maxWait = entry['Min']
+                    break
+                elif entry['DestinationCode'] == destinationCode:
+                    _seekTrainForward(line, counter, line.trainCount, destinationCode)
+                else:
+                    _seekTrainForward(line, counter, line.trainCount)
+        counter = counter + 1
+    line.newTrains.append(newTrain)
+
+def schedules(seed, noise, unknownRate, count=10, step=13):
+    '''
+    Synthetic schedules, each entry tagged with its 'Index' in the schedule.
+    '''
+    generator = PIDGenerator(syntheticTopology(), noise=noise, unknownRate=unknownRate, seed=seed)
+    for timestamp, schedule in generator.schedules(count, step):
+        for index, entry in enumerate(schedule):
+            entry['Index'] = index
+        yield timestamp, schedule
+
+def trainGroups(trains):
+    '''
+    The set of trains, each as the frozenset of its entries' indexes.
+    '''
+    return set(frozenset(entry['Index'] for entry in train.listings) for train in trains)
+
+
+class AssembleTrainsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.topology = syntheticTopology()
+
+    def testSweepMatchesRecursion(self):
+        # The ordered sweep groups the entries into the same trains as the recursion.
+        for seed in SEEDS:
+            for noise, unknownRate in SETTINGS:
+                legacy = _BenchmarkManager(self.topology)
+                current = _BenchmarkManager(self.topology)
+                for timestamp, schedule in schedules(seed, noise, unknownRate):
+                    legacyDict = legacy._listToDict([dict(entry) for entry in schedule],
+                                                    ['LocationCode', 'DestinationCode'])
+                    currentDict = current._listToDict([dict(entry) for entry in schedule],
+                                                      ['LocationCode', 'DestinationCode'])
+                    for legacyLine, line in zip(legacy.rail_lines, current.rail_lines):
+                        expected = trainGroups(legacyFindTrains(legacyLine, legacyDict))
+                        line.findTrains(currentDict)
+                        self.assertEqual(trainGroups(line.newTrains), expected,
+                                         "Seed %i, noise %s, line %s%s, at %s" 
+                                         % (seed, noise, line.lineCode, 
+                                            " (reverse)" if line.reverse else "", timestamp))
+
+    def testSnapshotMatchesDictionaries(self):
+        # A ScheduleSnapshot gives the same trains as the PID dictionaries.
+        for seed in SEEDS[:2]:
+            for noise, unknownRate in SETTINGS:
+                fromDicts = _BenchmarkManager(self.topology)
+                fromSnapshots = _BenchmarkManager(self.topology)
+                for timestamp, schedule in schedules(seed, noise, unknownRate):
+                    fromDicts.currentSchedule = [dict(entry) for entry in schedule]
+                    fromDicts.findTrains()
+                    snapshot = ScheduleSnapshot.fromSchedule(schedule)
+                    fromSnapshots.currentSchedule = snapshot
+                    fromSnapshots.findTrains()
+                    for dictLine, snapshotLine in zip(fromDicts.rail_lines, 
+                                                      fromSnapshots.rail_lines):
+                        self.assertEqual([train.arrivalTimes for train in snapshotLine.Trains],
+                                         [train.arrivalTimes for train in dictLine.Trains])
+                        for dictTrain, snapshotTrain in zip(dictLine.newTrains, 
+                                                            snapshotLine.newTrains):
+                            self.assertEqual([(entry['LocationCode'], entry['Min'], entry['Train'])
+                                              for entry in snapshotTrain.listings],
+                                             [(entry['LocationCode'], entry['Min'], entry['Train'])
+                                              for entry in dictTrain.listings])
+                            # The listings are copies, which don't refer to the snapshot:
+                            for entry in snapshotTrain.listings:
+                                self.assertTrue(isinstance(entry, dict))
+                    # The snapshot records the same train for each entry:
+                    self.assertEqual([None if train == NO_TRAIN else train
+                                      for train in snapshot.train.tolist()],
+                                     [entry.get('Train') for entry in fromDicts.currentSchedule])
+
+
+class UpdateIntervalsTest(unittest.TestCase):
+
+    def testBeforeAnyPollTime(self):
+        # A schedule found without a time updates only the all-day estimates:
+        topology = syntheticTopology()
+        manager = _BenchmarkManager(topology)
+        manager.currentSchedule = PIDGenerator(topology).snapshot(240)
+        manager.findTrains()
+        observations = manager.updateIntervals()
+        self.assertTrue(observations)
+        self.assertEqual(set(row[0] for row in observations), set([None]))
+        station = manager.rail_lines[0].stationList[1]
+        self.assertEqual(station.intervals.stats.keys(), [ALL_DAY])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+'''
+Created on Feb 15, 2012
+
+@author: dmasad
+
+Tests of the train position estimates (see trainPositions.py).
+'''
+
+import unittest
+
+import numpy as np
+
+from benchmark import PIDGenerator, syntheticTopology, _BenchmarkManager
+
+class TrainPositionsTest(unittest.TestCase):
+
+    def setUp(self):
+        topology = syntheticTopology()
+        self.manager = _BenchmarkManager(topology)
+        generator = PIDGenerator(topology, noise=1.0, unknownRate=0.05)
+        for minute in [240, 241]:
+            self.manager.currentSchedule = generator.snapshot(minute)
+            self.manager.findTrains()
+        # Interval times missing, zero and typical, on alternate stations:
+        for line in self.manager.rail_lines:
+            for station in line.stationList[1::3]:
+                station.intervals.update(0.0)
+            for station in line.stationList[2::3]:
+                station.intervals.update(2.0)
+
+    def testVectorizedMatchesFindLocation(self):
+        positions = self.manager.trainPositions.locate()
+        for line, (lats, lons) in zip(self.manager.rail_lines, positions):
+            for train, lat, lon in zip(line.Trains, lats, lons):
+                train.findLocation()
+                self.assertAlmostEqual(train.lat, lat)
+                self.assertAlmostEqual(train.lon, lon)
+
+    def testFindLocationFallsBackToHalfway(self):
+        line = self.manager.rail_lines[0]
+        train = [train for train in line.Trains if train.nextStation.seqNum > 0][0]
+        station = train.nextStation
+        previous = line.stationList[station.seqNum - 1]
+        train.arrivalTimes[station.seqNum] = None
+        train.findLocation()
+        self.assertAlmostEqual(train.lat, (station.lat + previous.lat) / 2.0)
+        self.assertTrue(np.isfinite(train.lon))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+'''
+Created on Feb 16, 2012
+
+@author: dmasad
+
+Tests of the shared helpers (see utilities.py).
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+from utilities import asDatetime, saveArray
+
+class UtilitiesTest(unittest.TestCase):
+
+    def testAsDatetime(self):
+        moment = datetime(2012, 1, 9, 8, 30, 15, 250000)
+        self.assertTrue(asDatetime(moment) is moment)
+        self.assertEqual(asDatetime(None), None)
+        self.assertEqual(asDatetime(str(moment)), moment)
+        self.assertEqual(asDatetime(moment.isoformat()), moment)
+        self.assertEqual(asDatetime(u"2012-01-09 08:30:15"), moment.replace(microsecond=0))
+
+    def testSaveArray(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "values.npy")
+            saveArray(path, np.arange(3))
+            saveArray(path, np.arange(5))
+            self.assertEqual(list(np.load(path)), range(5))
+            self.assertEqual(os.listdir(directory), ["values.npy"])
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,29 +1,45 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
 
-def matchTrains(oldTrains, newTrains):
+MATCH_THRESHOLD = 5 # Maximum distance, in minutes, between two matched trains.
+MAX_GHOST_AGE = 10  # Number of snapshots an unmatched train is kept as a ghost.
+
+def matchTrains(oldTrains, newTrains, threshold=MATCH_THRESHOLD, optimal=True,
+                maxGhost=MAX_GHOST_AGE):
     '''
     Receive two lists of trains, and match them as follows:
     
     Find the distance between each new and old train.
-    Associate the two closest
+    If optimal is True, find the assignment that matches the most trains 
+    closer than threshold, with the smallest total distance.
+    Otherwise, associate the closest pairs first.
     
+    Unmatched old trains are kept as ghosts, until they have been missing
+    for more than maxGhost snapshots (never dropped if maxGhost is None).
     '''
     
-    pair_distances = {}
-    
-    # Find the distances between all old, new trains.
-    for i_old, old_train in enumerate(oldTrains):
-        old_train.matched = False
-        for i_new, new_train in enumerate(newTrains):
-            new_train.matched = False
-            pair_distances[(i_old, i_new)] = trainDistance(old_train, new_train)
-    
-    # Match trains from nearest to farthest:
-    sorted_pairs = sorted(pair_distances, key=pair_distances.get)
-    for pair in sorted_pairs:
-        i_old, i_new = pair
-        if oldTrains[i_old].matched == False and newTrains[i_new].matched == False\
-            and pair_distances[pair] < 5: #Arbitrary threshold for now
-            
+    for train in oldTrains + newTrains:
+        train.matched = False
+    
+    if oldTrains and newTrains:
+        distances = distanceMatrix(oldTrains, newTrains)
+        with np.errstate(invalid='ignore'):
+            gated = ~(distances < threshold) # Also excludes NaN distances.
+        if optimal:
+            # Gated pairs cost more than any set of allowed pairs:
+            cost = np.where(gated, threshold * (len(newTrains) + 1), distances)
+            rows, cols = linear_sum_assignment(cost)
+            pairs = [(i_old, i_new) for i_old, i_new in zip(rows, cols) if not gated[i_old, i_new]]
+        else:
+            # Match trains from nearest to farthest:
+            order = np.argsort(distances, axis=None, kind='mergesort')
+            pairs = []
+            for i_old, i_new in zip(*np.unravel_index(order, distances.shape)):
+                if gated[i_old, i_new]: break
+                if oldTrains[i_old].matched == False and newTrains[i_new].matched == False:
+                    newTrains[i_new].matched = oldTrains[i_old]
+                    oldTrains[i_old].matched = newTrains[i_new]
+        for i_old, i_new in pairs:
             newTrains[i_new].matched = oldTrains[i_old]
             oldTrains[i_old].matched = newTrains[i_new]
     
@@ -37,9 +53,34 @@ def matchTrains(oldTrains, newTrains):
     for train in oldTrains:
         if train.matched == False and train.end_of_track == False:
             train.ghost += 1
-            trainList.append(train)
+            if maxGhost is None or train.ghost <= maxGhost:
+                trainList.append(train)
     return trainList
 
+def distanceMatrix(oldTrains, newTrains):
+    '''
+    Compute the distance, as in trainDistance, between every old and new train.
+    Returns an array of shape (len(oldTrains), len(newTrains)); pairs where
+    an ETA is missing have a distance of NaN.
+    '''
+    oldETAs, oldSeq = etaMatrix(oldTrains)
+    newETAs, newSeq = etaMatrix(newTrains)
+    # Compare the ETAs at the next station of the train further along:
+    seqNums = np.maximum(oldSeq[:, np.newaxis], newSeq[np.newaxis, :])
+    rows = np.arange(len(oldTrains))[:, np.newaxis]
+    cols = np.arange(len(newTrains))[np.newaxis, :]
+    return np.abs(newETAs[cols, seqNums] - oldETAs[rows, seqNums])
+
+def etaMatrix(trains):
+    '''
+    Returns an array of the trains' ETAs, indexed by (train, station seqNum),
+    with NaN for missing ETAs, and an array of each train's next station seqNum.
+    All the trains must be on the same RailLine.
+    '''
+    etas = np.array([train.arrivalTimes for train in trains], dtype=float) # None becomes NaN.
+    seqNums = np.array([train.nextStation.seqNum for train in trains], dtype=np.intp)
+    return etas, seqNums
+
     
 def trainDistance(train1, train2):
     '''
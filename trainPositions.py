@@ -0,0 +1,105 @@
+'''
+Created on Jan 24, 2012
+
+@author: dmasad
+
+Vectorized estimates of train positions along the lines.
+
+Gives the same positions as Train.findLocation, for every train on every
+line at once: a train is placed between its previous and next stations,
+at the fraction ETA / interval time of the way from the previous one.
+Missing ETAs or interval times, and fractions over 1, give a fraction of 0.5.
+'''
+
+from __future__ import division
+import numpy as np
+
+def locateTrains(seqNums, etas, lats, lons, intervals, firstStation=None):
+    '''
+    Compute the positions of a set of trains.
+
+    seqNums: array of the index of each train's next station in the station arrays.
+    etas: array of each train's ETA at its next station (NaN if unknown).
+    lats, lons: arrays of station coordinates.
+    intervals: array of the estimated travel time to each station from the
+        previous one (NaN if unknown).
+    firstStation: boolean array marking the stations at the start of a line;
+        by default, only station 0. Trains headed to these are placed at the station.
+
+    Returns arrays of the trains' latitudes and longitudes.
+    '''
+    if firstStation is None:
+        firstStation = np.arange(len(lats)) == 0
+    prevNums = np.where(firstStation[seqNums], seqNums, seqNums - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = etas / intervals[seqNums]
+        fraction[~np.isfinite(fraction) | (fraction > 1)] = 0.5
+    lat = lats[prevNums] + (lats[seqNums] - lats[prevNums]) * fraction
+    lon = lons[prevNums] + (lons[seqNums] - lons[prevNums]) * fraction
+    return lat, lon
+
+
+class TrainPositions(object):
+    '''
+    Locates the trains on a set of RailLines in a single vectorized pass.
+    The station coordinates of all the lines are concatenated into one
+    set of arrays when the object is created.
+    '''
+
+    def __init__(self, railLines):
+        self.railLines = railLines
+        self.offsets = []   # Index of each line's first station in the arrays.
+        lats = []
+        lons = []
+        for line in railLines:
+            self.offsets.append(len(lats))
+            lats += [station.lat for station in line.stationList]
+            lons += [station.lon for station in line.stationList]
+        self.lats = np.array(lats, dtype=float)
+        self.lons = np.array(lons, dtype=float)
+        self.firstStation = np.zeros(len(lats), dtype=bool)
+        self.firstStation[self.offsets] = True
+
+    def intervals(self):
+        '''
+        Collect the current estimated interval time of every station.
+        '''
+        intervals = []
+        for line in self.railLines:
+            for station in line.stationList:
+                interval = line.intervalTime(station)
+                intervals.append(np.nan if interval is None else interval)
+        return np.array(intervals, dtype=float)
+
+    def locate(self, intervals=None):
+        '''
+        Compute the position of every train on every line.
+
+        intervals: optional array of station interval times, as returned by
+            intervals(); computed from the current Station data if omitted.
+
+        Returns a list with one (lat, lon) tuple of arrays per line.
+        '''
+        if intervals is None:
+            intervals = self.intervals()
+        seqNums = []
+        etas = []
+        counts = []
+        for offset, line in zip(self.offsets, self.railLines):
+            counts.append(len(line.Trains))
+            for train in line.Trains:
+                seqNums.append(offset + train.nextStation.seqNum)
+                eta = train.findETA(train.nextStation.stationCode)
+                etas.append(np.nan if eta is None else eta)
+        seqNums = np.array(seqNums, dtype=np.intp)
+        etas = np.array(etas, dtype=float)
+
+        lat, lon = locateTrains(seqNums, etas, self.lats, self.lons, intervals,
+                                self.firstStation)
+
+        positions = []
+        start = 0
+        for count in counts:
+            positions.append((lat[start:start+count], lon[start:start+count]))
+            start += count
+        return positions
@@ -0,0 +1,35 @@
+'''
+Created on Feb 16, 2012
+
+@author: dmasad
+
+Small helpers shared by the storage and analysis modules.
+'''
+
+import os
+from datetime import datetime
+
+import numpy as np
+
+def asDatetime(timestamp):
+    '''
+    Return timestamp as a datetime. Strings are parsed as stored in the
+    database, "YYYY-MM-DD HH:MM:SS" with optional microseconds (a 'T' may
+    separate the date and time); anything else is returned as it is.
+    '''
+    if not isinstance(timestamp, basestring):
+        return timestamp
+    timestamp = timestamp.replace('T', ' ', 1)
+    if timestamp[19:20] == '.':
+        return datetime.strptime(timestamp[:26], "%Y-%m-%d %H:%M:%S.%f")
+    return datetime.strptime(timestamp[:19], "%Y-%m-%d %H:%M:%S")
+
+def saveArray(path, array):
+    '''
+    Save an array to a .npy file, replacing any existing file only once
+    the new one is complete.
+    '''
+    f = open(path + ".tmp", "wb")
+    np.save(f, array)
+    f.close()
+    os.rename(path + ".tmp", path)
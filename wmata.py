@@ -7,17 +7,131 @@ Python class for working with WMATA API
 '''
 
 import json
-import csv
-from urllib2 import urlopen
+import httplib
+import socket
+from Queue import Queue, Empty, Full
+from urllib import urlencode
+from urlparse import urlparse
 from collections import defaultdict
+from itertools import chain
+
+from exporters import exportRecords
+
+DEFAULT_BASE_URL = "http://api.wmata.com"
+DEFAULT_TIMEOUT = 10 # Seconds to wait for an API response.
+
+# Arrival states of a PID entry, as encoded in its 'Min' field.
+MINUTES = 0   # A countdown in minutes.
+ARRIVING = 1  # 'ARR'
+BOARDING = 2  # 'BRD'
+UNKNOWN = 3   # Empty or nonstandard entries, such as '---'.
+
+def parseMinutes(minText):
+    '''
+    Parse the 'Min' field of a PID entry.
+    
+    Returns a tuple of (minutes, state), where state is one of the arrival
+    state codes above; arriving and boarding trains are 0 minutes away, and
+    the minutes of UNKNOWN entries are None.
+    '''
+    if minText == 'ARR': return 0, ARRIVING
+    if minText == 'BRD': return 0, BOARDING
+    try:
+        return int(minText), MINUTES
+    except (TypeError, ValueError):
+        return None, UNKNOWN
+
+class WMATAError(IOError):
+    '''
+    Raised when the API can't be reached or returns an error status.
+    '''
+    pass
+
+class ConnectionPool(object):
+    '''
+    A thread-safe pool of keep-alive HTTP connections to a single host.
+    '''
+    
+    def __init__(self, base_url, timeout=DEFAULT_TIMEOUT, size=4):
+        url = urlparse(base_url)
+        if url.scheme == 'https':
+            self.connectionClass = httplib.HTTPSConnection
+        else:
+            self.connectionClass = httplib.HTTPConnection
+        self.host = url.netloc
+        self.prefix = url.path.rstrip('/')
+        self.timeout = timeout
+        self.connections = Queue(size)
+    
+    def get(self, path):
+        '''
+        GET path from the host, reusing an idle connection if there is one.
+        Returns the response body.
+        
+        A request that fails on a reused connection (which the server may
+        have closed) is retried once on a new connection.
+        '''
+        try:
+            connection = self.connections.get_nowait()
+            reused = True
+        except Empty:
+            connection = self.connectionClass(self.host, timeout=self.timeout)
+            reused = False
+        
+        try:
+            connection.request("GET", self.prefix + path)
+            response = connection.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error) as error:
+            connection.close()
+            if reused:
+                return self.get(path)
+            raise WMATAError("Request for %s failed: %s" % (path, error))
+        
+        if response.status != 200:
+            connection.close()
+            raise WMATAError("Request for %s returned HTTP %i" % (path, response.status))
+        if response.getheader('connection', '').lower() == 'close' or response.version < 11:
+            connection.close()
+        else:
+            self.release(connection)
+        return body
+    
+    def release(self, connection):
+        try:
+            self.connections.put_nowait(connection)
+        except Full:
+            connection.close()
+    
+    def close(self):
+        while True:
+            try:
+                self.connections.get_nowait().close()
+            except Empty:
+                break
 
 class WMATA(object):
 
-    def __init__(self, api_key):
+    def __init__(self, api_key, base_url=DEFAULT_BASE_URL, timeout=DEFAULT_TIMEOUT):
+        '''
+        api_key: a valid WMATA API key.
+        base_url: root URL of the API, which may be a local stand-in server.
+        timeout: seconds to wait for each API response.
+        '''
         self.api_key = api_key
+        self.base_url = base_url
+        self.pool = ConnectionPool(base_url, timeout)
         self.currentSchedule = [] # List that will hold the current schedule.
         self.stationdata = {}     # Dictionary that will hold station data.
     
+    def _getJSON(self, path, **params):
+        '''
+        Request an API method over a pooled connection, and decode the JSON response.
+        Raises WMATAError if the request fails, and ValueError for invalid JSON.
+        '''
+        params['api_key'] = self.api_key
+        return json.loads(self.pool.get(path + "?" + urlencode(params)))
+    
     def updateSchedule(self, stationCodes="All"):
         '''
         Returns a list of rail schedule dictionaries.
@@ -27,10 +141,7 @@ class WMATA(object):
         '''
         
         # Update the schedule from the API and return it.
-        url = "http://api.wmata.com/StationPrediction.svc/json/GetPrediction/" \
-                + stationCodes + "?api_key=" + self.api_key
-        schedule_json = urlopen(url)
-        return json.loads(schedule_json.read())['Trains']
+        return self._getJSON("/StationPrediction.svc/json/GetPrediction/" + stationCodes)['Trains']
     
     def scheduleDict(self, keys):
         '''
@@ -61,10 +172,7 @@ class WMATA(object):
         If that is unsuccessful, get it from the web API.
         '''
         
-        url = "http://api.wmata.com/Rail.svc/json/JLines?api_key=" + self.api_key
-        lines_json = urlopen(url)
-        lines_raw = lines_json.read()
-        return json.loads(lines_raw)['Lines']
+        return self._getJSON("/Rail.svc/json/JLines")['Lines']
         
     
     def getRailPath(self, startStation, endStation):
@@ -72,18 +180,16 @@ class WMATA(object):
         Returns a list of rail stations between startStation and endStation.
         '''
         
-        url = "http://api.wmata.com/Rail.svc/json/JPath?FromStationCode=" + startStation + "&ToStationCode=" + endStation + "&api_key=" + self.api_key
-        path_json = urlopen(url)
-        return json.loads(path_json.read())['Path']
+        return self._getJSON("/Rail.svc/json/JPath", FromStationCode=startStation, 
+                             ToStationCode=endStation)['Path']
     
     def getStationData(self, stationCode):
         '''
         Get station data.
         '''
         if stationCode not in self.stationdata:
-            url = "http://api.wmata.com/Rail.svc/json/JStationInfo?StationCode=" + stationCode + "&api_key=" + self.api_key
-            station_json = urlopen(url)
-            self.stationdata[stationCode] = json.loads(station_json.read())
+            self.stationdata[stationCode] = self._getJSON("/Rail.svc/json/JStationInfo", 
+                                                          StationCode=stationCode)
         return self.stationdata[stationCode]
     
     def saveStationData(self, filepath):
@@ -94,23 +200,25 @@ class WMATA(object):
         for station in stationdata:
             self.stationdata[station] = stationdata[station]       
     
-    def export_data(self, data, filepath):
-        '''
-        Exports a list of dictionaries with the same fields
-        to a CSV file.
+    def export_data(self, data, filepath, fields=None, format=None, types=None):
         '''
-        f = open(filepath, "wb")
-        writer = csv.writer(f)
-        row = []
-        for key in data[0]:
-            row.append(key)
-        writer.writerow(row)
+        Exports an iterable of dictionaries with the same fields to a CSV
+        (or, depending on format or the file extension, Parquet or Arrow)
+        file, one record at a time.
         
-        for entry in data:
-            row = []
-            for key in entry:
-                row.append(entry[key])
-            writer.writerow(row)
+        fields: list of the fields to write, in order; by default, the
+            fields of the first record.
+        types: dictionary of the fields' pyarrow type names, for Parquet 
+            and Arrow files; see exporters.py.
+        Returns the number of records written.
+        '''
+        data = iter(data)
+        if fields is None:
+            first = next(data, None)
+            if first is None: return 0
+            fields = first.keys()
+            data = chain([first], data)
+        return exportRecords(data, filepath, fields, format, types)
                  
     def _writeJSON(self, json_data, filepath):
         f = open(filepath, "w")